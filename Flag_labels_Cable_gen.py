@@ -1,24 +1,24 @@
-import chardet
-from io import BytesIO
-import csv
-import os
-import pyqrcode
-from PIL import Image, ImageDraw, ImageFont, ImageColor
-
-# Define conversion factor (1 mm = 11.81 pixels at 300 DPI)
+from collections import namedtuple
+from functools import lru_cache
+import math
+from PIL import Image, ImageDraw
+import labels_common
+from labels_common import (PREVIEW_PPI, METRICS_FILE, VERIFY_WORKERS, SHARD_WORKERS, QR_CACHE_SIZE, PrintField,
+                           SheetStyle, LabelKind, convert_color, fit_label_font, generate_qr_image, label_qr_image,
+                           natural_sort_key, port_sort_key, qr_image_size, qr_placeholder_image, text_width, timed_stage)
+
+# Resolution in pixels per inch (1 mm = 11.81 pixels at 300 PPI)
 PPI = 300
-#inch = 25.4 mm
-#MM_TO_PIXELS = 11.81
-MM_TO_PIXELS = PPI / 25.4
 
-font_type = "arial.ttf"
-font_type = "consolab.ttf"
+# Label text font, the size is reduced to fit the text into the label
+#FONT_TYPE = "arial.ttf"
+FONT_TYPE = "consolab.ttf"
+FONT_SIZE = 29
 
 # Define label dimensions in mm
 LABEL_WIDTH = 57 #37
 TOTAL_LABEL_WIDTH = 101 #84 
 LABEL_HEIGHT = 13
-TOTAL_LABEL_HEIGHT = LABEL_HEIGHT * 2
  
 TAIL_WIDTH = 10
 TAIL_SHIFT = 1.5 # 2
@@ -30,29 +30,49 @@ LABEL_COLOR = 'yellow'
 #LABEL_COLOR = 'white'
 BACK_COLOR = (230,230,230)
 
-CORNER_RADIUS = 0.5 * MM_TO_PIXELS  # Adjust corner roundness
-TOTAL_LABEL_WIDTH_PX = TOTAL_LABEL_WIDTH * MM_TO_PIXELS
-TOTAL_LABEL_HEIGHT_PX = TOTAL_LABEL_HEIGHT * MM_TO_PIXELS
+# Tail corner radius in mm, 0 for square corners
+CORNER_RADIUS = 0.5
 
-def convert_color(color):
-    if isinstance(color, str):
-        return ImageColor.getrgb(color)  # Convert color name to RGB tuple
-    return color  # If already an RGB tuple, return as is
+# QR code settings
+#Low (L): Recovers 7% of data. Medium (M): Recovers 15% of data. Quartile (Q): Recovers 25% of data. High (H): Recovers 30% of data.
+QR_VERSION = 5 #5 8
+QR_SCALE = 3   #3 2
+QR_QUIET_ZONE = 4
+QR_ERROR = 'M'
+# A4 Left Right side mergin.
+SIDE_MERGIN = 4 # mm
 
-def detect_file_encoding(csv_filename):
+# Pre-rotated text lines of the upside-down half kept in memory
+TEXT_CACHE_SIZE = 1024
+
+# CSV columns used for a label, SrcODF, TrgODF and Copies may be missing
+CSV_COLUMNS = ('SrcName', 'SrcIP', 'SrcPort', 'TrgName', 'TrgIP', 'TrgPort', 'SrcODF', 'TrgODF', 'Copies')
+OPTIONAL_COLUMNS = ('SrcODF', 'TrgODF', 'Copies')
+
+# Columns to group the rows by before the port order, e.g. ('SrcName', 'SrcODF')
+SORT_GROUP_BY = ()
+
+# Render profiles: the constants a profile may set (TOML keys are their lower case names) and the ones
+# that may be 0. Settings missing in a profile keep the values above.
+PROFILE_SETTINGS = ('PPI', 'FONT_TYPE', 'FONT_SIZE', 'LABEL_WIDTH', 'TOTAL_LABEL_WIDTH', 'LABEL_HEIGHT', 'TAIL_WIDTH', 'TAIL_SHIFT',
+                    'LINE_WIDTH', 'CORNER_RADIUS', 'LABEL_COLOR', 'BACK_COLOR', 'SIDE_MERGIN', 'QR_VERSION', 'QR_SCALE', 'QR_QUIET_ZONE', 'QR_ERROR')
+PROFILE_ZERO_SETTINGS = ('CORNER_RADIUS', 'TAIL_SHIFT', 'SIDE_MERGIN', 'QR_QUIET_ZONE')
+
+# Compact row record holding only the label columns (namedtuple has empty __slots__)
+CableRow = namedtuple('CableRow', ['sname', 'sip', 'sport', 'tname', 'tip', 'tport', 'src_odf', 'trg_odf', 'copies'])
+
+def row_sort_key(row):
     """
-    Detect the encoding of a file using chardet.
-    
+    Sort key of a row: the SORT_GROUP_BY columns, then the natural SrcPort order.
+
     Args:
-        csv_filename (str): The path to the CSV file.
-    
+        row (CableRow): The row.
+
     Returns:
-        str: The detected encoding.
+        tuple: The precomputed sort key.
     """
-    with open(csv_filename, 'rb') as file:
-        raw_data = file.read()
-        result = chardet.detect(raw_data)
-        return result['encoding']
+    groups = tuple(natural_sort_key(row[CSV_COLUMNS.index(column)]) for column in SORT_GROUP_BY)
+    return groups + (port_sort_key(row.sport),)
 
 
 def create_arc_points(x, y, radius, start_angle, end_angle, segments=16):
@@ -69,18 +89,97 @@ def create_arc_points(x, y, radius, start_angle, end_angle, segments=16):
         ))
     return points
 
-def draw_label(data_lab_a, data_lab_b, data_qr_a = '', data_qr_b = ''):
+@lru_cache(maxsize=QR_CACHE_SIZE)
+@timed_stage('qr_seconds')
+def generate_flipped_qr_image(data_qr, version, scale, quiet_zone, background, error='M'):
+    """
+    Generate a QR code image turned by 180 degrees for the upside-down half of a flag.
+
+    Takes the same arguments as generate_qr_image and flips its cached image.
+
+    Returns:
+        Image: The flipped QR code image. It is shared by all callers, do not modify it.
+    """
+    return generate_qr_image(data_qr, version, scale, quiet_zone, background, error=error).transpose(Image.Transpose.ROTATE_180)
+
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def rotated_text_line(line, font, start):
+    """
+    Render a line of text turned by 180 degrees for the upside-down half of a flag.
+
+    The line is drawn black on a transparent tile exactly as it would be drawn
+    at a position with the fractional part start, then the tile is rotated.
+    Whole lines are cached rather than single glyphs, so kerning and
+    antialiasing stay the same as for text drawn in place.
+
+    Args:
+        line (str): The text line.
+        font (FreeTypeFont): The font from load_font.
+        start (tuple): The fractional part of the (x, y) text position.
+
+    Returns:
+        tuple: (tile, left, top) - the rotated RGBA tile, shared by all callers, and the
+        offset of the unrotated tile from the integer part of the text position.
+    """
+    left, top, right, bottom = font.getbbox(line)
+    pad_left = max(0, -left) + 2
+    pad_top = max(0, -top) + 2
+    tile = Image.new("RGBA", (pad_left + max(right, 0) + 2, pad_top + max(bottom, 0) + 2), (255, 255, 255, 0))
+    ImageDraw.Draw(tile).text((pad_left + start[0], pad_top + start[1]), line, font=font, fill=(0, 0, 0))
+    return tile.transpose(Image.Transpose.ROTATE_180), -pad_left, -pad_top
+
+def paste_rotated(img, tile, x, y, box, origin):
+    """
+    Paste a 180 degree rotated tile as if it was placed unrotated into a box that is then rotated.
+
+    Args:
+        img (Image): The label image.
+        tile (Image): The rotated tile, pasted with its alpha channel as mask.
+        x (int): The left edge of the unrotated tile within the box.
+        y (int): The top edge of the unrotated tile within the box.
+        box (tuple): The (width, height) of the box, parts of the tile outside it are cut off.
+        origin (tuple): The (x, y) of the rotated box on the label.
+    """
+    box_width, box_height = box
+    tile_width, tile_height = tile.size
+    # Part of the unrotated tile inside the box
+    x0, y0 = max(x, 0), max(y, 0)
+    x1, y1 = min(x + tile_width, box_width), min(y + tile_height, box_height)
+    if x0 >= x1 or y0 >= y1:
+        return
+    # The same part of the rotated tile, and where it lands once the box is rotated
+    part = tile.crop((x + tile_width - x1, y + tile_height - y1, x + tile_width - x0, y + tile_height - y0))
+    position = (origin[0] + box_width - x1, origin[1] + box_height - y1)
+    if part.mode == "RGBA":
+        img.paste(part, position, part)
+    else:
+        img.paste(part, position)
+
+
+@lru_cache(maxsize=None)
+@timed_stage('shape_seconds')
+def label_template(profile):
+    """
+    Draw the blank flag of a render profile once: the outline with its tail and the fold line.
+
+    Args:
+        profile (RenderProfile): The render profile.
+
+    Returns:
+        Image: The blank flag, copied for every label drawn with the profile.
+    """
     # Create a blank white image
-    img = Image.new("RGBA", (int(TOTAL_LABEL_WIDTH_PX), int(TOTAL_LABEL_HEIGHT_PX)), BACK_COLOR)
+    mm_to_pixels = profile.mm_to_pixels
+    img = Image.new("RGBA", (int(profile.total_label_width_px), int(profile.total_label_height_px)), profile.back_color)
     draw = ImageDraw.Draw(img)
     
     # Convert measurements to pixels
-    w = TOTAL_LABEL_WIDTH_PX - 1 
-    h = TOTAL_LABEL_HEIGHT_PX -1
-    split_x = LABEL_WIDTH * MM_TO_PIXELS
-    split_y1 = TAIL_SHIFT * MM_TO_PIXELS
-    split_y2 = (TAIL_SHIFT + TAIL_WIDTH) * MM_TO_PIXELS
-    r = CORNER_RADIUS
+    w = profile.total_label_width_px - 1 
+    h = profile.total_label_height_px -1
+    split_x = profile.label_width * mm_to_pixels
+    split_y1 = profile.tail_shift * mm_to_pixels
+    split_y2 = (profile.tail_shift + profile.tail_width) * mm_to_pixels
+    r = profile.corner_radius_px
     
     # Create the complete path points
     path_points = []
@@ -105,11 +204,11 @@ def draw_label(data_lab_a, data_lab_b, data_qr_a = '', data_qr_b = ''):
     path_points.append((0, r))  # Left edge
     
     # Draw the filled shape
-    draw.polygon(path_points, fill = LABEL_COLOR, outline="black", width = LINE_WIDTH)
+    draw.polygon(path_points, fill = profile.label_color, outline="black", width = profile.line_width)
     
     # Draw dashed line
-    x1, y1 = 0, LABEL_HEIGHT * MM_TO_PIXELS
-    x2, y2 = LABEL_WIDTH * MM_TO_PIXELS, LABEL_HEIGHT * MM_TO_PIXELS
+    x1, y1 = 0, profile.label_height * mm_to_pixels
+    x2, y2 = profile.label_width * mm_to_pixels, profile.label_height * mm_to_pixels
     dash_length = 3
     gap_length = 3
     current_x = x1
@@ -117,245 +216,251 @@ def draw_label(data_lab_a, data_lab_b, data_qr_a = '', data_qr_b = ''):
         next_x = min(current_x + dash_length, x2)
         draw.line([(current_x, y1), (next_x, y2)], fill="black", width=1)
         current_x += dash_length + gap_length
+    return img
+
+def draw_label(profile, data_lab_a, data_lab_b, data_qr_a = '', data_qr_b = ''):
+    # The QR codes and texts are drawn on a copy of the blank flag
+    mm_to_pixels = profile.mm_to_pixels
+    img = label_template(profile).copy()
+    draw = ImageDraw.Draw(img)
 
     # QR Generation
-    #Low (L): Recovers 7% of data. Medium (M): Recovers 15% of data. Quartile (Q): Recovers 25% of data. High (H): Recovers 30% of data.
-    version = 5 #5 8
-    scale = 3   #3 2
-    quiet_zone = 4
-    qr_background = convert_color(LABEL_COLOR)
-    # Create a QR code with UTF-8 encoding
-    qr_a = pyqrcode.create(data_qr_a, encoding='utf-8', version=version, error='M')
-    qr_b = pyqrcode.create(data_qr_b, encoding='utf-8', version=version, error='M')
-    # Generate the QR code as PNG and save to a BytesIO object
-    qr_png_a = BytesIO()
-    qr_png_b = BytesIO()
-    qr_a.png(qr_png_a, scale=scale, quiet_zone = quiet_zone, background = qr_background)
-    qr_b.png(qr_png_b, scale=scale, quiet_zone = quiet_zone, background = qr_background)
-    qr_png_a.seek(0)  # Reset the pointer to the beginning of the file-like object
-    qr_png_b.seek(0)  # Reset the pointer to the beginning of the file-like object    
-    
-    # Convert the PNG from BytesIO to a PIL Image
-    qr_img_a = Image.open(qr_png_a)
-    qr_img_b = Image.open(qr_png_b)
+    qr_background = convert_color(profile.label_color)
+    # Create the QR codes, cached by payload
+    qr_img_a = label_qr_image(profile, data_qr_a, qr_background)
     qr_img_width, qr_img_height = qr_img_a.size
 
     # Split both sets of data into lines
     a_lines = data_lab_a.split("\n")
     b_lines = data_lab_b.split("\n")
-    # Combine both sets of lines
-    all_lines = a_lines + b_lines
-    
-    font_size = 29
-    font_type = "arial.ttf"
-    font_type = "consolab.ttf"
-    
-    font = ImageFont.truetype(font_type, font_size)
-    # Calculate line height
-    line_height = draw.textbbox((0, 0), "Ay", font = font)[3]  # Use textbbox to get height
-    # Calculate total text height and maximum text width
-    total_text_height = max(len(a_lines) * line_height, len(b_lines) * line_height)
-    total_text_width = max(draw.textbbox((0, 0), line, font=font)[2] for line in all_lines)
+
     # Define maximum allowed dimensions
-    max_width = (LABEL_WIDTH - 4) * MM_TO_PIXELS - qr_img_width
-    max_height = LABEL_HEIGHT * MM_TO_PIXELS - 2 * MM_TO_PIXELS
-    img.paste(qr_img_a, (round(1 * MM_TO_PIXELS), round(1 * MM_TO_PIXELS)))
-    
-    # Calculate scale factor to fit text within the rectangle
-    scale_factor = min(max_width / total_text_width, max_height / total_text_height)    
-    # If scaling is needed, adjust font size
-    if scale_factor != 1:
-        adjusted_font_size = int(font_size * scale_factor)
-        font = ImageFont.truetype(font_type, adjusted_font_size)
-        line_height = draw.textbbox((0, 0), "Ay", font=font)[3]  # Use textbbox to get height
+    max_width = (profile.label_width - 4) * mm_to_pixels - qr_img_width
+    max_height = profile.label_height * mm_to_pixels - 2 * mm_to_pixels
+    img.paste(qr_img_a, (round(1 * mm_to_pixels), round(1 * mm_to_pixels)))
+
+    # Fit the widest line of both halves and the taller of them
+    font, line_height = fit_label_font(profile, a_lines + b_lines, max(len(a_lines), len(b_lines)), max_width, max_height)
 
     # Draw each line of text
-    for i, line in enumerate(a_lines):
-        draw.text((2 * MM_TO_PIXELS + qr_img_width, 1 * MM_TO_PIXELS + i * line_height), line, font=font, fill=(0, 0, 0))    
+    with timed_stage('text_seconds'):
+        for i, line in enumerate(a_lines):
+            draw.text((2 * mm_to_pixels + qr_img_width, 1 * mm_to_pixels + i * line_height), line, font=font, fill=(0, 0, 0))    
+
+    # The upside-down half is drawn straight into its place: the box it fills is
+    # turned by 180 degrees, so the QR code goes to its bottom right corner and
+    # the text lines are pasted pre-rotated, bottom line first from the top
+    box = (round(max_width + qr_img_width + 2 * mm_to_pixels), round(max_height))
+    origin = (round(1 * mm_to_pixels), round((profile.label_height + 1) * mm_to_pixels))
+
+    # Add the flipped QR code
+    if profile.qr_placeholder:
+        qr_img_b = qr_placeholder_image(profile.qr_version, profile.qr_scale, profile.qr_quiet_zone, qr_background, rotated=True)
+    else:
+        qr_img_b = generate_flipped_qr_image(data_qr_b, profile.qr_version, profile.qr_scale, profile.qr_quiet_zone, qr_background, error=profile.qr_error)
+    paste_rotated(img, qr_img_b, 0, 0, box, origin)
 
-    # Create a separate image for the flipped text
-    flipped_img = Image.new("RGBA", (round(max_width + qr_img_width + 2 * MM_TO_PIXELS), round(max_height)), (255, 255, 255, 0))
-    flipped_draw = ImageDraw.Draw(flipped_img)
+    # Add the flipped text
+    with timed_stage('text_seconds'):
+        for i, line in enumerate(b_lines):
+            x, y = 1 * mm_to_pixels + qr_img_width, i * line_height
+            tile, left, top = rotated_text_line(line, font, (math.modf(x)[0], math.modf(y)[0]))
+            paste_rotated(img, tile, int(x) + left, int(y) + top, box, origin)
 
-    # Add the QR code to the new image
-    flipped_img.paste(qr_img_b, (0, 0)) 
+    return img
 
-    # Draw text on the separate image
-    for i, line in enumerate(b_lines):
-        flipped_draw.text((1 * MM_TO_PIXELS + qr_img_width, i * line_height), line, font=font, fill=(0, 0, 0))
+def printer_label_fields(profile, data_lab_a, data_lab_b, data_qr_a = '', data_qr_b = ''):
+    """
+    Lay out a flag label as printer fields, at the places draw_label draws them.
 
-    # Rotate the image 180 degrees
-    flipped_img = flipped_img.rotate(180, expand=True)
+    The destination half is printed upside down: its text lines are rotated
+    180 degrees. The QR code is printed upright in the place of the rotated
+    one, which scans the same.
 
-    # Paste the rotated text onto the main label
-    img.paste(flipped_img, (round(1 * MM_TO_PIXELS), round((LABEL_HEIGHT + 1) * MM_TO_PIXELS)), flipped_img)
-    return img
+    Args:
+        profile (RenderProfile): The render profile.
+        data_lab_a (str): The source label text.
+        data_lab_b (str): The destination label text.
+        data_qr_a (str): The data of the source QR code.
+        data_qr_b (str): The data of the destination QR code.
+
+    Returns:
+        tuple: (width, height, fields), the label size in dots and its PrintField entries.
+    """
+    mm_to_pixels = profile.mm_to_pixels
+    qr_img_width = qr_image_size(profile.qr_version, profile.qr_scale, profile.qr_quiet_zone)
+    quiet_zone_px = round(profile.qr_quiet_zone * profile.qr_scale)
+
+    a_lines = data_lab_a.split("\n")
+    b_lines = data_lab_b.split("\n")
+    max_width = (profile.label_width - 4) * mm_to_pixels - qr_img_width
+    max_height = profile.label_height * mm_to_pixels - 2 * mm_to_pixels
+    font, line_height = fit_label_font(profile, a_lines + b_lines, max(len(a_lines), len(b_lines)), max_width, max_height)
 
+    # Printer QR codes have no quiet zone, the symbol starts after it
+    fields = [PrintField('qr', round(1 * mm_to_pixels) + quiet_zone_px, round(1 * mm_to_pixels) + quiet_zone_px, profile.qr_scale, data_qr_a, False)]
+    for i, line in enumerate(a_lines):
+        fields.append(PrintField('text', 2 * mm_to_pixels + qr_img_width, 1 * mm_to_pixels + i * line_height, font.size, line, False))
+
+    # Box of the flipped half, anything at (x, y) in it lands at (x0 + w - x, y0 + h - y)
+    flipped_x = round(1 * mm_to_pixels)
+    flipped_y = round((profile.label_height + 1) * mm_to_pixels)
+    flipped_width = round(max_width + qr_img_width + 2 * mm_to_pixels)
+    flipped_height = round(max_height)
+    fields.append(PrintField('qr', flipped_x + flipped_width - qr_img_width + quiet_zone_px,
+                             flipped_y + flipped_height - qr_img_width + quiet_zone_px, profile.qr_scale, data_qr_b, False))
+    for i, line in enumerate(b_lines):
+        line_width = text_width(font, line)
+        fields.append(PrintField('text', flipped_x + flipped_width - (1 * mm_to_pixels + qr_img_width) - line_width,
+                                 flipped_y + flipped_height - i * line_height - line_height, font.size, line, True))
+    return int(profile.total_label_width_px), int(profile.total_label_height_px), fields
 
-def draw_dotted_lines(draw, start_x, start_y, end_x, end_y, dash_length=5, gap_length=5):
+def label_data(row):
     """
-    Draw dotted lines between two points.
+    Build the label texts and QR payloads of a row.
 
     Args:
-        draw (ImageDraw): The drawing context.
-        start_x (int): The starting x-coordinate.
-        start_y (int): The starting y-coordinate.
-        end_x (int): The ending x-coordinate.
-        end_y (int): The ending y-coordinate.
-        dash_length (int): The length of each dash.
-        gap_length (int): The length of the gap between dashes.
+        row (CableRow): The row.
+
+    Returns:
+        tuple: (data_lab_a, data_lab_b, data_qr_a, data_qr_b) in the argument order of draw_label.
     """
-    total_length = ((end_x - start_x) ** 2 + (end_y - start_y) ** 2) ** 0.5
-    dashes = int(total_length // (dash_length + gap_length))
-    
-    for i in range(dashes):
-        start = i * (dash_length + gap_length)
-        end = start + dash_length
-        x = start_x + (end_x - start_x) * (start / total_length)
-        y = start_y + (end_y - start_y) * (start / total_length)
-        x_end = start_x + (end_x - start_x) * (end / total_length)
-        y_end = start_y + (end_y - start_y) * (end / total_length)
-        draw.line([(x, y), (x_end, y_end)], fill=(0, 0, 0), width=1)
-
-def place_labels_on_a4_sheet(labels, output_filename):
+    # Extract the data from the CSV row
+    sport = row.sport
+    sname = row.sname
+    tname = row.tname
+    tport = row.tport
+    sip = row.sip
+    tip = row.tip
+
+    # SrcODF and TrgODF are empty strings if the columns are not present
+    src_odf = row.src_odf
+    trg_odf = row.trg_odf
+
+    # Create the data for the QR code and label
+    data_qr_a = f"{sname}\nip: {sip}\nPort: {sport}"
+    data_lab_a = f"-=Source=-\n{sname}\nip: {sip} Port: {sport}"
+    data_qr_b = f"{tname}\nip: {tip}\nPort: {tport}"
+    data_lab_b = f"-=Destination=-\n{tname}\nip: {tip} Port: {tport}"
+
+    # Modify labels if SrcODF and TrgODF are present and non-empty
+    if src_odf != '':
+        data_lab_a += f"\nodf: {src_odf}"
+
+    if trg_odf != '':
+        data_lab_b += f"\nodf: {trg_odf}"
+
+    return data_lab_a, data_lab_b, data_qr_a, data_qr_b
+
+def qr_payloads(row):
     """
-    Place labels on an A4 sheet.
+    The QR payloads on the label of a row.
 
     Args:
-        labels (list): A list of label images.
-        output_filename (str): The filename to save the A4 sheet to.
-    """
-    # A4 sheet dimensions in pixels
-    #a4_width = 2480
-    #a4_height = 3508
-
-    a4_width = round(210 * MM_TO_PIXELS)
-    a4_height = round(297 * MM_TO_PIXELS)
-    # margin from left right edge
-    side_mergin = 4 # mm
-    side_mergin_px = side_mergin * MM_TO_PIXELS 
- 
-
-    # Create a new image for the A4 sheet
-    a4_sheet = Image.new('RGB', (a4_width, a4_height), color = BACK_COLOR)
-    draw = ImageDraw.Draw(a4_sheet)
+        row (CableRow): The row.
 
-    # Open the first label image to get its dimensions
-    label_img = labels[0]
-    label_width, label_height = label_img.size
+    Returns:
+        tuple: (data_qr_a, data_qr_b).
+    """
+    return label_data(row)[2:]
 
-    # Calculate the number of rows and columns for the labels
-    num_cols = 2
-    num_rows = 11
-    
-    # Calculate the spacing between labels
-    cell_width = round((a4_width - side_mergin_px) // num_cols)
-    label_spacing_x = (cell_width - label_width) // 2
-    label_spacing_y = (a4_height - (num_rows * label_height)) // (num_rows + 1)
-    
-    sheet_index = 1
-
-    # Place the labels on the A4 sheet
-    for label_index, label_img in enumerate(labels):
-        # Calculate the position of the label
-        row = (label_index // num_cols) % num_rows
-        col = label_index % num_cols
-        x = round(side_mergin_px // 2 + label_spacing_x + (col * (label_width + label_spacing_x * 2)))
-        y = label_spacing_y + (row * (label_height + label_spacing_y))
-
-        # Create a new A4 sheet if necessary
-        if label_index % (num_cols * num_rows) == 0 and label_index != 0:
-            for i in range(0, num_rows + 1):
-                y_line = label_spacing_y + (i * (label_height + label_spacing_y)) - label_spacing_y // 2
-                draw_dotted_lines(draw, 0, y_line, a4_width, y_line)
-            for i in range(1, num_cols):
-                x_line = side_mergin_px // 2 + label_spacing_x + (i * (label_width + label_spacing_x * 2)) - label_spacing_x 
-                draw_dotted_lines(draw, x_line, 0, x_line, a4_height)
-
-            a4_sheet.save(f'{output_filename}_{sheet_index}.png')
-            sheet_index += 1
-            a4_sheet = Image.new('RGB', (a4_width, a4_height), color=(255, 255, 255))
-            draw = ImageDraw.Draw(a4_sheet)
-
-        a4_sheet.paste(label_img, (x, y))
-
-    # Draw the final dotted lines
-    for i in range(0, num_rows + 1):
-        y_line = label_spacing_y + (i * (label_height + label_spacing_y)) - label_spacing_y // 2
-        draw_dotted_lines(draw, 0, y_line, a4_width, y_line)
-    for i in range(0, num_cols + 1):
-        x_line = side_mergin_px // 2 + label_spacing_x + (i * (label_width + label_spacing_x * 2)) - label_spacing_x
-        draw_dotted_lines(draw, x_line, 0, x_line, a4_height)
-
-    a4_sheet.save(f'{output_filename}_{sheet_index}.png', dpi=(PPI, PPI))
-
-def process_csv_file(csv_filename, output_dir):
+def profile_geometry(settings):
     """
-    Process a CSV file and generate labels.
+    Derive the pixel geometry of a render profile and check that the parts of the flag fit into it.
 
     Args:
-        csv_filename (str): The filename of the CSV file.
-        output_dir (str): The directory to save the generated labels.
-    """
-    labels = []
-    
-    # Detect the encoding of the file dynamically
-    encoding = detect_file_encoding(csv_filename)
-    print(f"Detected encoding: {encoding}")
-    
-    with open(csv_filename, 'r', encoding=encoding) as csv_file:
-        reader = csv.DictReader(csv_file, delimiter=';', quotechar='|')
-        
-        # Read all rows into a list
-        rows = list(reader)
-
-        # Sort the rows first by 'Division' and then by 'Name'
-        sorted_rows = sorted(rows, key=lambda row: (row['SrcPort']))
-        
-        for row in sorted_rows:
-            # Extract the data from the CSV row
-            sport = row['SrcPort'].strip()
-            sname = row['SrcName'].strip()
-            tname = row['TrgName'].strip()
-            tport = row['TrgPort'].strip()
-            sip = row['SrcIP'].strip()
-            tip = row['TrgIP'].strip()
-            
-            # Check if 'SrcODF' and 'TrgODF' columns exist
-            src_odf = row.get('SrcODF', '').strip()  # Get value or empty string if not present
-            trg_odf = row.get('TrgODF', '').strip()  # Get value or empty string if not present
-            
-            print(sip, sport,tname,tip,tport)
-
-            # Create the data for the QR code and label
-            data_qr_a = f"{sname}\nip: {sip}\nPort: {sport}"
-            data_lab_a = f"-=Source=-\n{sname}\nip: {sip} Port: {sport}"
-            data_qr_b = f"{tname}\nip: {tip}\nPort: {tport}"
-            data_lab_b = f"-=Destination=-\n{tname}\nip: {tip} Port: {tport}"
-
-            # Modify labels if SrcODF and TrgODF are present and non-empty
-            if src_odf != '':
-                data_lab_a += f"\nodf: {src_odf}"
-            
-            if trg_odf != '':
-                data_lab_b += f"\nodf: {trg_odf}"
-
-            # Generate the label image
-            label_img = draw_label(data_lab_a, data_lab_b, data_qr_a, data_qr_b)
-            
-
-            # Add the label image to the list of labels
-            labels.append(label_img)
-
-    # Place the labels on an A4 sheet only if there are labels
-    if labels:
-        os.makedirs(output_dir, exist_ok=True)
-        output_filename = os.path.join(output_dir, "labels_a4_sheet")
-        place_labels_on_a4_sheet(labels, output_filename)
-    else:
-        print("No records found.")
+        settings (dict): The profile settings by lower case name, with mm_to_pixels.
+
+    Returns:
+        dict: The derived settings.
 
-# Example usage
-csv_filename = 'temp.csv'
-output_dir = 'flag_labels'
-process_csv_file(csv_filename, output_dir)
+    Raises:
+        ValueError: If the tail, its rounded corners, the QR codes or the texts do not fit into the flag.
+    """
+    mm_to_pixels = settings['mm_to_pixels']
+    total_label_height = settings['label_height'] * 2
+    tail_length = settings['total_label_width'] - settings['label_width']
+    qr_size = qr_image_size(settings['qr_version'], settings['qr_scale'], settings['qr_quiet_zone'])
+
+    # The shape label_template draws and the places draw_label draws the parts at
+    if tail_length <= 0:
+        raise ValueError(f"total_label_width {settings['total_label_width']} mm must be more than "
+                         f"label_width {settings['label_width']} mm to leave room for the tail")
+    if settings['tail_shift'] + settings['tail_width'] > total_label_height:
+        raise ValueError(f"the tail (tail_shift {settings['tail_shift']} mm and tail_width {settings['tail_width']} mm) "
+                         f"is longer than the {total_label_height} mm high flag")
+    if 2 * settings['corner_radius'] > min(settings['tail_width'], tail_length):
+        raise ValueError(f"corner_radius {settings['corner_radius']} mm does not fit into the "
+                         f"{tail_length} x {settings['tail_width']} mm tail")
+    if round(1 * mm_to_pixels) + qr_size > settings['label_height'] * mm_to_pixels:
+        raise ValueError(f"the QR codes ({qr_size * settings['pixels_to_mm']:.1f} mm with qr_version, qr_scale and "
+                         f"qr_quiet_zone) do not fit into the {settings['label_height']} mm high halves of the flag")
+    if (settings['label_width'] - 4) * mm_to_pixels - qr_size <= 0 or settings['label_height'] <= 2:
+        raise ValueError(f"the QR codes leave no room for the texts of the {settings['label_width']} x "
+                         f"{settings['label_height']} mm halves of the flag")
+    return {'total_label_height': total_label_height, 'corner_radius_px': settings['corner_radius'] * mm_to_pixels,
+            'total_label_width_px': settings['total_label_width'] * mm_to_pixels,
+            'total_label_height_px': total_label_height * mm_to_pixels}
+
+# The flag labels for labels_common, the default profile is made of the constants above. Sheets after
+# the first one of a run are white and the last sheet records the PPI.
+FLAG_LABELS = LabelKind(
+    name='Flag_labels_Cable_gen', row_type=CableRow, columns=CSV_COLUMNS, optional_columns=OPTIONAL_COLUMNS, strip_values=True,
+    row_sort_key=row_sort_key, label_data=label_data, qr_payloads=qr_payloads,
+    draw_label=draw_label, label_fields=printer_label_fields,
+    sheet=SheetStyle(num_cols=2, num_rows=11, dash_length=5, gap_length=5, outer_lines_every_sheet=False,
+                     later_sheet_color=(255, 255, 255), last_sheet_dpi=True),
+    profile_settings=PROFILE_SETTINGS, zero_settings=PROFILE_ZERO_SETTINGS, profile_geometry=profile_geometry,
+    default_profile=labels_common.build_render_profile('default', {setting.lower(): globals()[setting] for setting in PROFILE_SETTINGS},
+                                                       profile_geometry),
+    caches=(('label_template', label_template), ('flipped_qr', generate_flipped_qr_image), ('rotated_text', rotated_text_line)))
+
+def process_csv_file(csv_filename, output_dir, memmap_dir=None, verify=False, resume=False, metrics_file=METRICS_FILE, profile=None):
+    """Process a CSV file and generate flag labels, see labels_common.process_csv_file."""
+    return labels_common.process_csv_file(FLAG_LABELS, csv_filename, output_dir, memmap_dir, verify, resume, metrics_file, profile)
+
+def process_csv_file_sharded(csv_filename, output_dir, workers=SHARD_WORKERS, queue_dir=None, memmap_dir=None, profile=None):
+    """Process a CSV file with several worker processes, see labels_common.process_csv_file_sharded."""
+    return labels_common.process_csv_file_sharded(FLAG_LABELS, csv_filename, output_dir, workers, queue_dir, memmap_dir, profile)
+
+def shard_csv_file(csv_filename, queue_dir, sheets_per_chunk=labels_common.SHARD_SHEETS, profile=None):
+    """Split an input file into chunks of a work queue, see labels_common.shard_csv_file."""
+    return labels_common.shard_csv_file(FLAG_LABELS, csv_filename, queue_dir, sheets_per_chunk, profile)
+
+def run_shard_worker(queue_dir, memmap_dir=None):
+    """Render chunks from a work queue, see labels_common.run_shard_worker."""
+    return labels_common.run_shard_worker(FLAG_LABELS, queue_dir, memmap_dir)
+
+def merge_shards(queue_dir, output_dir):
+    """Move the sheets of a finished sharded run into the output directory, see labels_common.merge_shards."""
+    return labels_common.merge_shards(queue_dir, output_dir)
+
+def verify_sheets(csv_filename, output_dir, workers=VERIFY_WORKERS, profile=None):
+    """Scan the QR codes of saved sheets, see labels_common.verify_sheets."""
+    return labels_common.verify_sheets(FLAG_LABELS, csv_filename, output_dir, workers, profile)
+
+def preview_csv_file(csv_filename, output_dir, ppi=PREVIEW_PPI, max_sheets=None, profile=None):
+    """Render low resolution preview sheets, see labels_common.preview_csv_file."""
+    return labels_common.preview_csv_file(FLAG_LABELS, csv_filename, output_dir, ppi, max_sheets, profile)
+
+def dry_run_csv_file(csv_filename, profile=None):
+    """Check an input file without rendering it, see labels_common.dry_run_csv_file."""
+    return labels_common.dry_run_csv_file(FLAG_LABELS, csv_filename, profile)
+
+def print_csv_file(csv_filename, target, language='zpl', metrics_file=METRICS_FILE, profile=None):
+    """Send the labels to a label printer, see labels_common.print_csv_file."""
+    return labels_common.print_csv_file(FLAG_LABELS, csv_filename, target, language, metrics_file, profile)
+
+def load_render_profiles(profiles_filename):
+    """Read the render profiles of a TOML file, see labels_common.load_render_profiles."""
+    return labels_common.load_render_profiles(FLAG_LABELS, profiles_filename)
+
+def cached_functions():
+    """The LRU cached functions whose hit rates are part of the run metrics."""
+    return labels_common.cached_functions(FLAG_LABELS)
+
+# Example usage, the guard keeps worker processes from running it again
+if __name__ == '__main__':
+    csv_filename = 'temp.csv'
+    output_dir = 'flag_labels'
+    process_csv_file(csv_filename, output_dir)
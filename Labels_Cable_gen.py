@@ -1,16 +1,14 @@
-import chardet
-from io import BytesIO
-import csv
-import os
-import pyqrcode
-from PIL import Image, ImageDraw, ImageFont, ImageColor
-
-# Define conversion factor (1 mm = 11.81 pixels at 300 DPI)
+from collections import namedtuple
+from functools import lru_cache
+from PIL import Image, ImageDraw
+import labels_common
+from labels_common import (PREVIEW_PPI, METRICS_FILE, VERIFY_WORKERS, SHARD_WORKERS, PrintField,
+                           SheetStyle, LabelKind, convert_color, draw_rounded_rectangle_color, fit_label_font,
+                           label_qr_image, natural_sort_key, port_sort_key, qr_image_size, timed_stage)
+
+
+# Resolution in pixels per inch (1 mm = 11.81 pixels at 300 PPI)
 PPI = 300
-#inch = 25.4 mm
-#MM_TO_PIXELS = 11.81
-MM_TO_PIXELS = PPI / 25.4
-PIXELS_TO_MM = 25.4 / PPI
 
 BACK_COLOR = (230,230,230)
 LABEL_COLOR = 'yellow'
@@ -22,351 +20,322 @@ LINE_WIDTH = 1
 MIDDLE_PART_WIDTH = 4
 # A4 Left Right side mergin. 
 SIDE_MERGIN = 4 # mm
+# Label corner radius in mm, 0 for square corners
+CORNER_RADIUS = 1.7
+
+# QR code settings
+#Low (L): Recovers 7% of data. Medium (M): Recovers 15% of data. Quartile (Q): Recovers 25% of data. High (H): Recovers 30% of data.
+QR_VERSION = 8
+QR_SCALE = 3
+QR_QUIET_ZONE = 5
+QR_ERROR = 'M'
+
+# Label text font, the size is reduced to fit the text into the label
+#FONT_TYPE = "arial.ttf"
+FONT_TYPE = "consolab.ttf"
+FONT_SIZE = 29
+
+# CSV columns used for a label, SrcODF, TrgODF and Copies may be missing
+CSV_COLUMNS = ('SrcName', 'SrcIP', 'SrcPort', 'TrgName', 'TrgIP', 'TrgPort', 'SrcODF', 'TrgODF', 'Copies')
+OPTIONAL_COLUMNS = ('SrcODF', 'TrgODF', 'Copies')
+
+# Columns to group the rows by before the port order, e.g. ('SrcName', 'SrcODF')
+SORT_GROUP_BY = ()
+
+# Render profiles: the constants a profile may set (TOML keys are their lower case names) and the ones
+# that may be 0. Settings missing in a profile keep the values above.
+PROFILE_SETTINGS = ('PPI', 'BACK_COLOR', 'LABEL_COLOR', 'LABEL_WIDTH', 'LABEL_HEIGHT', 'LINE_WIDTH', 'CORNER_RADIUS', 'MIDDLE_PART_WIDTH',
+                    'SIDE_MERGIN', 'QR_VERSION', 'QR_SCALE', 'QR_QUIET_ZONE', 'QR_ERROR', 'FONT_TYPE', 'FONT_SIZE')
+PROFILE_ZERO_SETTINGS = ('CORNER_RADIUS', 'MIDDLE_PART_WIDTH', 'SIDE_MERGIN', 'QR_QUIET_ZONE')
+
+# Compact row record holding only the label columns (namedtuple has empty __slots__)
+CableRow = namedtuple('CableRow', ['sname', 'sip', 'sport', 'tname', 'tip', 'tport', 'src_odf', 'trg_odf', 'copies'])
+
+def row_sort_key(row):
+    """
+    Sort key of a row: the SORT_GROUP_BY columns, then the natural SrcPort order.
 
+    Args:
+        row (CableRow): The row.
 
-TOTAL_LABEL_WIDTH = LABEL_WIDTH * 2
-TOTAL_LABEL_HEIGHT = LABEL_HEIGHT
-
-TOTAL_LABEL_WIDTH_PX = TOTAL_LABEL_WIDTH * MM_TO_PIXELS
-TOTAL_LABEL_HEIGHT_PX = TOTAL_LABEL_HEIGHT * MM_TO_PIXELS
-
-def convert_color(color):
-    if isinstance(color, str):
-        return ImageColor.getrgb(color)  # Convert color name to RGB tuple
-    return color  # If already an RGB tuple, return as is
+    Returns:
+        tuple: The precomputed sort key.
+    """
+    groups = tuple(natural_sort_key(row[CSV_COLUMNS.index(column)]) for column in SORT_GROUP_BY)
+    return groups + (port_sort_key(row.sport),)
 
-def detect_file_encoding(csv_filename):
+@lru_cache(maxsize=None)
+@timed_stage('shape_seconds')
+def label_template(profile):
     """
-    Detect the encoding of a file using chardet.
-    
+    Draw the blank label of a render profile once: both rounded halves and the middle line.
+
     Args:
-        csv_filename (str): The path to the CSV file.
-    
+        profile (RenderProfile): The render profile.
+
     Returns:
-        str: The detected encoding.
+        Image: The blank label, copied for every label drawn with the profile.
     """
-    with open(csv_filename, 'rb') as file:
-        raw_data = file.read()
-        result = chardet.detect(raw_data)
-        return result['encoding']
-
-def draw_rounded_rectangle_color(draw, xy, radius, fill_color, stroke_color, width=1):
-    # Extract coordinates from the xy tuple
-    x1, y1, x2, y2 = xy
-    
-    # Draw the filled rounded rectangle
-    # Draw the main body of the rectangle with the fill color
-    draw.rectangle([x1 + radius, y1, x2 - radius, y2], fill=fill_color)  # Fill the central part
-    draw.rectangle([x1, y1 + radius, x2, y2 - radius], fill=fill_color)  # Fill the sides
-
-    # Draw the rounded corners with the fill color
-    draw.pieslice([x1, y1, x1 + 2 * radius, y1 + 2 * radius], start=180, end=270, fill=fill_color)
-    draw.pieslice([x2 - 2 * radius, y1, x2, y1 + 2 * radius], start=270, end=360, fill=fill_color)
-    draw.pieslice([x1, y2 - 2 * radius, x1 + 2 * radius, y2], start=90, end=180, fill=fill_color)
-    draw.pieslice([x2 - 2 * radius, y2 - 2 * radius, x2, y2], start=0, end=90, fill=fill_color)
-    
-    # Now draw the stroke (outline) over the filled area
-    draw.line([(x1 + radius, y1), (x2 - radius, y1)], fill=stroke_color, width=width)
-    draw.line([(x1 + radius, y2), (x2 - radius, y2)], fill=stroke_color, width=width)
-    draw.line([(x1, y1 + radius), (x1, y2 - radius)], fill=stroke_color, width=width)
-    draw.line([(x2, y1 + radius), (x2, y2 - radius)], fill=stroke_color, width=width)
-    draw.arc([x1, y1, x1 + 2 * radius, y1 + 2 * radius], start=180, end=270, fill=stroke_color, width=width)
-    draw.arc([x2 - 2 * radius, y1, x2, y1 + 2 * radius], start=270, end=360, fill=stroke_color, width=width)
-    draw.arc([x1, y2 - 2 * radius, x1 + 2 * radius, y2], start=90, end=180, fill=stroke_color, width=width)
-    draw.arc([x2 - 2 * radius, y2 - 2 * radius, x2, y2], start=0, end=90, fill=stroke_color, width=width)
-
-def draw_rounded_rectangle(draw, xy, radius, color, width=1):
-    # Convert each element of xy to mm
-    x1, y1, x2, y2 = xy
-    draw.line([(x1 + radius, y1), (x2 - radius, y1)], fill=color, width=width)
-    draw.line([(x1 + radius, y2), (x2 - radius, y2)], fill=color, width=width)
-    draw.line([(x1, y1 + radius), (x1, y2 - radius)], fill=color, width=width)
-    draw.line([(x2, y1 + radius), (x2, y2 - radius)], fill=color, width=width)
-    draw.arc([x1, y1, x1 + 2 * radius, y1 + 2 * radius], start=180, end=270, fill=color, width=width)
-    draw.arc([x2 - 2 * radius, y1, x2, y1 + 2 * radius], start=270, end=360, fill=color, width=width)
-    draw.arc([x1, y2 - 2 * radius, x1 + 2 * radius, y2], start=90, end=180, fill=color, width=width)
-    draw.arc([x2 - 2 * radius, y2 - 2 * radius, x2, y2], start=0, end=90, fill=color, width=width)
-
-
-def generate_qr_code_label(data_qr_left, data_qr_right, data_lab_left, data_lab_right):
+    mm_to_pixels = profile.mm_to_pixels
+    lb_fill_color = convert_color(profile.label_color)
+
+    # Create a blank white image
+    img_base = Image.new("RGBA", (int(profile.total_label_width_px), int(profile.total_label_height_px)), profile.back_color)
+    draw_base = ImageDraw.Draw(img_base)
+
+    new_img_width = round((profile.label_width - 2 - profile.middle_part_width) * mm_to_pixels)
+    new_img_height = round(profile.label_height * mm_to_pixels) - 1
+
+    # Both halves are the same blank rounded rectangle
+    half_img = Image.new('RGBA', (new_img_width, new_img_height), color = profile.back_color)
+    draw_rounded_rectangle_color(ImageDraw.Draw(half_img), (0, 0, new_img_width - 1, new_img_height - 1), profile.corner_radius_px, lb_fill_color, (0, 0, 0) ,width = profile.line_width)
+
+    for half_x in label_half_offsets(profile):
+        img_base.paste(half_img, (half_x, 0))
+
+    draw_base.line([(profile.total_label_width_px/2, 0), (profile.total_label_width_px/2, new_img_height)], fill=(0, 0, 0), width = profile.line_width)
+    return img_base
+
+def label_half_offsets(profile):
+    """The x offsets in pixels of the source and destination halves of a label."""
+    mm_to_pixels = profile.mm_to_pixels
+    return round(1 * mm_to_pixels), round((profile.label_width + 1 + profile.middle_part_width) * mm_to_pixels)
+
+def generate_qr_code_label(profile, data_qr_left, data_qr_right, data_lab_left, data_lab_right):
     """
     Generate a QR code and create the label image without saving intermediate images to disk.
+
+    The QR codes and texts are drawn on a copy of the profile's label_template.
     
     Args:
-        data_qr (str): The data to encode in the QR code.
-        data_lab (str): The data to display as a label.
+        profile (RenderProfile): The render profile.
+        data_qr_left (str): The data of the source QR code.
+        data_qr_right (str): The data of the destination QR code.
+        data_lab_left (str): The source label text.
+        data_lab_right (str): The destination label text.
     
     Returns:
         Image: The generated label image.
     """
+    mm_to_pixels = profile.mm_to_pixels
+    Shift = round(1 * mm_to_pixels)
+    lb_fill_color = convert_color(profile.label_color)
     
-    # Calculate the font size based on the image height
-    font_size = 29
-    font_type = "arial.ttf"
-    font_type = "consolab.ttf"
-    font = ImageFont.truetype(font_type, font_size)    
-    
-    #Low (L): Recovers 7% of data. Medium (M): Recovers 15% of data. Quartile (Q): Recovers 25% of data. High (H): Recovers 30% of data.
-    version = 8
-    scale = 3
-    quiet_zone = 5
-    Shift = round(1 * MM_TO_PIXELS)
-    lb_fill_color = convert_color(LABEL_COLOR)
-    
-    # Create a QR code with UTF-8 encoding
-    qr_left = pyqrcode.create(data_qr_left, encoding='utf-8', version=version, error='M')
-    qr_right = pyqrcode.create(data_qr_right, encoding='utf-8', version=version, error='M')
-    
-
-    # Generate the QR code as PNG and save to a BytesIO object
-    qr_png_left = BytesIO()
-    qr_png_right = BytesIO()
-    qr_left.png(qr_png_left, scale=scale, quiet_zone=quiet_zone, background = lb_fill_color)
-    qr_right.png(qr_png_right, scale=scale, quiet_zone=quiet_zone, background = lb_fill_color)
-    qr_png_left.seek(0)  # Reset the pointer to the beginning of the file-like object
-    qr_png_right.seek(0)  # Reset the pointer to the beginning of the file-like object
-
-    # Convert the PNG from BytesIO to a PIL Image
-    qr_img_a = Image.open(qr_png_left)
-    qr_img_b = Image.open(qr_png_right)
+    # Create the QR codes, cached by payload
+    qr_img_a = label_qr_image(profile, data_qr_left, lb_fill_color)
+    qr_img_b = label_qr_image(profile, data_qr_right, lb_fill_color)
 
     qr_img_width, qr_img_height = qr_img_a.size
 
+    img_base = label_template(profile).copy()
+    draw_base = ImageDraw.Draw(img_base)
 
-    # Create a blank white image
-    img_base = Image.new("RGBA", (int(TOTAL_LABEL_WIDTH_PX), int(TOTAL_LABEL_HEIGHT_PX)), BACK_COLOR)
-    draw_base = ImageDraw.Draw(img_base)   
-    
-    new_img_width = round((LABEL_WIDTH - 2 - MIDDLE_PART_WIDTH) * MM_TO_PIXELS)
-    new_img_height = round(LABEL_HEIGHT * MM_TO_PIXELS) - 1
-
-    a_img = Image.new('RGBA', (new_img_width, new_img_height), color = BACK_COLOR)
-    b_img = Image.new('RGBA', (new_img_width, new_img_height), color = BACK_COLOR)    
-
-    # Create a drawing context
-    a_draw = ImageDraw.Draw(a_img)
-    b_draw = ImageDraw.Draw(b_img)
-
-   
+    new_img_width = round((profile.label_width - 2 - profile.middle_part_width) * mm_to_pixels)
+    new_img_height = round(profile.label_height * mm_to_pixels) - 1
 
     # Split both sets of data into lines
     lines_a = data_lab_left.split("\n")
     lines_b = data_lab_right.split("\n")
 
-    # Combine both sets of lines
-    all_lines = lines_a + lines_b
-
-    # Split the data into lines
-    lines = data_lab_left.split("\n")
-  
-    # Calculate line height
-    line_height = a_draw.textbbox((0, 0), "Ay", font=font)[3]  # Use textbbox to get height
-    
-    # Calculate total text height and maximum text width
-    total_text_height = len(lines) * line_height
-    total_text_width = max(a_draw.textbbox((0, 0), line, font=font)[2] for line in all_lines)
-    
     # Define maximum allowed dimensions
-    max_width = new_img_width  - (qr_img_width + 2 * MM_TO_PIXELS + Shift)
-    max_height = new_img_height - 2 * MM_TO_PIXELS    
-    
-    
-    # Calculate scale factor to fit text within the rectangle
-    scale_factor = min(max_width / total_text_width, max_height / total_text_height)
-
-    # If scaling is needed, adjust font size
-    if scale_factor != 1:
-        adjusted_font_size = int(font_size * scale_factor)
-        font = ImageFont.truetype(font_type, adjusted_font_size)
-        line_height = a_draw.textbbox((0, 0), "Ay", font=font)[3]  # Use textbbox to get height
+    max_width = new_img_width  - (qr_img_width + 2 * mm_to_pixels + Shift)
+    max_height = new_img_height - 2 * mm_to_pixels    
 
-    draw_rounded_rectangle_color(a_draw, (0, 0, new_img_width - 1, new_img_height - 1), 20, lb_fill_color, (0, 0, 0) ,width = LINE_WIDTH)
-    draw_rounded_rectangle_color(b_draw, (0, 0, new_img_width - 1, new_img_height - 1), 20, lb_fill_color, (0, 0, 0) ,width = LINE_WIDTH)
-    
+    # Fit the widest line of both sides, the height is taken from the source side
+    font, line_height = fit_label_font(profile, lines_a + lines_b, len(lines_a), max_width, max_height)
 
-    # Add the QR code to the new image
-    a_img.paste(qr_img_a, (Shift, Shift))
-    b_img.paste(qr_img_b, (Shift, Shift))
+    for half_x, qr_img, lines in zip(label_half_offsets(profile), (qr_img_a, qr_img_b), (lines_a, lines_b)):
+        # Add the QR code to the half
+        img_base.paste(qr_img, (half_x + Shift, Shift))
 
-    # Draw each line of text
-    for i, line in enumerate(lines_a):
-        a_draw.text((qr_img_width + Shift, i * line_height + 1 * MM_TO_PIXELS), line, font=font, fill=(0, 0, 0))
+        # Draw each line of text
+        with timed_stage('text_seconds'):
+            for i, line in enumerate(lines):
+                draw_base.text((half_x + qr_img_width + Shift, i * line_height + 1 * mm_to_pixels), line, font=font, fill=(0, 0, 0))
+    return img_base
 
-    # Draw each line of text
-    for i, line in enumerate(lines_b):
-        b_draw.text((qr_img_width + Shift, i * line_height + 1 * MM_TO_PIXELS), line, font=font, fill=(0, 0, 0))
+def printer_label_fields(profile, data_qr_left, data_qr_right, data_lab_left, data_lab_right):
+    """
+    Lay out a label as printer fields, at the places generate_qr_code_label draws them.
 
-    img_base.paste(a_img, (round(1 * MM_TO_PIXELS), 0))
-    img_base.paste(b_img, (round((LABEL_WIDTH + 1 + MIDDLE_PART_WIDTH) * MM_TO_PIXELS), 0))   
+    Args:
+        profile (RenderProfile): The render profile.
+        data_qr_left (str): The data of the source QR code.
+        data_qr_right (str): The data of the destination QR code.
+        data_lab_left (str): The source label text.
+        data_lab_right (str): The destination label text.
 
-    # Add a rounded border
-    border_padding = 1
-    draw_base.line([(TOTAL_LABEL_WIDTH_PX/2, 0), (TOTAL_LABEL_WIDTH_PX/2, new_img_height)], fill=(0, 0, 0), width = LINE_WIDTH)
-    return img_base
+    Returns:
+        tuple: (width, height, fields), the label size in dots and its PrintField entries.
+    """
+    mm_to_pixels = profile.mm_to_pixels
+    Shift = round(1 * mm_to_pixels)
+    qr_img_width = qr_image_size(profile.qr_version, profile.qr_scale, profile.qr_quiet_zone)
+    quiet_zone_px = round(profile.qr_quiet_zone * profile.qr_scale)
+    new_img_width = round((profile.label_width - 2 - profile.middle_part_width) * mm_to_pixels)
+    new_img_height = round(profile.label_height * mm_to_pixels) - 1
 
-def draw_dotted_lines(draw, start_x, start_y, end_x, end_y, dash_length=5, gap_length=5):
+    lines_a = data_lab_left.split("\n")
+    lines_b = data_lab_right.split("\n")
+    max_width = new_img_width  - (qr_img_width + 2 * mm_to_pixels + Shift)
+    max_height = new_img_height - 2 * mm_to_pixels
+    font, line_height = fit_label_font(profile, lines_a + lines_b, len(lines_a), max_width, max_height)
+
+    fields = []
+    for half_x, data_qr, lines in zip(label_half_offsets(profile), (data_qr_left, data_qr_right), (lines_a, lines_b)):
+        # Printer QR codes have no quiet zone, the symbol starts after it
+        fields.append(PrintField('qr', half_x + Shift + quiet_zone_px, Shift + quiet_zone_px, profile.qr_scale, data_qr, False))
+        for i, line in enumerate(lines):
+            fields.append(PrintField('text', half_x + qr_img_width + Shift, i * line_height + 1 * mm_to_pixels, font.size, line, False))
+    return int(profile.total_label_width_px), int(profile.total_label_height_px), fields
+
+def label_data(row):
     """
-    Draw dotted lines between two points.
+    Build the QR payloads and label texts of a row.
 
     Args:
-        draw (ImageDraw): The drawing context.
-        start_x (int): The starting x-coordinate.
-        start_y (int): The starting y-coordinate.
-        end_x (int): The ending x-coordinate.
-        end_y (int): The ending y-coordinate.
-        dash_length (int): The length of each dash.
-        gap_length (int): The length of the gap between dashes.
+        row (CableRow): The row.
+
+    Returns:
+        tuple: (data_qr_left, data_qr_right, data_lab_left, data_lab_right).
     """
-    total_length = ((end_x - start_x) ** 2 + (end_y - start_y) ** 2) ** 0.5
-    dashes = int(total_length // (dash_length + gap_length))
-    
-    for i in range(dashes):
-        start = i * (dash_length + gap_length)
-        end = start + dash_length
-        x = start_x + (end_x - start_x) * (start / total_length)
-        y = start_y + (end_y - start_y) * (start / total_length)
-        x_end = start_x + (end_x - start_x) * (end / total_length)
-        y_end = start_y + (end_y - start_y) * (end / total_length)
-        draw.line([(x, y), (x_end, y_end)], fill=(0, 0, 0), width=1)
-
-def place_labels_on_a4_sheet(labels, output_filename):
+    # Extract the data from the CSV row
+    sport = row.sport
+    sname = row.sname
+    tname = row.tname
+    tport = row.tport
+    sip = row.sip
+    tip = row.tip
+
+    # SrcODF and TrgODF are empty strings if the columns are not present
+    src_odf = row.src_odf
+    trg_odf = row.trg_odf
+
+    # Create the data for the QR code and label
+    data_qr_left = f"{sname}\r\nIp: {sip}\r\nPort: {sport}"
+    data_lab_left = f"-=Source=-\n{sname}\nIp: {sip}\nPort: {sport}"
+    data_qr_right = f"{tname}\r\nIp: {tip}\r\nPort: {tport}"
+    data_lab_right = f"-=Destination=-\n{tname}\nIp: {tip}\nPort: {tport}"
+
+    # Modify labels if SrcODF and TrgODF are present and non-empty
+    if src_odf != '':
+        data_lab_left += f"\nODF: {src_odf}"
+
+    if trg_odf != '':
+        data_lab_right += f"\nODF: {trg_odf}"
+
+    return data_qr_left, data_qr_right, data_lab_left, data_lab_right
+
+def qr_payloads(row):
     """
-    Place labels on an A4 sheet.
+    The QR payloads on the label of a row.
 
     Args:
-        labels (list): A list of label images.
-        output_filename (str): The filename to save the A4 sheet to.
-    """
-    # A4 sheet dimensions in pixels
-    #a4_width = 2480
-    #a4_height = 3508
-    a4_width = round(210 * MM_TO_PIXELS)
-    a4_height = round(297 * MM_TO_PIXELS)
-    
-    # margin from left right edge
-    side_mergin_px = SIDE_MERGIN * MM_TO_PIXELS
-    
-    # Create a new image for the A4 sheet
-    a4_sheet = Image.new('RGB', (a4_width, a4_height), color = BACK_COLOR)
-    draw = ImageDraw.Draw(a4_sheet)
+        row (CableRow): The row.
 
-    # Open the first label image to get its dimensions
-    label_img = labels[0]
-    label_width, label_height = label_img.size
+    Returns:
+        tuple: (data_qr_left, data_qr_right).
+    """
+    return label_data(row)[:2]
 
-    # Calculate the number of rows and columns for the labels
-    num_cols = 2
-    num_rows = 15 # 12
-    
-    # Calculate the spacing between labels
-    cell_width = round((a4_width - side_mergin_px) // num_cols)
-    label_spacing_x = (cell_width - label_width) // 2
-    label_spacing_y = (a4_height - (num_rows * label_height)) // (num_rows + 1)
-    
-    sheet_index = 1
-
-    # Place the labels on the A4 sheet
-    for label_index, label_img in enumerate(labels):
-        # Calculate the position of the label
-        row = (label_index // num_cols) % num_rows
-        col = label_index % num_cols
-        x = round(side_mergin_px // 2 + label_spacing_x + (col * (label_width + label_spacing_x * 2)))
-        y = label_spacing_y + (row * (label_height + label_spacing_y))
-
-        # Create a new A4 sheet if necessary
-        if label_index % (num_cols * num_rows) == 0 and label_index != 0:
-            for i in range(0, num_rows + 1):
-                y_line = label_spacing_y + (i * (label_height + label_spacing_y)) - label_spacing_y // 2
-                draw_dotted_lines(draw, 0, y_line, a4_width, y_line)
-            for i in range(1, num_cols):
-                x_line = side_mergin_px // 2 + label_spacing_x + (i * (label_width + label_spacing_x * 2)) - label_spacing_x 
-                draw_dotted_lines(draw, x_line, 0, x_line, a4_height)
-
-            a4_sheet.save(f'{output_filename}_{sheet_index}.png')
-            sheet_index += 1
-            a4_sheet = Image.new('RGB', (a4_width, a4_height), color = BACK_COLOR)
-            draw = ImageDraw.Draw(a4_sheet)
-
-        a4_sheet.paste(label_img, (x, y))
-
-    # Draw the final dotted lines
-    for i in range(0, num_rows + 1):
-        y_line = label_spacing_y + (i * (label_height + label_spacing_y)) - label_spacing_y // 2
-        draw_dotted_lines(draw, 0, y_line, a4_width, y_line)
-    for i in range(0, num_cols + 1):
-        x_line = side_mergin_px // 2 + label_spacing_x + (i * (label_width + label_spacing_x * 2)) - label_spacing_x
-        draw_dotted_lines(draw, x_line, 0, x_line, a4_height)
-
-    a4_sheet.save(f'{output_filename}_{sheet_index}.png')
-
-def process_csv_file(csv_filename, output_dir):
+def profile_geometry(settings):
     """
-    Process a CSV file and generate labels.
+    Derive the pixel geometry of a render profile and check that the parts of the label fit into it.
 
     Args:
-        csv_filename (str): The filename of the CSV file.
-        output_dir (str): The directory to save the generated labels.
+        settings (dict): The profile settings by lower case name, with mm_to_pixels.
+
+    Returns:
+        dict: The derived settings.
+
+    Raises:
+        ValueError: If the halves, their rounded corners, the QR codes or the texts do not fit into the label.
     """
-    labels = []
-    
-    # Detect the encoding of the file dynamically
-    encoding = detect_file_encoding(csv_filename)
-    print(f"Detected encoding: {encoding}")
-    
-    with open(csv_filename, 'r', encoding=encoding) as csv_file:
-        reader = csv.DictReader(csv_file, delimiter=';', quotechar='|')
-        
-        # Read all rows into a list
-        rows = list(reader)
-
-        # Sort the rows first by 'Division' and then by 'Name'
-        sorted_rows = sorted(rows, key=lambda row: (row['SrcPort']))
-        
-        #for row in sorted_rows:
-        for row in rows:
-            # Extract the data from the CSV row
-            sport = row['SrcPort']
-            sname = row['SrcName']
-            tname = row['TrgName']
-            tport = row['TrgPort']
-            sip = row['SrcIP']
-            tip = row['TrgIP']
-            
-            # Check if 'SrcODF' and 'TrgODF' columns exist
-            src_odf = row.get('SrcODF', '')  # Get value or empty string if not present
-            trg_odf = row.get('TrgODF', '')  # Get value or empty string if not present
-            
-            print(sip, sport,tname,tip,tport)
-
-            # Create the data for the QR code and label
-            data_qr_left = f"{sname}\r\nIp: {sip}\r\nPort: {sport}"
-            data_lab_left = f"-=Source=-\n{sname}\nIp: {sip}\nPort: {sport}"
-            data_qr_right = f"{tname}\r\nIp: {tip}\r\nPort: {tport}"
-            data_lab_right = f"-=Destination=-\n{tname}\nIp: {tip}\nPort: {tport}"
-
-            # Modify labels if SrcODF and TrgODF are present and non-empty
-            if src_odf != '':
-                data_lab_left += f"\nODF: {src_odf}"
-            
-            if trg_odf != '':
-                data_lab_right += f"\nODF: {trg_odf}"
-
-            # Generate the label image
-            label_img = generate_qr_code_label(data_qr_left, data_qr_right, data_lab_left, data_lab_right)
-
-            # Add the label image to the list of labels
-            labels.append(label_img)
-
-    # Place the labels on an A4 sheet only if there are labels
-    if labels:
-        os.makedirs(output_dir, exist_ok=True)
-        output_filename = os.path.join(output_dir, "labels_a4_sheet")
-        place_labels_on_a4_sheet(labels, output_filename)
-    else:
-        print("No records found.")
-
-# Example usage
-csv_filename = 'temp.csv'
-
-output_dir = 'cable_labels'
-process_csv_file(csv_filename, output_dir)
+    mm_to_pixels = settings['mm_to_pixels']
+    total_label_width = settings['label_width'] * 2
+    total_label_height = settings['label_height']
+    corner_radius_px = round(settings['corner_radius'] * mm_to_pixels)
+    qr_size = qr_image_size(settings['qr_version'], settings['qr_scale'], settings['qr_quiet_zone'])
+
+    # The halves label_template draws and the places generate_qr_code_label draws the parts at
+    shift = round(1 * mm_to_pixels)
+    half_width = round((settings['label_width'] - 2 - settings['middle_part_width']) * mm_to_pixels)
+    half_height = round(settings['label_height'] * mm_to_pixels) - 1
+    if half_width <= 0 or half_height <= 0:
+        raise ValueError(f"label_width {settings['label_width']} mm leaves no room for the halves of the label "
+                         f"with middle_part_width {settings['middle_part_width']} mm")
+    if 2 * corner_radius_px > min(half_width, half_height) - 1:
+        raise ValueError(f"corner_radius {settings['corner_radius']} mm does not fit into the halves of the "
+                         f"{total_label_width} x {total_label_height} mm label")
+    if shift + qr_size > min(half_width, half_height):
+        raise ValueError(f"the QR codes ({qr_size * settings['pixels_to_mm']:.1f} mm with qr_version, qr_scale and "
+                         f"qr_quiet_zone) do not fit into the halves of the {total_label_width} x {total_label_height} mm label")
+    if half_width - (qr_size + 2 * mm_to_pixels + shift) <= 0 or half_height - 2 * mm_to_pixels <= 0:
+        raise ValueError(f"the QR codes leave no room for the texts of the {total_label_width} x {total_label_height} mm label")
+    return {'corner_radius_px': corner_radius_px,
+            'total_label_width': total_label_width, 'total_label_height': total_label_height,
+            'total_label_width_px': total_label_width * mm_to_pixels,
+            'total_label_height_px': total_label_height * mm_to_pixels}
+
+# The cable labels for labels_common, the default profile is made of the constants above
+CABLE_LABELS = LabelKind(
+    name='Labels_Cable_gen', row_type=CableRow, columns=CSV_COLUMNS, optional_columns=OPTIONAL_COLUMNS, strip_values=False,
+    row_sort_key=row_sort_key, label_data=label_data, qr_payloads=qr_payloads,
+    draw_label=generate_qr_code_label, label_fields=printer_label_fields,
+    sheet=SheetStyle(num_cols=2, num_rows=15, dash_length=5, gap_length=5, outer_lines_every_sheet=False,
+                     later_sheet_color=None, last_sheet_dpi=False),
+    profile_settings=PROFILE_SETTINGS, zero_settings=PROFILE_ZERO_SETTINGS, profile_geometry=profile_geometry,
+    default_profile=labels_common.build_render_profile('default', {setting.lower(): globals()[setting] for setting in PROFILE_SETTINGS},
+                                                       profile_geometry),
+    caches=(('label_template', label_template),))
+
+def process_csv_file(csv_filename, output_dir, memmap_dir=None, verify=False, resume=False, metrics_file=METRICS_FILE, profile=None):
+    """Process a CSV file and generate cable labels, see labels_common.process_csv_file."""
+    return labels_common.process_csv_file(CABLE_LABELS, csv_filename, output_dir, memmap_dir, verify, resume, metrics_file, profile)
+
+def process_csv_file_sharded(csv_filename, output_dir, workers=SHARD_WORKERS, queue_dir=None, memmap_dir=None, profile=None):
+    """Process a CSV file with several worker processes, see labels_common.process_csv_file_sharded."""
+    return labels_common.process_csv_file_sharded(CABLE_LABELS, csv_filename, output_dir, workers, queue_dir, memmap_dir, profile)
+
+def shard_csv_file(csv_filename, queue_dir, sheets_per_chunk=labels_common.SHARD_SHEETS, profile=None):
+    """Split an input file into chunks of a work queue, see labels_common.shard_csv_file."""
+    return labels_common.shard_csv_file(CABLE_LABELS, csv_filename, queue_dir, sheets_per_chunk, profile)
+
+def run_shard_worker(queue_dir, memmap_dir=None):
+    """Render chunks from a work queue, see labels_common.run_shard_worker."""
+    return labels_common.run_shard_worker(CABLE_LABELS, queue_dir, memmap_dir)
+
+def merge_shards(queue_dir, output_dir):
+    """Move the sheets of a finished sharded run into the output directory, see labels_common.merge_shards."""
+    return labels_common.merge_shards(queue_dir, output_dir)
+
+def verify_sheets(csv_filename, output_dir, workers=VERIFY_WORKERS, profile=None):
+    """Scan the QR codes of saved sheets, see labels_common.verify_sheets."""
+    return labels_common.verify_sheets(CABLE_LABELS, csv_filename, output_dir, workers, profile)
+
+def preview_csv_file(csv_filename, output_dir, ppi=PREVIEW_PPI, max_sheets=None, profile=None):
+    """Render low resolution preview sheets, see labels_common.preview_csv_file."""
+    return labels_common.preview_csv_file(CABLE_LABELS, csv_filename, output_dir, ppi, max_sheets, profile)
+
+def dry_run_csv_file(csv_filename, profile=None):
+    """Check an input file without rendering it, see labels_common.dry_run_csv_file."""
+    return labels_common.dry_run_csv_file(CABLE_LABELS, csv_filename, profile)
+
+def print_csv_file(csv_filename, target, language='zpl', metrics_file=METRICS_FILE, profile=None):
+    """Send the labels to a label printer, see labels_common.print_csv_file."""
+    return labels_common.print_csv_file(CABLE_LABELS, csv_filename, target, language, metrics_file, profile)
+
+def load_render_profiles(profiles_filename):
+    """Read the render profiles of a TOML file, see labels_common.load_render_profiles."""
+    return labels_common.load_render_profiles(CABLE_LABELS, profiles_filename)
+
+def cached_functions():
+    """The LRU cached functions whose hit rates are part of the run metrics."""
+    return labels_common.cached_functions(CABLE_LABELS)
+
+# Example usage, the guard keeps worker processes from running it again
+if __name__ == '__main__':
+    csv_filename = 'temp.csv'
+
+    output_dir = 'cable_labels'
+    process_csv_file(csv_filename, output_dir)
@@ -1,15 +1,13 @@
-import chardet
-from io import BytesIO
-import csv
-import os
-import pyqrcode
-from PIL import Image, ImageDraw, ImageFont, ImageColor
-
-# Define conversion factor (1 mm = 11.81 pixels at 300 DPI)
+from collections import namedtuple
+from functools import lru_cache
+from PIL import Image, ImageDraw
+import labels_common
+from labels_common import (PREVIEW_PPI, METRICS_FILE, VERIFY_WORKERS, SHARD_WORKERS, PrintField, SheetStyle, LabelKind,
+                           convert_color, draw_rounded_rectangle_color, fit_label_font, label_qr_image,
+                           qr_image_size, timed_stage)
+
+# Resolution in pixels per inch (1 mm = 11.81 pixels at 300 PPI)
 PPI = 300
-#inch = 25.4 mm
-MM_TO_PIXELS = PPI / 25.4
-PIXELS_TO_MM = 25.4 / PPI
 
 LABEL_COLOR = 'yellow'
 #LABEL_COLOR = 'white'
@@ -19,293 +17,282 @@ LABEL_HEIGHT = 20
 LINE_WIDTH = 1
 # A4 Left Right side mergin. 
 SIDE_MERGIN = 4 # mm
+# Label corner radius in mm, 0 for square corners
+CORNER_RADIUS = 1.7
+
+# QR code settings
+#Low (L): Recovers 7% of data. Medium (M): Recovers 15% of data. Quartile (Q): Recovers 25% of data. High (H): Recovers 30% of data.
+QR_VERSION = 8
+QR_SCALE = 3
+QR_QUIET_ZONE = 5
+QR_ERROR = 'H'
+
+# Label text font, the size is reduced to fit the text into the label
+FONT_TYPE = "arial.ttf"
+#FONT_TYPE = "consolab.ttf"
+FONT_SIZE = 29
+# Text margins in mm
+W_MERGIN = 6
+H_MERGIN = 4
+
+# CSV columns used for a label, Copies may be missing
+CSV_COLUMNS = ('ID', 'Name', 'IP', 'Division', 'City', 'Copies')
+OPTIONAL_COLUMNS = ('Copies',)
+
+# Render profiles: the constants a profile may set (TOML keys are their lower case names) and the ones
+# that may be 0. Settings missing in a profile keep the values above.
+PROFILE_SETTINGS = ('PPI', 'LABEL_COLOR', 'BACK_COLOR', 'LABEL_WIDTH', 'LABEL_HEIGHT', 'LINE_WIDTH', 'CORNER_RADIUS', 'SIDE_MERGIN',
+                    'QR_VERSION', 'QR_SCALE', 'QR_QUIET_ZONE', 'QR_ERROR', 'FONT_TYPE', 'FONT_SIZE', 'W_MERGIN', 'H_MERGIN')
+PROFILE_ZERO_SETTINGS = ('CORNER_RADIUS', 'SIDE_MERGIN', 'QR_QUIET_ZONE', 'W_MERGIN', 'H_MERGIN')
+
+# Compact row record holding only the label columns (namedtuple has empty __slots__)
+DeviceRow = namedtuple('DeviceRow', ['id', 'name', 'ip', 'division', 'city', 'copies'])
+
+def row_sort_key(row):
+    """
+    Sort key of a row: Division, then City, then Name.
 
+    Args:
+        row (DeviceRow): The row.
 
-def convert_color(color):
-    if isinstance(color, str):
-        return ImageColor.getrgb(color)  # Convert color name to RGB tuple
-    return color  # If already an RGB tuple, return as is
+    Returns:
+        tuple: The sort key.
+    """
+    return (row.division, row.city, row.name)
 
-def draw_rounded_rectangle_color(draw, xy, radius, fill_color, stroke_color, width=1):
-    # Extract coordinates from the xy tuple
-    x1, y1, x2, y2 = xy
-    
-    # Draw the filled rounded rectangle
-    # Draw the main body of the rectangle with the fill color
-    draw.rectangle([x1 + radius, y1, x2 - radius, y2], fill=fill_color)  # Fill the central part
-    draw.rectangle([x1, y1 + radius, x2, y2 - radius], fill=fill_color)  # Fill the sides
-
-    # Draw the rounded corners with the fill color
-    draw.pieslice([x1, y1, x1 + 2 * radius, y1 + 2 * radius], start=180, end=270, fill=fill_color)
-    draw.pieslice([x2 - 2 * radius, y1, x2, y1 + 2 * radius], start=270, end=360, fill=fill_color)
-    draw.pieslice([x1, y2 - 2 * radius, x1 + 2 * radius, y2], start=90, end=180, fill=fill_color)
-    draw.pieslice([x2 - 2 * radius, y2 - 2 * radius, x2, y2], start=0, end=90, fill=fill_color)
-    
-    # Now draw the stroke (outline) over the filled area
-    draw.line([(x1 + radius, y1), (x2 - radius, y1)], fill=stroke_color, width=width)
-    draw.line([(x1 + radius, y2), (x2 - radius, y2)], fill=stroke_color, width=width)
-    draw.line([(x1, y1 + radius), (x1, y2 - radius)], fill=stroke_color, width=width)
-    draw.line([(x2, y1 + radius), (x2, y2 - radius)], fill=stroke_color, width=width)
-    draw.arc([x1, y1, x1 + 2 * radius, y1 + 2 * radius], start=180, end=270, fill=stroke_color, width=width)
-    draw.arc([x2 - 2 * radius, y1, x2, y1 + 2 * radius], start=270, end=360, fill=stroke_color, width=width)
-    draw.arc([x1, y2 - 2 * radius, x1 + 2 * radius, y2], start=90, end=180, fill=stroke_color, width=width)
-    draw.arc([x2 - 2 * radius, y2 - 2 * radius, x2, y2], start=0, end=90, fill=stroke_color, width=width)
-
-
-def draw_rounded_rectangle(draw, xy, radius, color, width=1):
-    # Convert each element of xy to mm
-    x1, y1, x2, y2 = xy
-    draw.line([(x1 + radius, y1), (x2 - radius, y1)], fill=color, width=width)
-    draw.line([(x1 + radius, y2), (x2 - radius, y2)], fill=color, width=width)
-    draw.line([(x1, y1 + radius), (x1, y2 - radius)], fill=color, width=width)
-    draw.line([(x2, y1 + radius), (x2, y2 - radius)], fill=color, width=width)
-    draw.arc([x1, y1, x1 + 2 * radius, y1 + 2 * radius], start=180, end=270, fill=color, width=width)
-    draw.arc([x2 - 2 * radius, y1, x2, y1 + 2 * radius], start=270, end=360, fill=color, width=width)
-    draw.arc([x1, y2 - 2 * radius, x1 + 2 * radius, y2], start=90, end=180, fill=color, width=width)
-    draw.arc([x2 - 2 * radius, y2 - 2 * radius, x2, y2], start=0, end=90, fill=color, width=width)
-
-
-def detect_file_encoding(csv_filename):
+@lru_cache(maxsize=None)
+@timed_stage('shape_seconds')
+def label_template(profile):
     """
-    Detect the encoding of a file using chardet.
-    
+    Draw the blank label of a render profile once: the rounded rectangle.
+
     Args:
-        csv_filename (str): The path to the CSV file.
-    
+        profile (RenderProfile): The render profile.
+
     Returns:
-        str: The detected encoding.
+        Image: The blank label, copied for every label drawn with the profile.
     """
-    with open(csv_filename, 'rb') as file:
-        raw_data = file.read()
-        result = chardet.detect(raw_data)
-        return result['encoding']
+    new_img_width = round(profile.label_width * profile.mm_to_pixels)
+    new_img_height = round(profile.label_height * profile.mm_to_pixels)
 
+    new_img = Image.new('RGBA', (new_img_width, new_img_height), color = profile.back_color)
+    # Add a rounded border
+    draw_rounded_rectangle_color(ImageDraw.Draw(new_img), (0, 0, new_img_width - 1, new_img_height - 1), profile.corner_radius_px,
+                                 convert_color(profile.label_color), (0, 0, 0) ,width = profile.line_width)
+    return new_img
 
-def generate_qr_code_label(data_qr, data_lab):
+def generate_qr_code_label(profile, data_qr, data_lab):
     """
     Generate a QR code and create the label image without saving intermediate images to disk.
+
+    The QR code and text are drawn on a copy of the profile's label_template.
     
     Args:
+        profile (RenderProfile): The render profile.
         data_qr (str): The data to encode in the QR code.
         data_lab (str): The data to display as a label.
     
     Returns:
         Image: The generated label image.
     """
-    version = 8
-    scale = 3
-    quiet_zone = 5
-    font_size = 29 # will be calced later
-    font_type = "arial.ttf"
-    #font_type = "consolab.ttf"
-    wMergin = 6
-    hMergin = 4
-    lb_fill_color = convert_color(LABEL_COLOR)
+    mm_to_pixels = profile.mm_to_pixels
+    scale = profile.qr_scale
+    quiet_zone = profile.qr_quiet_zone
+    wMergin = profile.w_mergin
+    hMergin = profile.h_mergin
+    lb_fill_color = convert_color(profile.label_color)
  
-    # Create a QR code with UTF-8 encoding
-    qr = pyqrcode.create(data_qr, encoding='utf-8', version=version)
-
-    # Generate the QR code as PNG and save to a BytesIO object
-    qr_png = BytesIO()
-    qr.png(qr_png, scale=scale, quiet_zone = quiet_zone, background = lb_fill_color)
-    qr_png.seek(0)  # Reset the pointer to the beginning of the file-like object
-
-    # Convert the PNG from BytesIO to a PIL Image
-    qr_img = Image.open(qr_png)
+    # Create the QR code, cached by payload
+    qr_img = label_qr_image(profile, data_qr, lb_fill_color)
     qr_img_width, qr_img_height = qr_img.size
 
     # Create a new image with a larger width
-    new_img_width = round(LABEL_WIDTH * MM_TO_PIXELS)
-    new_img_height = round(LABEL_HEIGHT * MM_TO_PIXELS)
+    new_img_width = round(profile.label_width * mm_to_pixels)
+    new_img_height = round(profile.label_height * mm_to_pixels)
 
-    new_img = Image.new('RGBA', (new_img_width, new_img_height), color = BACK_COLOR)    
+    new_img = label_template(profile).copy()
     # Create a drawing context
     draw = ImageDraw.Draw(new_img)
-    # Add a rounded border
-    draw_rounded_rectangle_color(draw, (0, 0, new_img_width - 1, new_img_height - 1), 20, lb_fill_color, (0, 0, 0) ,width = LINE_WIDTH)
 
     # Add the QR code to the new image
-    new_img.paste(qr_img, (round(1 * MM_TO_PIXELS), (new_img_height - qr_img_height) // 2))
+    new_img.paste(qr_img, (round(1 * mm_to_pixels), (new_img_height - qr_img_height) // 2))
 
     # Split the data into lines
     lines = data_lab.split("\n")
 
-    # Calculate line height
-    font = ImageFont.truetype(font_type, font_size)
-    line_height = draw.textbbox((0, 0), "Ay", font=font)[3]  # Use textbbox to get height
-    
-    # Calculate total text height and maximum text width
-    total_text_height = len(lines) * line_height
-    total_text_width = max(draw.textbbox((0, 0), line, font=font)[2] for line in lines)    
-
     # Define maximum allowed dimensions
-    max_width = new_img_width  - (qr_img_width + scale * quiet_zone + wMergin * MM_TO_PIXELS)
-    max_height = new_img_height - hMergin * MM_TO_PIXELS
+    max_width = new_img_width  - (qr_img_width + scale * quiet_zone + wMergin * mm_to_pixels)
+    max_height = new_img_height - hMergin * mm_to_pixels
 
-
-    # Calculate scale factor to fit text within the rectangle
-    scale_factor = min(max_width / total_text_width, max_height / total_text_height)
-
-    # If scaling is needed, adjust font size
-    if scale_factor != 1:
-        adjusted_font_size = int(font_size * scale_factor)
-        font = ImageFont.truetype(font_type, adjusted_font_size)
-         line_height = draw.textbbox((0, 0), "Ay", font=font)[3]  # Use textbbox to get height
+    # Scale the font to fit text within the rectangle
+    font, line_height = fit_label_font(profile, lines, len(lines), max_width, max_height)
 
     
     # Draw each line of text
-    for i, line in enumerate(lines):
-        draw.text((qr_img_width + scale * quiet_zone + wMergin * MM_TO_PIXELS // 2, i * line_height + hMergin * MM_TO_PIXELS // 2), line, font=font, fill=(0, 0, 0))
+    with timed_stage('text_seconds'):
+        for i, line in enumerate(lines):
+            draw.text((qr_img_width + scale * quiet_zone + wMergin * mm_to_pixels // 2, i * line_height + hMergin * mm_to_pixels // 2), line, font=font, fill=(0, 0, 0))
 
     return new_img
 
-def draw_dotted_lines(draw, start_x, start_y, end_x, end_y, dash_length=5, gap_length=10):
+def printer_label_fields(profile, data_qr, data_lab):
+    """
+    Lay out a label as printer fields, at the places generate_qr_code_label draws them.
+
+    Args:
+        profile (RenderProfile): The render profile.
+        data_qr (str): The data to encode in the QR code.
+        data_lab (str): The data to display as a label.
+
+    Returns:
+        tuple: (width, height, fields), the label size in dots and its PrintField entries.
+    """
+    mm_to_pixels = profile.mm_to_pixels
+    qr_scale = profile.qr_scale
+    qr_img_width = qr_image_size(profile.qr_version, qr_scale, profile.qr_quiet_zone)
+    quiet_zone_px = round(profile.qr_quiet_zone * qr_scale)
+    new_img_width = round(profile.label_width * mm_to_pixels)
+    new_img_height = round(profile.label_height * mm_to_pixels)
+
+    lines = data_lab.split("\n")
+    max_width = new_img_width  - (qr_img_width + qr_scale * profile.qr_quiet_zone + profile.w_mergin * mm_to_pixels)
+    max_height = new_img_height - profile.h_mergin * mm_to_pixels
+    font, line_height = fit_label_font(profile, lines, len(lines), max_width, max_height)
+
+    # Printer QR codes have no quiet zone, the symbol starts after it
+    fields = [PrintField('qr', round(1 * mm_to_pixels) + quiet_zone_px, (new_img_height - qr_img_width) // 2 + quiet_zone_px, qr_scale, data_qr, False)]
+    for i, line in enumerate(lines):
+        fields.append(PrintField('text', qr_img_width + qr_scale * profile.qr_quiet_zone + profile.w_mergin * mm_to_pixels // 2,
+                                 i * line_height + profile.h_mergin * mm_to_pixels // 2, font.size, line, False))
+    return new_img_width, new_img_height, fields
+
+def label_data(row):
     """
-    Draw dotted lines between two points.
+    Build the QR payload and label text of a row.
 
     Args:
-        draw (ImageDraw): The drawing context.
-        start_x (int): The starting x-coordinate.
-        start_y (int): The starting y-coordinate.
-        end_x (int): The ending x-coordinate.
-        end_y (int): The ending y-coordinate.
-        dash_length (int): The length of each dash.
-        gap_length (int): The length of the gap between dashes.
+        row (DeviceRow): The row.
+
+    Returns:
+        tuple: (data_qr, data_lab).
     """
-    total_length = ((end_x - start_x) ** 2 + (end_y - start_y) ** 2) ** 0.5
-    dashes = int(total_length // (dash_length + gap_length))
-    
-    for i in range(dashes):
-        start = i * (dash_length + gap_length)
-        end = start + dash_length
-        x = start_x + (end_x - start_x) * (start / total_length)
-        y = start_y + (end_y - start_y) * (start / total_length)
-        x_end = start_x + (end_x - start_x) * (end / total_length)
-        y_end = start_y + (end_y - start_y) * (end / total_length)
-        draw.line([(x, y), (x_end, y_end)], fill=(0, 0, 0), width=1)
-
-def place_labels_on_a4_sheet(labels, output_filename):
+    # Extract the data from the CSV row
+    name = row.name
+    id = row.id
+    ip = row.ip
+    pidr = row.division # Підрозділ
+    misto = row.city # Населений пункт
+
+    # Create the data for the QR code and label
+    data_qr = f"Name: {name}\r\nIP: {ip}"
+    #data_qr = f"NAME: {name}\nIP: {ip}\nID: {id}"
+    data_lab = f"{misto}\n{pidr}\nName: {name}\nID: {id}"
+    return data_qr, data_lab
+
+def qr_payloads(row):
     """
-    Place labels on an A4 sheet.
+    The QR payloads on the label of a row.
 
     Args:
-        labels (list): A list of label images.
-        output_filename (str): The filename to save the A4 sheet to.
+        row (DeviceRow): The row.
+
+    Returns:
+        tuple: (data_qr,).
     """
-    # A4 sheet dimensions in pixels
-    #a4_width = 2480
-    #a4_height = 3508
-    a4_width = round(210 * MM_TO_PIXELS)
-    a4_height = round(297 * MM_TO_PIXELS)   
-
-    # margin from left right edge
-    side_mergin_px = SIDE_MERGIN * MM_TO_PIXELS    
-
-    # Create a new image for the A4 sheet
-    a4_sheet = Image.new('RGB', (a4_width, a4_height), color = BACK_COLOR)
-    draw = ImageDraw.Draw(a4_sheet)
-
-    # Open the first label image to get its dimensions
-    label_img = labels[0]
-    label_width, label_height = label_img.size
-
-    # Calculate the number of rows and columns for the labels
-    num_cols = 2
-    num_rows = 12
-
-    # Calculate the spacing between labels
-    cell_width = round((a4_width - side_mergin_px) // num_cols)
-    label_spacing_x = (cell_width - label_width) // 2
-    label_spacing_y = (a4_height - (num_rows * label_height)) // (num_rows + 1)
-    
-    sheet_index = 1
-
-    # Place the labels on the A4 sheet
-    for label_index, label_img in enumerate(labels):
-        # Calculate the position of the label
-        row = (label_index // num_cols) % num_rows
-        col = label_index % num_cols
-        x = round(side_mergin_px // 2 + label_spacing_x + (col * (label_width + label_spacing_x * 2)))
-        y = label_spacing_y + (row * (label_height + label_spacing_y))
-
-        # Create a new A4 sheet if necessary
-        if label_index % (num_cols * num_rows) == 0 and label_index != 0:
-            for i in range(0, num_rows + 1):
-                y_line = label_spacing_y + (i * (label_height + label_spacing_y)) - label_spacing_y // 2
-                draw_dotted_lines(draw, 0, y_line, a4_width, y_line)
-            for i in range(0, num_cols + 1):
-                x_line = side_mergin_px // 2 + label_spacing_x + (i * (label_width + label_spacing_x * 2)) - label_spacing_x 
-                draw_dotted_lines(draw, x_line, 0, x_line, a4_height)
-
-            a4_sheet.save(f'{output_filename}_{sheet_index}.png')
-            sheet_index += 1
-            a4_sheet = Image.new('RGB', (a4_width, a4_height), color = BACK_COLOR)
-            draw = ImageDraw.Draw(a4_sheet)
-
-        a4_sheet.paste(label_img, (x, y))
-
-    # Draw the final dotted lines
-    for i in range(0, num_rows + 1):
-        y_line = label_spacing_y + (i * (label_height + label_spacing_y)) - label_spacing_y // 2
-        draw_dotted_lines(draw, 0, y_line, a4_width, y_line)
-    for i in range(0, num_cols + 1):
-        x_line = side_mergin_px // 2 + label_spacing_x + (i * (label_width + label_spacing_x * 2)) - label_spacing_x
-        draw_dotted_lines(draw, x_line, 0, x_line, a4_height)
-
-    a4_sheet.save(f'{output_filename}_{sheet_index}.png')
-
-def process_csv_file(csv_filename, output_dir):
+    return label_data(row)[:1]
+
+def profile_geometry(settings):
     """
-    Process a CSV file and generate labels.
+    Derive the pixel geometry of a render profile and check that the parts of the label fit into it.
 
     Args:
-        csv_filename (str): The filename of the CSV file.
-        output_dir (str): The directory to save the generated labels.
+        settings (dict): The profile settings by lower case name, with mm_to_pixels.
+
+    Returns:
+        dict: The derived settings.
+
+    Raises:
+        ValueError: If the rounded corners, the QR code or the text do not fit into the label.
     """
-    labels = []
-    
-    # Detect the encoding of the file dynamically
-    encoding = detect_file_encoding(csv_filename)
-    print(f"Detected encoding: {encoding}")
-    
-    with open(csv_filename, 'r', encoding=encoding) as csv_file:
-        reader = csv.DictReader(csv_file, delimiter=';', quotechar='|')
-        
-        # Read all rows into a list
-        rows = list(reader)
-
-        # Sort the rows first by 'Division' and then by 'Name'
-        sorted_rows = sorted(rows, key=lambda row: (row['Division'], row['City'], row['Name']))
-        
-        for row in sorted_rows:
-            # Extract the data from the CSV row
-            name = row['Name']
-            id = row['ID']
-            ip = row['IP']
-            pidr = row['Division'] # Підрозділ
-            misto = row['City'] # Населений пункт
-            print(name,id,ip)
-
-            # Create the data for the QR code and label
-            data_qr = f"Name: {name}\r\nIP: {ip}"
-            #data_qr = f"NAME: {name}\nIP: {ip}\nID: {id}"
-            data_lab = f"{misto}\n{pidr}\nName: {name}\nID: {id}"
-
-            # Generate the label image
-            label_img = generate_qr_code_label(data_qr, data_lab)
-
-            # Add the label image to the list of labels
-            labels.append(label_img)
-
-    # Place the labels on an A4 sheet only if there are labels
-    if labels:
-        os.makedirs(output_dir, exist_ok=True)
-        output_filename = os.path.join(output_dir, "labels_a4_sheet")
-        place_labels_on_a4_sheet(labels, output_filename)
-    else:
-        print("No records found.")
-
-# Example usage
-csv_filename = 'temp.csv'
-output_dir = 'labels'
-process_csv_file(csv_filename, output_dir)
+    mm_to_pixels = settings['mm_to_pixels']
+    width = round(settings['label_width'] * mm_to_pixels)
+    height = round(settings['label_height'] * mm_to_pixels)
+    corner_radius_px = round(settings['corner_radius'] * mm_to_pixels)
+    qr_size = qr_image_size(settings['qr_version'], settings['qr_scale'], settings['qr_quiet_zone'])
+
+    # The places generate_qr_code_label draws the parts at
+    if 2 * corner_radius_px > min(width, height) - 1:
+        raise ValueError(f"corner_radius {settings['corner_radius']} mm does not fit into the "
+                         f"{settings['label_width']} x {settings['label_height']} mm label")
+    if round(1 * mm_to_pixels) + qr_size > width or qr_size > height:
+        raise ValueError(f"the QR code ({qr_size * settings['pixels_to_mm']:.1f} mm with qr_version, qr_scale and "
+                         f"qr_quiet_zone) does not fit into the {settings['label_width']} x {settings['label_height']} mm label")
+    text_room = width - (qr_size + settings['qr_scale'] * settings['qr_quiet_zone'] + settings['w_mergin'] * mm_to_pixels)
+    text_room_height = height - settings['h_mergin'] * mm_to_pixels
+    if text_room <= 0 or text_room_height <= 0:
+        raise ValueError("the QR code and w_mergin and h_mergin leave no room for the text of the "
+                         f"{settings['label_width']} x {settings['label_height']} mm label")
+    return {'corner_radius_px': corner_radius_px}
+
+# The device labels for labels_common, the default profile is made of the constants above.
+# Every sheet gets the outer cut lines.
+HW_LABELS = LabelKind(
+    name='Labels_HW_gen', row_type=DeviceRow, columns=CSV_COLUMNS, optional_columns=OPTIONAL_COLUMNS, strip_values=False,
+    row_sort_key=row_sort_key, label_data=label_data, qr_payloads=qr_payloads,
+    draw_label=generate_qr_code_label, label_fields=printer_label_fields,
+    sheet=SheetStyle(num_cols=2, num_rows=12, dash_length=5, gap_length=10, outer_lines_every_sheet=True,
+                     later_sheet_color=None, last_sheet_dpi=False),
+    profile_settings=PROFILE_SETTINGS, zero_settings=PROFILE_ZERO_SETTINGS, profile_geometry=profile_geometry,
+    default_profile=labels_common.build_render_profile('default', {setting.lower(): globals()[setting] for setting in PROFILE_SETTINGS},
+                                                       profile_geometry),
+    caches=(('label_template', label_template),))
+
+def process_csv_file(csv_filename, output_dir, memmap_dir=None, verify=False, resume=False, metrics_file=METRICS_FILE, profile=None):
+    """Process a CSV file and generate device labels, see labels_common.process_csv_file."""
+    return labels_common.process_csv_file(HW_LABELS, csv_filename, output_dir, memmap_dir, verify, resume, metrics_file, profile)
+
+def process_csv_file_sharded(csv_filename, output_dir, workers=SHARD_WORKERS, queue_dir=None, memmap_dir=None, profile=None):
+    """Process a CSV file with several worker processes, see labels_common.process_csv_file_sharded."""
+    return labels_common.process_csv_file_sharded(HW_LABELS, csv_filename, output_dir, workers, queue_dir, memmap_dir, profile)
+
+def shard_csv_file(csv_filename, queue_dir, sheets_per_chunk=labels_common.SHARD_SHEETS, profile=None):
+    """Split an input file into chunks of a work queue, see labels_common.shard_csv_file."""
+    return labels_common.shard_csv_file(HW_LABELS, csv_filename, queue_dir, sheets_per_chunk, profile)
+
+def run_shard_worker(queue_dir, memmap_dir=None):
+    """Render chunks from a work queue, see labels_common.run_shard_worker."""
+    return labels_common.run_shard_worker(HW_LABELS, queue_dir, memmap_dir)
+
+def merge_shards(queue_dir, output_dir):
+    """Move the sheets of a finished sharded run into the output directory, see labels_common.merge_shards."""
+    return labels_common.merge_shards(queue_dir, output_dir)
+
+def verify_sheets(csv_filename, output_dir, workers=VERIFY_WORKERS, profile=None):
+    """Scan the QR codes of saved sheets, see labels_common.verify_sheets."""
+    return labels_common.verify_sheets(HW_LABELS, csv_filename, output_dir, workers, profile)
+
+def preview_csv_file(csv_filename, output_dir, ppi=PREVIEW_PPI, max_sheets=None, profile=None):
+    """Render low resolution preview sheets, see labels_common.preview_csv_file."""
+    return labels_common.preview_csv_file(HW_LABELS, csv_filename, output_dir, ppi, max_sheets, profile)
+
+def dry_run_csv_file(csv_filename, profile=None):
+    """Check an input file without rendering it, see labels_common.dry_run_csv_file."""
+    return labels_common.dry_run_csv_file(HW_LABELS, csv_filename, profile)
+
+def print_csv_file(csv_filename, target, language='zpl', metrics_file=METRICS_FILE, profile=None):
+    """Send the labels to a label printer, see labels_common.print_csv_file."""
+    return labels_common.print_csv_file(HW_LABELS, csv_filename, target, language, metrics_file, profile)
+
+def load_render_profiles(profiles_filename):
+    """Read the render profiles of a TOML file, see labels_common.load_render_profiles."""
+    return labels_common.load_render_profiles(HW_LABELS, profiles_filename)
+
+def cached_functions():
+    """The LRU cached functions whose hit rates are part of the run metrics."""
+    return labels_common.cached_functions(HW_LABELS)
+
+# Example usage, the guard keeps worker processes from running it again
+if __name__ == '__main__':
+    csv_filename = 'temp.csv'
+    output_dir = 'labels'
+    process_csv_file(csv_filename, output_dir)
@@ -0,0 +1,2291 @@
+"""
+Shared part of the label generators: reading and sorting the inventory,
+composing and saving A4 sheets, printer output, run metrics, checkpoints,
+sharding, render profiles, scan verification and dry runs.
+
+Each generator script describes its labels with a LabelKind - the row type
+and CSV columns, how a row becomes label data, how a label is drawn and how
+the sheet is laid out - and passes it to the functions here.
+"""
+import base64
+import binascii
+from chardet import UniversalDetector
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ContextDecorator
+from io import BytesIO
+from itertools import chain, islice, repeat
+from operator import itemgetter
+from functools import lru_cache, partial, update_wrapper
+from collections import OrderedDict, namedtuple
+import csv
+import hashlib
+import heapq
+import json
+import os
+import pickle
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+import zlib
+import numpy as np
+import png
+import pyqrcode
+from PIL import Image, ImageDraw, ImageFont, ImageColor
+
+# Rows sorted in memory at once, bigger inputs are sorted in runs spilled to disk
+SORT_BUFFER_ROWS = 100000
+
+# Digit runs of port and device names, compared as numbers when sorting
+NUMBER_PATTERN = re.compile(r'(\d+)')
+
+# Bytes read at once when detecting the encoding of a CSV file, and the most bytes fed to the detector
+ENCODING_BLOCK_BYTES = 65536
+ENCODING_SAMPLE_BYTES = 1 << 20
+# Bytes that are not plain ASCII text, NUL points to UTF-16 or UTF-32 without a byte order mark
+NON_ASCII_PATTERN = re.compile(rb'[\x00\x80-\xff]')
+
+# Rows converted at once when reading columnar (Parquet) inputs
+READ_BATCH_ROWS = 65536
+
+# Canvas rows encoded at once when saving a memory-mapped sheet
+SHEET_STRIP_ROWS = 256
+
+# Distinct QR codes kept in memory, repeated ones are rendered once
+QR_CACHE_SIZE = 1024
+# Bytes of rendered RGB label images kept in memory, repeated labels are rendered once. The number of
+# labels kept shrinks with the PPI. Runs with a memory-mapped sheet canvas keep fewer.
+LABEL_CACHE_BYTES = 64 << 20
+MEMMAP_LABEL_CACHE_BYTES = 16 << 20
+# Measured text line widths kept in memory for fitting the label font
+TEXT_WIDTH_CACHE_SIZE = 65536
+
+# Worker processes scanning the saved sheets in verify_sheets, None uses all CPUs
+VERIFY_WORKERS = None
+
+# Sharded runs: sheets per work queue chunk, worker processes of process_csv_file_sharded (None uses all CPUs)
+SHARD_SHEETS = 10
+SHARD_WORKERS = None
+
+# Sheets between the checkpoints of process_csv_file, 0 disables them
+CHECKPOINT_SHEETS = 10
+
+# Fitted label fonts smaller than this (in points) are reported by dry_run_csv_file
+MIN_FONT_PT = 5
+
+# Seconds between progress lines, and the file run metrics are written to: a Prometheus
+# text file if it ends in '.prom', otherwise JSON lines appended per run (None writes none)
+PROGRESS_INTERVAL = 5
+METRICS_FILE = None
+
+# Render profile settings that are whole numbers, the other numeric settings may be fractional.
+# Only the internal preview profiles scale QR codes by a fraction, see preview_profile.
+PROFILE_INTEGER_SETTINGS = ('LINE_WIDTH', 'QR_VERSION', 'QR_SCALE', 'QR_QUIET_ZONE', 'FONT_SIZE')
+
+# Magnifications of a ZPL ^BQ QR code field
+ZPL_QR_MAGNIFICATIONS = range(1, 11)
+
+# Resolution of the sheets rendered by preview_csv_file
+PREVIEW_PPI = 72
+
+# Direct printing, one printer job per label instead of A4 sheets
+PRINTER_LANGUAGES = ('zpl', 'zpl-grf', 'tspl')
+PRINTER_GAP = 2 # mm between labels on the roll
+# Gray level below which a pixel prints black in 1 bit printer images
+MONOCHROME_THRESHOLD = 128
+
+# Statistics of an ImageCache, like functools.lru_cache reports them, maxsize and currsize are in bytes
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+# A QR code ('qr', size is the module size) or text line ('text', size is the font height) of a printer label
+PrintField = namedtuple('PrintField', ['kind', 'x', 'y', 'size', 'data', 'inverted'])
+
+# Grid of label cells on an A4 sheet, positions are the (x, y) of each cell row by row
+SheetLayout = namedtuple('SheetLayout', ['width', 'height', 'num_cols', 'num_rows', 'side_mergin_px', 'label_spacing_x', 'label_spacing_y', 'positions'])
+
+# A label whose QR codes do not scan to the payloads of its row
+ScanMismatch = namedtuple('ScanMismatch', ['sheet', 'slot', 'expected', 'decoded'])
+
+# Outcome of a dry run: counts, (row, font size in pt) of small fonts, (row, payload, needed version) of QR overflows
+DryRunReport = namedtuple('DryRunReport', ['rows', 'labels', 'sheets', 'small_fonts', 'qr_overflows'])
+
+# How the labels of a kind are placed on A4 sheets: the grid, the dashes of the cut lines, whether the
+# outer cut lines are drawn on every sheet or only on the last one of a run, the background of the sheets
+# after the first one (None keeps the profile's back_color) and whether the last sheet records the PPI
+SheetStyle = namedtuple('SheetStyle', ['num_cols', 'num_rows', 'dash_length', 'gap_length', 'outer_lines_every_sheet', 'later_sheet_color', 'last_sheet_dpi'])
+
+# What a generator script renders:
+#   name - the generator name in the run metrics
+#   row_type, columns, optional_columns - the row record and the input columns of its fields, in order
+#   strip_values - whether cell values are stripped of surrounding white space
+#   row_sort_key(row), label_data(row), qr_payloads(row) - the sort key, the drawing arguments and QR payloads of a row
+#   draw_label(profile, *data), label_fields(profile, *data) - the label image and its printer fields
+#   sheet - the SheetStyle, profile_settings, zero_settings, profile_geometry(settings) - the profile constants
+#   (see compile_render_profile), default_profile - the RenderProfile of the script's constants
+#   caches - (name, function) of the script's own LRU caches reported in the run metrics
+LabelKind = namedtuple('LabelKind', ['name', 'row_type', 'columns', 'optional_columns', 'strip_values',
+                                     'row_sort_key', 'label_data', 'qr_payloads', 'draw_label', 'label_fields', 'sheet',
+                                     'profile_settings', 'zero_settings', 'profile_geometry', 'default_profile', 'caches'])
+
+class RenderProfile:
+    """
+    A validated render profile.
+
+    The settings are read as attributes with the lower case names of the
+    generator's PROFILE_SETTINGS constants, e.g. profile.ppi, and the derived
+    pixel geometry, e.g. profile.mm_to_pixels. Profiles are immutable and
+    compare and hash by their settings, so caches can be keyed on them.
+    """
+    __slots__ = ('name', 'settings', 'key')
+
+    def __init__(self, name, settings):
+        self.name = name
+        self.settings = dict(settings)
+        self.key = tuple(sorted(self.settings.items()))
+
+    def __getattr__(self, setting):
+        # Only called for names that are not slots
+        try:
+            return self.settings[setting]
+        except KeyError:
+            raise AttributeError(f"Render profile '{self.name}' has no setting '{setting}'") from None
+
+    def __eq__(self, other):
+        return isinstance(other, RenderProfile) and self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __reduce__(self):
+        return RenderProfile, (self.name, self.settings)
+
+    def __repr__(self):
+        return f'RenderProfile({self.name!r})'
+
+    @property
+    def font(self):
+        """The label font at the profile's font size, loaded once."""
+        return load_font(self.font_type, self.font_size)
+
+def convert_color(color):
+    if isinstance(color, str):
+        return ImageColor.getrgb(color)  # Convert color name to RGB tuple
+    return color  # If already an RGB tuple, return as is
+
+class RunState(threading.local):
+    """
+    The metrics of the run in the current thread.
+
+    Each thread has its own counters and stage timers, so runs in several
+    threads, e.g. with different render profiles, do not count into or
+    reset each other's metrics.
+
+    Attributes:
+        metrics (dict): Counters and stage timers of the run, see reset_run_metrics.
+        stages (list): Start time and time spent in nested timed stages, one [start, nested] entry per running stage.
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self.stages = []
+
+run_state = RunState()
+
+def count_metric(name, amount=1):
+    """Add to a counter or stage timer of the current run."""
+    run_state.metrics[name] = run_state.metrics.get(name, 0) + amount
+
+class timed_stage(ContextDecorator):
+    """
+    Add the time spent in a function or a with block to a stage timer of the run metrics.
+
+    Used as a decorator for functions that are a stage as a whole, and as
+    `with timed_stage(...)` for the part of a function that is. Time spent in
+    nested timed stages is counted only for their own stage, so the stages do
+    not overlap.
+
+    Args:
+        stage (str): The timer name, e.g. 'qr_seconds'.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        # The state is kept on the thread's stage stack, so the same instance can be entered
+        # again by recursion and by other threads
+        run_state.stages.append([time.perf_counter(), 0.0])
+        return self
+
+    def __exit__(self, *exc_info):
+        stages = run_state.stages
+        start, nested = stages.pop()
+        elapsed = time.perf_counter() - start
+        count_metric(self.stage, elapsed - nested)
+        if stages:
+            stages[-1][1] += elapsed
+        return False
+
+def detect_file_encoding(csv_filename):
+    """
+    Detect the encoding of a file using chardet.
+
+    ASCII reads the same in every encoding the detector chooses from, so the
+    file is only scanned up to the first line with another byte. From that
+    line on the file is fed to the detector in ENCODING_BLOCK_BYTES blocks
+    until it is confident or ENCODING_SAMPLE_BYTES were fed, so big files are
+    not loaded as a whole and rows with other characters far down the file
+    still decide the encoding.
+
+    Args:
+        csv_filename (str): The path to the CSV file.
+
+    Returns:
+        str: The detected encoding, 'ascii' when the whole file is ASCII.
+    """
+    detector = UniversalDetector()
+    with open(csv_filename, 'rb') as file:
+        blocks = iter(lambda: file.read(ENCODING_BLOCK_BYTES), b'')
+        for block in blocks:
+            match = NON_ASCII_PATTERN.search(block)
+            if match:
+                # Start at the line of the first other byte, ASCII rows would only dilute the sample
+                block = block[block.rfind(b'\n', 0, match.start()) + 1:]
+                break
+        else:
+            return 'ascii'
+
+        sample_bytes = 0
+        for block in chain([block], blocks):
+            detector.feed(block)
+            sample_bytes += len(block)
+            if detector.done or sample_bytes >= ENCODING_SAMPLE_BYTES:
+                break
+    detector.close()
+    return detector.result['encoding']
+
+def find_columns(kind, header, filename):
+    """
+    Find the position of each label column in a header.
+
+    Args:
+        kind (LabelKind): The label kind.
+        header (list): The column names of the input file.
+        filename (str): The input filename, used in the error message.
+
+    Returns:
+        list: The index of each kind.columns entry in header, None for a missing optional column.
+    """
+    indexes = []
+    for column in kind.columns:
+        if column in header:
+            indexes.append(header.index(column))
+        elif column in kind.optional_columns:
+            indexes.append(None)
+        else:
+            raise KeyError(f"Column '{column}' not found in {filename}")
+    return indexes
+
+def cell_to_str(value):
+    """Convert a cell value of a typed source (JSON, XLSX) to the label text."""
+    return '' if value is None else str(value)
+
+def parse_copies(row):
+    """
+    Number of copies of a label requested by the Copies column of a row.
+
+    Args:
+        row (tuple): A row record, its copies field is empty when the column is missing.
+
+    Returns:
+        int: The number of copies, 1 for an empty value, 0 skips the row.
+
+    Raises:
+        ValueError: If the value is not a whole number of 0 or more.
+    """
+    value = row.copies.strip()
+    if not value:
+        return 1
+    # Spreadsheet exports may write whole numbers as '2.0'
+    try:
+        copies = float(value)
+    except ValueError:
+        copies = None
+    if copies is None or not copies.is_integer() or copies < 0:
+        raise ValueError(f"Copies must be a whole number of 0 or more, not {row.copies!r} in row '{';'.join(row)}'")
+    return int(copies)
+
+def rows_from_columns(kind, columns, filename):
+    """
+    Build rows from one columnar batch without creating a dict per row.
+
+    Args:
+        kind (LabelKind): The label kind.
+        columns (list): One list of values per kind.columns entry, None for a missing optional column.
+        filename (str): The input filename, used in the error message.
+
+    Returns:
+        iterator: Row records of the batch.
+
+    Raises:
+        ValueError: If the columns have different lengths, zip would drop the records past the shortest one.
+    """
+    lengths = {name: len(column) for name, column in zip(kind.columns, columns) if column is not None}
+    length = max(lengths.values())
+    if min(lengths.values()) != length:
+        raise ValueError(f"Columns of {filename} have different lengths: "
+                         f"{', '.join(f'{name} {column_length}' for name, column_length in lengths.items())}")
+    if kind.strip_values:
+        columns = [[value.strip() for value in column] if column is not None else None for column in columns]
+    columns = [column if column is not None else repeat('', length) for column in columns]
+    return map(kind.row_type._make, zip(*columns))
+
+def read_csv_rows(kind, csv_filename, encoding):
+    """
+    Read a CSV file row by row as compact row tuples.
+
+    Args:
+        kind (LabelKind): The label kind.
+        csv_filename (str): The path to the CSV file.
+        encoding (str): The encoding of the file.
+
+    Yields:
+        tuple: One kind.row_type record per non-empty CSV row.
+    """
+    row_type = kind.row_type
+    strip = str.strip if kind.strip_values else str
+    with open(csv_filename, 'r', encoding=encoding) as csv_file:
+        reader = csv.reader(csv_file, delimiter=';', quotechar='|')
+        header = next(reader, None)
+        if header is None:
+            return
+
+        # Map each label column to its position in the file
+        indexes = find_columns(kind, header, csv_filename)
+
+        for values in reader:
+            # Skip empty lines like csv.DictReader does
+            if not values:
+                continue
+            yield row_type(*(strip(values[i]) if i is not None and i < len(values) else '' for i in indexes))
+
+def read_parquet_rows(kind, parquet_filename):
+    """
+    Read a Parquet file in columnar batches, loading only the label columns.
+
+    Args:
+        kind (LabelKind): The label kind.
+        parquet_filename (str): The path to the Parquet file.
+
+    Yields:
+        tuple: One kind.row_type record per table row.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    parquet_file = pq.ParquetFile(parquet_filename)
+    names = parquet_file.schema_arrow.names
+    indexes = find_columns(kind, names, parquet_filename)
+    projection = [names[i] for i in indexes if i is not None]
+
+    for batch in parquet_file.iter_batches(batch_size=READ_BATCH_ROWS, columns=projection):
+        columns = []
+        for i in indexes:
+            if i is None:
+                columns.append(None)
+                continue
+            # Cast and fill nulls on the whole column instead of per value
+            column = batch.column(names[i])
+            if not pa.types.is_string(column.type):
+                column = column.cast(pa.string())
+            columns.append(column.fill_null('').to_pylist())
+        yield from rows_from_columns(kind, columns, parquet_filename)
+
+def read_json_rows(kind, json_filename):
+    """
+    Read a JSON export of the inventory.
+
+    Supports column oriented objects ({"Name": [...], ...}), lists of
+    records ([{"Name": ...}, ...]) and JSON Lines files (.jsonl), which
+    are read one record at a time.
+
+    Args:
+        kind (LabelKind): The label kind.
+        json_filename (str): The path to the JSON file.
+
+    Yields:
+        tuple: One kind.row_type record per inventory entry.
+    """
+    strip = str.strip if kind.strip_values else str
+    with open(json_filename, 'r', encoding='utf-8-sig') as json_file:
+        if json_filename.lower().endswith('.jsonl'):
+            records = (json.loads(line) for line in json_file if line.strip())
+        else:
+            data = json.load(json_file)
+            if isinstance(data, dict):
+                # Column oriented export, use the columns as they are
+                names = list(data)
+                indexes = find_columns(kind, names, json_filename)
+                columns = [None if i is None else [cell_to_str(value) for value in data[names[i]]] for i in indexes]
+                yield from rows_from_columns(kind, columns, json_filename)
+                return
+            records = iter(data)
+
+        for record in records:
+            # Required columns must be present in every record
+            for column in kind.columns:
+                if column not in record and column not in kind.optional_columns:
+                    raise KeyError(f"Column '{column}' not found in {json_filename}")
+            yield kind.row_type(*(strip(cell_to_str(record.get(column))) for column in kind.columns))
+
+def read_xlsx_rows(kind, xlsx_filename):
+    """
+    Read the first worksheet of an XLSX workbook row by row.
+
+    Args:
+        kind (LabelKind): The label kind.
+        xlsx_filename (str): The path to the XLSX file.
+
+    Yields:
+        tuple: One kind.row_type record per non-empty worksheet row.
+    """
+    from openpyxl import load_workbook
+
+    strip = str.strip if kind.strip_values else str
+    workbook = load_workbook(xlsx_filename, read_only=True, data_only=True)
+    try:
+        sheet_rows = workbook.active.iter_rows(values_only=True)
+        header = next(sheet_rows, None)
+        if header is None:
+            return
+        indexes = find_columns(kind, [cell_to_str(name).strip() for name in header], xlsx_filename)
+
+        for values in sheet_rows:
+            if all(value is None for value in values):
+                continue
+            yield kind.row_type(*(strip(cell_to_str(values[i])) if i is not None and i < len(values) else '' for i in indexes))
+    finally:
+        workbook.close()
+
+# Input readers by file extension, anything else is read as a ';' separated CSV file
+INPUT_READERS = {
+    '.parquet': read_parquet_rows,
+    '.json': read_json_rows,
+    '.jsonl': read_json_rows,
+    '.xlsx': read_xlsx_rows,
+}
+
+def read_input_rows(kind, input_filename):
+    """
+    Read the rows of an inventory file with the reader matching its extension.
+
+    Only CSV files need the encoding detection, the other formats carry
+    their own encoding.
+
+    Args:
+        kind (LabelKind): The label kind.
+        input_filename (str): The path to a CSV, Parquet, JSON or XLSX file.
+
+    Returns:
+        iterator: kind.row_type records in the order of the file.
+    """
+    extension = os.path.splitext(input_filename)[1].lower()
+    reader = INPUT_READERS.get(extension)
+    if reader is not None:
+        return reader(kind, input_filename)
+
+    # Detect the encoding of the file dynamically
+    encoding = detect_file_encoding(input_filename)
+    print(f"Detected encoding: {encoding}")
+    return read_csv_rows(kind, input_filename, encoding)
+
+
+def natural_sort_key(text):
+    """
+    Sort key that compares the digit runs of a string as numbers.
+
+    Args:
+        text (str): The string to sort, e.g. a device name like 'sw-10'.
+
+    Returns:
+        tuple: Alternating lower-cased text parts and integers.
+    """
+    parts = NUMBER_PATTERN.split(text.lower())
+    parts[1::2] = [int(part) for part in parts[1::2]]
+    return tuple(parts)
+
+def port_sort_key(port):
+    """
+    Natural sort key of an interface name, so 'Gi1/0/2' comes before 'Gi1/0/10'.
+
+    Args:
+        port (str): The port name, e.g. 'Gi1/0/10', 'Te2/1', 'eth3' or '12'.
+
+    Returns:
+        tuple: (interface type, (slot, module, port, ...) as integers, port),
+        the original name breaks ties between different spellings.
+    """
+    match = NUMBER_PATTERN.search(port)
+    if_type = port[:match.start()] if match else port
+    numbers = tuple(int(number) for number in NUMBER_PATTERN.findall(port))
+    return (if_type.strip().lower(), numbers, port)
+
+def spill_sorted_run(run):
+    """
+    Write a sorted run of (key, row) pairs to a temporary file.
+
+    Args:
+        run (list): Sorted (key, row) pairs.
+
+    Returns:
+        file: The temporary file, positioned at its beginning.
+    """
+    run_file = tempfile.TemporaryFile()
+    pickler = pickle.Pickler(run_file, pickle.HIGHEST_PROTOCOL)
+    for item in run:
+        pickler.dump(item)
+    run_file.seek(0)
+    return run_file
+
+def read_sorted_run(run_file):
+    """
+    Read back the (key, row) pairs written by spill_sorted_run.
+
+    Args:
+        run_file (file): The temporary file of the run.
+
+    Yields:
+        tuple: The (key, row) pairs in the order they were written.
+    """
+    unpickler = pickle.Unpickler(run_file)
+    while True:
+        try:
+            yield unpickler.load()
+        except EOFError:
+            return
+
+def sort_rows_external(rows, key, buffer_rows=SORT_BUFFER_ROWS):
+    """
+    Sort rows lazily without holding more than buffer_rows of them in memory.
+
+    Inputs that fit into the buffer are sorted in memory. Larger inputs are
+    sorted in runs of buffer_rows which are spilled to temporary files and
+    merged back while the rows are consumed. The sort is stable and the key
+    is computed only once per row.
+
+    Args:
+        rows (iterable): The rows to sort.
+        key (callable): Function returning the sort key of a row.
+        buffer_rows (int): Maximum number of rows kept in memory at once.
+
+    Yields:
+        The rows in sorted order.
+    """
+    rows = iter(rows)
+    runs = []
+    try:
+        while True:
+            run = [(key(row), row) for row in islice(rows, buffer_rows)]
+            run.sort(key=itemgetter(0))
+
+            # Everything fits in memory, no need to touch the disk
+            if not runs and len(run) < buffer_rows:
+                for _, row in run:
+                    yield row
+                return
+
+            if run:
+                runs.append(spill_sorted_run(run))
+            if len(run) < buffer_rows:
+                break
+
+        for _, row in heapq.merge(*(read_sorted_run(run_file) for run_file in runs), key=itemgetter(0)):
+            yield row
+    finally:
+        for run_file in runs:
+            run_file.close()
+
+def merge_duplicate_rows(rows):
+    """
+    Merge runs of identical rows into one row with the copies of all of them.
+
+    Only rows next to each other are merged. Sorting brings rows with the same
+    sort key together but keeps their file order, so a label listed twice with
+    another row of the same sort key in between stays two rows (its image is
+    still rendered once, see render_label).
+
+    Args:
+        rows (iterable): Row records with a copies field.
+
+    Yields:
+        tuple: The rows, each run of rows that differ only in their copies as one row.
+    """
+    previous = None
+    copies = 0
+    for row in rows:
+        if previous is not None and row._replace(copies='') == previous._replace(copies=''):
+            copies += parse_copies(row)
+            continue
+        if previous is not None:
+            yield previous if copies == parse_copies(previous) else previous._replace(copies=str(copies))
+        previous = row
+        copies = parse_copies(row)
+    if previous is not None:
+        yield previous if copies == parse_copies(previous) else previous._replace(copies=str(copies))
+
+def read_sorted_rows(kind, input_filename):
+    """
+    Read the rows of an inventory file in label order, see sort_rows_external.
+
+    Adjacent duplicate rows are merged, see merge_duplicate_rows.
+
+    Args:
+        kind (LabelKind): The label kind.
+        input_filename (str): The path to a CSV, Parquet, JSON or XLSX file.
+
+    Returns:
+        iterator: kind.row_type records sorted by kind.row_sort_key.
+    """
+    return merge_duplicate_rows(sort_rows_external(read_input_rows(kind, input_filename), key=kind.row_sort_key))
+
+def draw_rounded_rectangle_color(draw, xy, radius, fill_color, stroke_color, width=1):
+    # Extract coordinates from the xy tuple
+    x1, y1, x2, y2 = xy
+
+    # Draw the filled rounded rectangle
+    # Draw the main body of the rectangle with the fill color
+    draw.rectangle([x1 + radius, y1, x2 - radius, y2], fill=fill_color)  # Fill the central part
+    draw.rectangle([x1, y1 + radius, x2, y2 - radius], fill=fill_color)  # Fill the sides
+
+    # Draw the rounded corners with the fill color
+    draw.pieslice([x1, y1, x1 + 2 * radius, y1 + 2 * radius], start=180, end=270, fill=fill_color)
+    draw.pieslice([x2 - 2 * radius, y1, x2, y1 + 2 * radius], start=270, end=360, fill=fill_color)
+    draw.pieslice([x1, y2 - 2 * radius, x1 + 2 * radius, y2], start=90, end=180, fill=fill_color)
+    draw.pieslice([x2 - 2 * radius, y2 - 2 * radius, x2, y2], start=0, end=90, fill=fill_color)
+
+    # Now draw the stroke (outline) over the filled area
+    draw.line([(x1 + radius, y1), (x2 - radius, y1)], fill=stroke_color, width=width)
+    draw.line([(x1 + radius, y2), (x2 - radius, y2)], fill=stroke_color, width=width)
+    draw.line([(x1, y1 + radius), (x1, y2 - radius)], fill=stroke_color, width=width)
+    draw.line([(x2, y1 + radius), (x2, y2 - radius)], fill=stroke_color, width=width)
+    draw.arc([x1, y1, x1 + 2 * radius, y1 + 2 * radius], start=180, end=270, fill=stroke_color, width=width)
+    draw.arc([x2 - 2 * radius, y1, x2, y1 + 2 * radius], start=270, end=360, fill=stroke_color, width=width)
+    draw.arc([x1, y2 - 2 * radius, x1 + 2 * radius, y2], start=90, end=180, fill=stroke_color, width=width)
+    draw.arc([x2 - 2 * radius, y2 - 2 * radius, x2, y2], start=0, end=90, fill=stroke_color, width=width)
+
+def draw_rounded_rectangle(draw, xy, radius, color, width=1):
+    # Convert each element of xy to mm
+    x1, y1, x2, y2 = xy
+    draw.line([(x1 + radius, y1), (x2 - radius, y1)], fill=color, width=width)
+    draw.line([(x1 + radius, y2), (x2 - radius, y2)], fill=color, width=width)
+    draw.line([(x1, y1 + radius), (x1, y2 - radius)], fill=color, width=width)
+    draw.line([(x2, y1 + radius), (x2, y2 - radius)], fill=color, width=width)
+    draw.arc([x1, y1, x1 + 2 * radius, y1 + 2 * radius], start=180, end=270, fill=color, width=width)
+    draw.arc([x2 - 2 * radius, y1, x2, y1 + 2 * radius], start=270, end=360, fill=color, width=width)
+    draw.arc([x1, y2 - 2 * radius, x1 + 2 * radius, y2], start=90, end=180, fill=color, width=width)
+    draw.arc([x2 - 2 * radius, y2 - 2 * radius, x2, y2], start=0, end=90, fill=color, width=width)
+
+
+@lru_cache(maxsize=None)
+def load_font(font_type, font_size):
+    """Load a TrueType font once per run for each size."""
+    return ImageFont.truetype(font_type, font_size)
+
+@lru_cache(maxsize=None)
+def font_line_height(font):
+    """Height of a text line in a font, measured once per font."""
+    return font.getbbox("Ay")[3]
+
+@lru_cache(maxsize=TEXT_WIDTH_CACHE_SIZE)
+def text_width(font, line):
+    """Width of a line of text in a font, measured once per font and line."""
+    return font.getbbox(line)[2]
+
+@timed_stage('text_seconds')
+def fit_label_font(profile, lines, line_count, max_width, max_height):
+    """
+    Scale the label font so the text fits into the given rectangle.
+
+    Only font metrics are used, nothing is drawn.
+
+    Args:
+        profile (RenderProfile): The profile whose font is scaled.
+        lines (list): The lines whose widest one has to fit into max_width.
+        line_count (int): The number of lines that have to fit into max_height.
+        max_width (float): The maximum text width in pixels.
+        max_height (float): The maximum text height in pixels.
+
+    Returns:
+        tuple: (font, line_height) for drawing the text.
+    """
+    font = profile.font
+    # Calculate line height
+    line_height = font_line_height(font)
+
+    # Calculate total text height and maximum text width
+    total_text_height = line_count * line_height
+    total_text_width = max(text_width(font, line) for line in lines)
+
+    # Calculate scale factor to fit text within the rectangle
+    scale_factor = min(max_width / total_text_width, max_height / total_text_height)
+
+    # If scaling is needed, adjust font size
+    if scale_factor != 1:
+        font = load_font(profile.font_type, int(profile.font_size * scale_factor))
+        line_height = font_line_height(font)
+    return font, line_height
+
+def qr_image_size(version, scale, quiet_zone):
+    """
+    Size of a QR code image drawn by generate_qr_image, quiet zone included.
+
+    Args:
+        version (int): The QR code version.
+        scale (float): The size of a module in pixels.
+        quiet_zone (int): The width of the quiet zone in modules.
+
+    Returns:
+        int: The width and height of the image in pixels.
+    """
+    return round((17 + 4 * version + 2 * quiet_zone) * scale)
+
+@lru_cache(maxsize=QR_CACHE_SIZE)
+@timed_stage('qr_seconds')
+def generate_qr_image(data_qr, version, scale, quiet_zone, background, error='M'):
+    """
+    Generate a QR code image, a payload repeated within a run is encoded only once.
+
+    Args:
+        data_qr (str): The data to encode in the QR code.
+        version (int): The QR code version.
+        scale (float): The size of a module in pixels. A fractional scale draws the
+            code with 1 pixel modules and resizes it once to qr_image_size.
+        quiet_zone (int): The width of the quiet zone in modules.
+        background (tuple): The background RGB color.
+        error (str): The error correction level.
+
+    Returns:
+        Image: The QR code image. It is shared by all callers, do not modify it.
+    """
+    # Create a QR code with UTF-8 encoding
+    qr = pyqrcode.create(data_qr, encoding='utf-8', version=version, error=error)
+    whole_scale = scale == int(scale)
+
+    # Generate the QR code as PNG and save to a BytesIO object
+    qr_png = BytesIO()
+    qr.png(qr_png, scale=int(scale) if whole_scale else 1, quiet_zone=quiet_zone, background=background)
+    qr_png.seek(0)  # Reset the pointer to the beginning of the file-like object
+
+    # Convert the PNG from BytesIO to a PIL Image, decoded now so the cached image is ready to paste
+    qr_img = Image.open(qr_png)
+    qr_img.load()
+    if not whole_scale:
+        # Shrinking averages the modules, enlarging keeps their edges sharp
+        size = qr_image_size(version, scale, quiet_zone)
+        qr_img = qr_img.convert('RGBA').resize((size, size), Image.BOX if scale < 1 else Image.NEAREST)
+    return qr_img
+
+@lru_cache(maxsize=None)
+@timed_stage('qr_seconds')
+def qr_placeholder_image(version, scale, quiet_zone, background, rotated=False):
+    """
+    Draw a stand-in for the QR codes of preview labels, once per geometry.
+
+    It is as large as the QR code generate_qr_image draws with the same
+    arguments: the quiet zone, a grey symbol and its three finder patterns.
+
+    Args:
+        version (int): The QR code version.
+        scale (float): The size of a module in pixels.
+        quiet_zone (int): The width of the quiet zone in modules.
+        background (tuple): The background RGB color.
+        rotated (bool): Turn it by 180 degrees like the QR codes of an upside-down label half.
+
+    Returns:
+        Image: The placeholder image. It is shared by all callers, do not modify it.
+    """
+    size = qr_image_size(version, scale, quiet_zone)
+    modules = 17 + 4 * version
+    img = Image.new('RGB', (size, size), background)
+    draw = ImageDraw.Draw(img)
+
+    def module_box(x, y, width):
+        # Pixel box of width x width modules from module (x, y) of the symbol
+        return [round((quiet_zone + x) * scale), round((quiet_zone + y) * scale),
+                round((quiet_zone + x + width) * scale) - 1, round((quiet_zone + y + width) * scale) - 1]
+
+    draw.rectangle(module_box(0, 0, modules), fill=(160, 160, 160))
+    for x, y in ((0, 0), (modules - 7, 0), (0, modules - 7)):
+        draw.rectangle(module_box(x, y, 7), fill=(0, 0, 0))
+        draw.rectangle(module_box(x + 1, y + 1, 5), fill=background)
+        draw.rectangle(module_box(x + 2, y + 2, 3), fill=(0, 0, 0))
+    return img.transpose(Image.Transpose.ROTATE_180) if rotated else img
+
+def label_qr_image(profile, data_qr, background):
+    """
+    The QR code of a label drawn with a render profile.
+
+    Preview profiles (see preview_profile) get a qr_placeholder_image instead:
+    their QR codes are too small to scan, and encoding them would take most of
+    the time of a preview.
+
+    Args:
+        profile (RenderProfile): The render profile.
+        data_qr (str): The data to encode in the QR code.
+        background (tuple): The background RGB color.
+
+    Returns:
+        Image: The QR code image. It is shared by all callers, do not modify it.
+    """
+    if profile.qr_placeholder:
+        return qr_placeholder_image(profile.qr_version, profile.qr_scale, profile.qr_quiet_zone, background)
+    return generate_qr_image(data_qr, profile.qr_version, profile.qr_scale, profile.qr_quiet_zone, background, error=profile.qr_error)
+
+class ImageCache:
+    """
+    Least recently used cache of the images a function returns, bounded by their size in bytes.
+
+    Works like functools.lru_cache (cache_info, cache_clear), but big images
+    take more of the bound than small ones, so the memory it holds does not
+    grow with the PPI. The images are keyed on all arguments, render profile
+    included, and the bookkeeping is locked so threads can share the cache.
+    """
+
+    def __init__(self, function, max_bytes):
+        update_wrapper(self, function)
+        self.function = function
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, *args):
+        with self.lock:
+            image = self.images.get(args)
+            if image is not None:
+                self.images.move_to_end(args)
+                self.hits += 1
+                return image
+            self.misses += 1
+        image = self.function(*args)
+        with self.lock:
+            if args not in self.images:
+                self.images[args] = image
+                self.bytes += image.width * image.height * len(image.getbands())
+                self.evict()
+        return image
+
+    def evict(self):
+        """Drop the least recently used images until the cache fits its bound, the newest one stays."""
+        while self.bytes > self.max_bytes and len(self.images) > 1:
+            _, image = self.images.popitem(last=False)
+            self.bytes -= image.width * image.height * len(image.getbands())
+
+    def resize(self, max_bytes):
+        """Change the bound of the cache, e.g. for a run with a memory-mapped sheet canvas."""
+        with self.lock:
+            self.max_bytes = max_bytes
+            self.evict()
+
+    def cache_info(self):
+        """Hits, misses, the bound and the bytes held, see CacheInfo."""
+        return CacheInfo(self.hits, self.misses, self.max_bytes, self.bytes)
+
+    def cache_clear(self):
+        """Drop all images and reset the statistics."""
+        with self.lock:
+            self.images.clear()
+            self.bytes = 0
+            self.hits = 0
+            self.misses = 0
+
+def image_cache(max_bytes):
+    """
+    Cache the images a function returns in an ImageCache.
+
+    Args:
+        max_bytes (int): The bound of the cache in bytes.
+
+    Returns:
+        callable: The decorator.
+    """
+    return partial(ImageCache, max_bytes=max_bytes)
+
+@image_cache(max_bytes=LABEL_CACHE_BYTES)
+def render_label(kind, profile, data):
+    """
+    Render a label with the kind's draw_label, identical labels within a run are rendered once.
+
+    The label is kept as an RGB image, the sheets and printers do not use the
+    alpha channel and the cache holds a quarter more labels.
+
+    Args:
+        kind (LabelKind): The label kind.
+        profile (RenderProfile): The render profile.
+        data (tuple): The drawing arguments from kind.label_data.
+
+    Returns:
+        Image: The label image. It is shared by all callers, do not modify it.
+    """
+    return kind.draw_label(profile, *data).convert('RGB')
+
+def draw_dotted_lines(canvas, start_x, start_y, end_x, end_y, dash_length=5, gap_length=5):
+    """
+    Draw dotted lines between two points.
+
+    Dashes cover the same pixels as ImageDraw.line with width 1 (coordinates
+    are truncated and both ends included), so the sheets look the same as
+    when they were drawn with Pillow. Only horizontal and vertical lines
+    are supported.
+
+    Args:
+        canvas (ndarray): The sheet canvas, an RGB array of shape (height, width, 3).
+        start_x (int): The starting x-coordinate.
+        start_y (int): The starting y-coordinate.
+        end_x (int): The ending x-coordinate.
+        end_y (int): The ending y-coordinate.
+        dash_length (int): The length of each dash.
+        gap_length (int): The length of the gap between dashes.
+    """
+    total_length = ((end_x - start_x) ** 2 + (end_y - start_y) ** 2) ** 0.5
+    dashes = int(total_length // (dash_length + gap_length))
+
+    for i in range(dashes):
+        start = i * (dash_length + gap_length)
+        end = start + dash_length
+        x = start_x + (end_x - start_x) * (start / total_length)
+        y = start_y + (end_y - start_y) * (start / total_length)
+        x_end = start_x + (end_x - start_x) * (end / total_length)
+        y_end = start_y + (end_y - start_y) * (end / total_length)
+        x1, x2 = sorted((max(int(x), 0), max(int(x_end), 0)))
+        y1, y2 = sorted((max(int(y), 0), max(int(y_end), 0)))
+        canvas[y1:y2 + 1, x1:x2 + 1] = 0
+
+def new_sheet_canvas(width, height, color, memmap_dir=None):
+    """
+    Create the canvas of an A4 sheet as an RGB NumPy array.
+
+    Args:
+        width (int): The sheet width in pixels.
+        height (int): The sheet height in pixels.
+        color (tuple): The background RGB color.
+        memmap_dir (str): Directory for a memory-mapped canvas file, None keeps the canvas in RAM.
+
+    Returns:
+        ndarray: The canvas of shape (height, width, 3), a np.memmap if memmap_dir is set.
+    """
+    if memmap_dir is None:
+        canvas = np.empty((height, width, 3), dtype=np.uint8)
+    else:
+        # Anonymous temporary file, removed as soon as the canvas is released
+        os.makedirs(memmap_dir, exist_ok=True)
+        with tempfile.TemporaryFile(dir=memmap_dir) as canvas_file:
+            canvas = np.memmap(canvas_file, dtype=np.uint8, mode='w+', shape=(height, width, 3))
+    canvas[:] = color
+    return canvas
+
+def label_to_array(label_img):
+    """
+    View a label image as an RGB array without converting its mode.
+
+    Args:
+        label_img (Image): The label image, RGB or RGBA (the alpha channel is ignored).
+
+    Returns:
+        ndarray: The label pixels of shape (height, width, 3).
+    """
+    if label_img.mode not in ('RGB', 'RGBA'):
+        label_img = label_img.convert('RGB')
+    return np.asarray(label_img)[:, :, :3]
+
+def paste_label(canvas, label, x, y):
+    """
+    Paste a label onto the sheet canvas, clipped to the canvas on all sides like Image.paste.
+
+    Args:
+        canvas (ndarray): The sheet canvas.
+        label (ndarray): The label pixels, see label_to_array.
+        x (int): The left edge of the label on the sheet.
+        y (int): The top edge of the label on the sheet.
+    """
+    # Cut off the parts of the label left of, above, right of and below the canvas
+    left, top = max(0, -x), max(0, -y)
+    right = min(label.shape[1], canvas.shape[1] - x)
+    bottom = min(label.shape[0], canvas.shape[0] - y)
+    if left >= right or top >= bottom:
+        return
+    canvas[y + top:y + bottom, x + left:x + right] = label[top:bottom, left:right]
+
+@timed_stage('compose_seconds')
+def compose_label(canvas, label, slot, positions):
+    """
+    Write a label into its cell of the sheet canvas.
+
+    Args:
+        canvas (ndarray): The sheet canvas.
+        label (ndarray): The label pixels, see label_to_array.
+        slot (int): The number of the cell on the sheet, row by row from 0.
+        positions (list): The (x, y) of each label cell on the sheet, row by row.
+    """
+    x, y = positions[slot]
+    paste_label(canvas, label, x, y)
+
+def iter_canvas_rows(canvas, strip_rows=SHEET_STRIP_ROWS):
+    """
+    Read the rows of a canvas strip by strip.
+
+    Args:
+        canvas (ndarray): The sheet canvas.
+        strip_rows (int): The number of rows read from the canvas at once.
+
+    Yields:
+        bytes: The packed RGB pixels of each row.
+    """
+    for top in range(0, canvas.shape[0], strip_rows):
+        strip = np.ascontiguousarray(canvas[top:top + strip_rows])
+        for row in strip:
+            yield row.tobytes()
+
+@timed_stage('encode_seconds')
+def save_sheet_canvas(canvas, filename, dpi=None):
+    """
+    Save the sheet canvas as a PNG file.
+
+    A memory-mapped canvas is encoded in strips with pypng, so the sheet is
+    never loaded into RAM as a whole. A canvas in RAM is saved with Pillow.
+
+    Args:
+        canvas (ndarray): The sheet canvas.
+        filename (str): The PNG filename.
+        dpi (tuple): Optional (x, y) resolution stored in the file.
+    """
+    if isinstance(canvas, np.memmap):
+        height, width = canvas.shape[:2]
+        resolution = {}
+        if dpi is not None:
+            # Same pixels per meter as Pillow writes for dpi
+            resolution = dict(x_pixels_per_unit=int(dpi[0] / 0.0254 + 0.5),
+                              y_pixels_per_unit=int(dpi[1] / 0.0254 + 0.5),
+                              unit_is_meter=True)
+        writer = png.Writer(width, height, greyscale=False, bitdepth=8, **resolution)
+        with open(filename, 'wb') as png_file:
+            writer.write_packed(png_file, iter_canvas_rows(canvas))
+    elif dpi is not None:
+        Image.fromarray(canvas).save(filename, dpi=dpi)
+    else:
+        Image.fromarray(canvas).save(filename)
+    count_metric('sheets')
+    count_metric('bytes_written', os.path.getsize(filename))
+
+def sheet_layout(profile, sheet, label_width, label_height):
+    """
+    Lay out the label cells of an A4 sheet.
+
+    Args:
+        profile (RenderProfile): The render profile.
+        sheet (SheetStyle): The sheet style of the label kind.
+        label_width (int): The label width in pixels.
+        label_height (int): The label height in pixels.
+
+    Returns:
+        SheetLayout: The sheet size, the grid and the position of each label.
+    """
+    # A4 sheet dimensions in pixels
+    #a4_width = 2480
+    #a4_height = 3508
+    a4_width = round(210 * profile.mm_to_pixels)
+    a4_height = round(297 * profile.mm_to_pixels)
+
+    # margin from left right edge
+    side_mergin_px = profile.side_mergin * profile.mm_to_pixels
+
+    # Calculate the number of rows and columns for the labels
+    num_cols = sheet.num_cols
+    num_rows = sheet.num_rows
+
+    # Calculate the spacing between labels
+    cell_width = round((a4_width - side_mergin_px) // num_cols)
+    label_spacing_x = (cell_width - label_width) // 2
+    label_spacing_y = (a4_height - (num_rows * label_height)) // (num_rows + 1)
+
+    # Positions of the labels on a sheet, row by row, the same on every sheet
+    positions = [(round(side_mergin_px // 2 + label_spacing_x + (col * (label_width + label_spacing_x * 2))),
+                  label_spacing_y + (row * (label_height + label_spacing_y)))
+                 for row in range(num_rows) for col in range(num_cols)]
+
+    return SheetLayout(a4_width, a4_height, num_cols, num_rows, side_mergin_px, label_spacing_x, label_spacing_y, positions)
+
+def draw_cut_lines(canvas, layout, sheet, label_width, label_height, outer):
+    """
+    Draw the dotted cut lines between the label cells of a sheet.
+
+    Args:
+        canvas (ndarray): The sheet canvas.
+        layout (SheetLayout): The layout of the sheet.
+        sheet (SheetStyle): The sheet style, for the dashes of the lines.
+        label_width (int): The label width in pixels.
+        label_height (int): The label height in pixels.
+        outer (bool): Whether the vertical lines at the left and right edge are drawn too.
+    """
+    a4_width, a4_height, num_cols, num_rows, side_mergin_px, label_spacing_x, label_spacing_y, _ = layout
+    dashes = dict(dash_length=sheet.dash_length, gap_length=sheet.gap_length)
+    for i in range(0, num_rows + 1):
+        y_line = label_spacing_y + (i * (label_height + label_spacing_y)) - label_spacing_y // 2
+        draw_dotted_lines(canvas, 0, y_line, a4_width, y_line, **dashes)
+    first_col, last_col = (0, num_cols + 1) if outer else (1, num_cols)
+    for i in range(first_col, last_col):
+        x_line = side_mergin_px // 2 + label_spacing_x + (i * (label_width + label_spacing_x * 2)) - label_spacing_x
+        draw_dotted_lines(canvas, x_line, 0, x_line, a4_height, **dashes)
+
+def place_labels_on_a4_sheet(kind, profile, labels, output_filename, memmap_dir=None, first_sheet=1, last=True, sheet_saved=None):
+    """
+    Place labels on an A4 sheet.
+
+    The sheet is composed in a NumPy canvas that is reused for every sheet.
+    Each label is written into its cell of the canvas as soon as it arrives
+    (see compose_label), no other copy of the sheet is kept. With memmap_dir
+    the canvas is a memory-mapped file and sheets are saved in strips, so
+    high PPI runs need only a few strips and one label of RAM per sheet.
+
+    Args:
+        kind (LabelKind): The label kind, its sheet style sets the grid and the cut lines.
+        profile (RenderProfile): The render profile the labels were drawn with.
+        labels (iterable): Label images, a list or a generator yielding them one by one.
+        output_filename (str): The filename to save the A4 sheet to.
+        memmap_dir (str): Directory for the memory-mapped canvas file, None keeps the canvas in RAM.
+        first_sheet (int): The number of the first sheet, sharded runs continue the numbering of earlier chunks.
+        last (bool): Whether these labels end the run. Unless the sheet style draws them on every
+            sheet, only the last sheet of a run gets the outer cut lines.
+        sheet_saved (callable): Called with the number of each sheet once it is saved, e.g. to record a checkpoint.
+
+    Returns:
+        int: The number of the last saved sheet, first_sheet - 1 when there are no labels.
+    """
+    sheet = kind.sheet
+
+    # Take the first label image to get its dimensions, no labels save no sheet
+    labels = iter(labels)
+    label_img = next(labels, None)
+    if label_img is None:
+        return first_sheet - 1
+    label_width, label_height = label_img.size
+
+    # Lay out the labels on the sheet, the same on every sheet
+    layout = sheet_layout(profile, sheet, label_width, label_height)
+    a4_width, a4_height, num_cols, num_rows, side_mergin_px, label_spacing_x, label_spacing_y, positions = layout
+
+    # Create a new image for the A4 sheet, the sheet style may give later sheets of a run another background
+    later_sheet_color = sheet.later_sheet_color or profile.back_color
+    a4_sheet = new_sheet_canvas(a4_width, a4_height, profile.back_color if first_sheet == 1 else later_sheet_color, memmap_dir)
+
+    labels_per_sheet = num_cols * num_rows
+
+    sheet_index = first_sheet
+    slot = 0
+    previous_img = label = None
+
+    # Place the labels on the A4 sheet
+    for label_img in chain([label_img], labels):
+        # Create a new A4 sheet if necessary
+        if slot == labels_per_sheet:
+            draw_cut_lines(a4_sheet, layout, sheet, label_width, label_height, sheet.outer_lines_every_sheet)
+
+            save_sheet_canvas(a4_sheet, f'{output_filename}_{sheet_index}.png')
+            if sheet_saved is not None:
+                sheet_saved(sheet_index)
+            sheet_index += 1
+            a4_sheet[:] = later_sheet_color
+            slot = 0
+
+        # Copies of a label are the same image, its pixels are read once
+        if label_img is not previous_img:
+            label = label_to_array(label_img)
+            previous_img = label_img
+        compose_label(a4_sheet, label, slot, positions)
+        slot += 1
+
+    # Draw the final dotted lines, the outer ones only when the run ends here
+    draw_cut_lines(a4_sheet, layout, sheet, label_width, label_height, last or sheet.outer_lines_every_sheet)
+
+    dpi = (profile.ppi, profile.ppi) if last and sheet.last_sheet_dpi else None
+    save_sheet_canvas(a4_sheet, f'{output_filename}_{sheet_index}.png', dpi=dpi)
+    if sheet_saved is not None:
+        sheet_saved(sheet_index)
+    return sheet_index
+
+def zpl_escape(text):
+    """
+    Hex-escape the characters ZPL would interpret, for fields sent with ^FH.
+
+    Args:
+        text (str): The field data.
+
+    Returns:
+        str: The data with '^', '~', '_' and control characters (line breaks) as _XX.
+    """
+    return ''.join(f'_{ord(char):02X}' if char in '^~_' or ord(char) < 32 else char for char in text)
+
+@timed_stage('encode_seconds')
+def encode_zpl(profile, width, height, fields, copies=1):
+    """
+    Encode a label as ZPL with native QR code and text fields.
+
+    Args:
+        profile (RenderProfile): The render profile, for the QR error correction level.
+        width (int): The label width in dots.
+        height (int): The label height in dots.
+        fields (list): PrintField entries of the label.
+        copies (int): The number of copies to print.
+
+    Returns:
+        bytes: The ZPL label format.
+    """
+    # UTF-8 field data, the label origin at the top-left corner
+    commands = ['^XA', '^CI28', f'^PW{width}', f'^LL{height}', '^LH0,0']
+    for field in fields:
+        x, y = round(field.x), round(field.y)
+        if field.kind == 'qr':
+            # Model 2 QR code, error correction level and automatic input mode in the data prefix.
+            # The magnification is a whole number of dots per module.
+            magnification = min(max(round(field.size), ZPL_QR_MAGNIFICATIONS[0]), ZPL_QR_MAGNIFICATIONS[-1])
+            commands.append(f'^FO{x},{y}^BQN,2,{magnification}^FH^FD{profile.qr_error}A,{zpl_escape(field.data)}^FS')
+        else:
+            orientation = 'I' if field.inverted else 'N'
+            commands.append(f'^FO{x},{y}^A0{orientation},{field.size}^FH^FD{zpl_escape(field.data)}^FS')
+    if copies != 1:
+        commands.append(f'^PQ{copies}')
+    commands.append('^XZ')
+    return ('\n'.join(commands) + '\n').encode('utf-8')
+
+def label_to_monochrome(label_img, black_bit):
+    """
+    Convert a label image to 1 bit per pixel for a thermal printer.
+
+    Args:
+        label_img (Image): The label image.
+        black_bit (int): 1 if set bits print black (ZPL), 0 if cleared bits do (TSPL).
+
+    Returns:
+        Image: A mode '1' image, no dithering, light label colors print white.
+    """
+    black, white = (255, 0) if black_bit else (0, 255)
+    return label_img.convert('L').point(lambda value: black if value < MONOCHROME_THRESHOLD else white, '1')
+
+@timed_stage('encode_seconds')
+def encode_zpl_grf(label_img, copies=1):
+    """
+    Encode a rendered label as a compressed ZPL graphic field (^GFA with Z64 data).
+
+    Args:
+        label_img (Image): The label image.
+        copies (int): The number of copies to print.
+
+    Returns:
+        bytes: The ZPL label format.
+    """
+    mono = label_to_monochrome(label_img, black_bit=1)
+    width, height = mono.size
+    row_bytes = (width + 7) // 8
+    data = mono.tobytes()
+    z64 = base64.b64encode(zlib.compress(data)).decode('ascii')
+    crc = binascii.crc_hqx(z64.encode('ascii'), 0)
+
+    commands = ['^XA', f'^PW{width}', f'^LL{height}', '^LH0,0',
+                f'^FO0,0^GFA,{len(data)},{len(data)},{row_bytes},:Z64:{z64}:{crc:04x}^FS']
+    if copies != 1:
+        commands.append(f'^PQ{copies}')
+    commands.append('^XZ')
+    return ('\n'.join(commands) + '\n').encode('ascii')
+
+@timed_stage('encode_seconds')
+def encode_tspl_bitmap(profile, label_img, copies=1):
+    """
+    Encode a rendered label as a TSPL job printing a 1 bit BITMAP.
+
+    Args:
+        profile (RenderProfile): The render profile, for the label size in mm.
+        label_img (Image): The label image.
+        copies (int): The number of copies to print.
+
+    Returns:
+        bytes: The TSPL commands.
+    """
+    mono = label_to_monochrome(label_img, black_bit=0)
+    width, height = mono.size
+    row_bytes = (width + 7) // 8
+    header = (f'SIZE {width * profile.pixels_to_mm:.1f} mm,{height * profile.pixels_to_mm:.1f} mm\r\n'
+              f'GAP {PRINTER_GAP} mm,0 mm\r\n'
+              'CLS\r\n'
+              f'BITMAP 0,0,{row_bytes},{height},0,')
+    return header.encode('ascii') + mono.tobytes() + f'\r\nPRINT 1,{copies}\r\n'.encode('ascii')
+
+def open_printer_output(target):
+    """
+    Open the destination of a printer job.
+
+    Args:
+        target (str): 'tcp://host:port' for a raw printer socket (port 9100
+            if omitted), anything else is the path of a job file.
+
+    Returns:
+        file: A binary file object, close it to finish the job.
+    """
+    if target.startswith('tcp://'):
+        host, _, port = target[len('tcp://'):].partition(':')
+        connection = socket.create_connection((host, int(port or 9100)))
+        try:
+            return connection.makefile('wb')
+        finally:
+            # The socket stays open until the file object is closed
+            connection.close()
+    return open(target, 'wb')
+
+def generate_labels(kind, profile, rows):
+    """
+    Render a label image for each row.
+
+    Args:
+        kind (LabelKind): The label kind.
+        profile (RenderProfile): The render profile.
+        rows (iterable): kind.row_type records.
+
+    Yields:
+        Image: The label image for each row, rendered only when requested and
+        repeated as many times as the Copies column asks for. The progress is
+        counted in the run metrics and printed now and then, see report_progress.
+    """
+    for row in rows:
+        # Generate the label image once, however many copies are requested
+        label_img = render_label(kind, profile, kind.label_data(row))
+        copies = parse_copies(row)
+        count_metric('rows')
+        count_metric('labels', copies)
+        report_progress()
+        for _ in range(copies):
+            yield label_img
+
+def decode_qr_codes(pixels):
+    """
+    Decode every QR code found in a label with OpenCV's ArUco based QR code
+    detector, which finds small codes more reliably than the classic one.
+
+    Args:
+        pixels (ndarray): The grayscale label pixels.
+
+    Returns:
+        list: The decoded payloads, codes that were found but not decoded are left out.
+    """
+    import cv2
+
+    found, payloads, _, _ = cv2.QRCodeDetectorAruco().detectAndDecodeMulti(pixels)
+    return [payload for payload in payloads if payload] if found else []
+
+def verify_sheet(sheet_filename, label_size, cells):
+    """
+    Scan the QR codes on one saved sheet and compare them with the source rows.
+
+    Runs in a worker process of verify_sheets.
+
+    Args:
+        sheet_filename (str): The sheet PNG file.
+        label_size (tuple): The (width, height) of a label in pixels.
+        cells (list): The ((x, y), payloads) of each label on the sheet, see LabelKind.qr_payloads.
+
+    Returns:
+        list: A ScanMismatch for each label whose codes do not decode to its payloads.
+    """
+    sheet = np.asarray(Image.open(sheet_filename).convert('L'))
+    label_width, label_height = label_size
+    mismatches = []
+    for slot, ((x, y), payloads) in enumerate(cells, start=1):
+        decoded = decode_qr_codes(sheet[y:y + label_height, x:x + label_width])
+        if sorted(decoded) != sorted(payloads):
+            mismatches.append(ScanMismatch(sheet_filename, slot, payloads, tuple(decoded)))
+    return mismatches
+
+def verify_sheets(kind, csv_filename, output_dir, workers=VERIFY_WORKERS, profile=None):
+    """
+    Check that every QR code on the saved sheets scans to the data of its row.
+
+    The rows are read and sorted again to know which label is in which cell,
+    then the sheets are scanned in parallel, one sheet per task.
+
+    Args:
+        kind (LabelKind): The label kind.
+        csv_filename (str): The input file the sheets were generated from.
+        output_dir (str): The directory with the generated sheets.
+        workers (int): The number of worker processes, None uses all CPUs.
+        profile (RenderProfile): The profile the sheets were rendered with, None for the kind's default profile.
+
+    Returns:
+        list: ScanMismatch records, empty when every label scans correctly.
+    """
+    profile = profile or kind.default_profile
+    rows = read_sorted_rows(kind, csv_filename)
+    first_row = next(rows, None)
+    if first_row is None:
+        return []
+
+    # The cells of a sheet depend only on the label size
+    label_size = render_label(kind, profile, kind.label_data(first_row)).size
+    layout = sheet_layout(profile, kind.sheet, *label_size)
+    labels_per_sheet = layout.num_cols * layout.num_rows
+    payloads = (kind.qr_payloads(row) for row in chain([first_row], rows) for _ in range(parse_copies(row)))
+
+    output_filename = os.path.join(output_dir, "labels_a4_sheet")
+    sheet_filenames = []
+    sheet_cells = []
+    while True:
+        sheet_payloads = list(islice(payloads, labels_per_sheet))
+        if not sheet_payloads:
+            break
+        sheet_filenames.append(f'{output_filename}_{len(sheet_filenames) + 1}.png')
+        sheet_cells.append(list(zip(layout.positions, sheet_payloads)))
+
+    mismatches = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for sheet_mismatches in executor.map(verify_sheet, sheet_filenames, repeat(label_size), sheet_cells):
+            mismatches.extend(sheet_mismatches)
+
+    for mismatch in mismatches:
+        print(f"{mismatch.sheet} label {mismatch.slot}: expected {mismatch.expected!r}, scanned {mismatch.decoded!r}")
+    print(f"Verified {len(sheet_filenames)} sheets, {len(mismatches)} labels do not scan correctly.")
+    return mismatches
+
+def cached_functions(kind):
+    """The LRU cached functions whose hit rates are part of the run metrics."""
+    return dict((('qr', generate_qr_image), ('label', render_label), ('text_width', text_width)) + kind.caches)
+
+def reset_run_metrics(kind):
+    """
+    Start counting the metrics of a new run in the current thread.
+
+    Only the thread's counters are reset; the stages it is timing keep running.
+    """
+    now = time.perf_counter()
+    run_state.metrics = dict(start=now, last_progress=now, rows=0, labels=0, sheets=0, bytes_written=0,
+                             cache_start={name: function.cache_info() for name, function in cached_functions(kind).items()})
+
+def report_progress(force=False):
+    """
+    Print the progress of the run, at most once every PROGRESS_INTERVAL seconds.
+
+    Args:
+        force (bool): Print even if the last progress line is recent, e.g. at the end of a run.
+    """
+    run_metrics = run_state.metrics
+    if 'start' not in run_metrics:
+        now = time.perf_counter()
+        run_metrics.update(start=now, last_progress=now, rows=0, labels=0, sheets=0, bytes_written=0)
+    now = time.perf_counter()
+    if not force and now - run_metrics['last_progress'] < PROGRESS_INTERVAL:
+        return
+    run_metrics['last_progress'] = now
+    elapsed = max(now - run_metrics['start'], 1e-9)
+    print(f"{run_metrics['rows']} rows, {run_metrics['labels']} labels, {run_metrics['sheets']} sheets "
+          f"in {elapsed:.1f} s ({run_metrics['labels'] / elapsed:.0f} labels/s)")
+
+def peak_rss_bytes():
+    """Peak resident set size of the process in bytes, None where the resource module is missing (Windows)."""
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024
+
+def collect_run_metrics(kind, input_filename):
+    """
+    Summarize the metrics of the current run.
+
+    Args:
+        kind (LabelKind): The label kind of the run.
+        input_filename (str): The input file of the run.
+
+    The caches are shared by all threads, so while runs overlap in several
+    threads their cache hit rates count each other's lookups.
+
+    Returns:
+        dict: Rates, totals, peak RSS, the time spent in each stage and the cache hit rates
+        (None for caches that were not used).
+    """
+    if 'cache_start' not in run_state.metrics:
+        reset_run_metrics(kind)
+    run_metrics = run_state.metrics
+    elapsed = max(time.perf_counter() - run_metrics['start'], 1e-9)
+    metrics = {
+        'generator': kind.name,
+        'input': input_filename,
+        'timestamp': round(time.time(), 3),
+        'seconds': round(elapsed, 3),
+        'rows': run_metrics['rows'],
+        'labels': run_metrics['labels'],
+        'sheets': run_metrics['sheets'],
+        'labels_per_second': round(run_metrics['labels'] / elapsed, 3),
+        'sheets_per_second': round(run_metrics['sheets'] / elapsed, 3),
+        'bytes_written': run_metrics['bytes_written'],
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+    for stage in ('qr_seconds', 'shape_seconds', 'text_seconds', 'compose_seconds', 'encode_seconds'):
+        metrics[stage] = round(run_metrics.get(stage, 0.0), 3)
+    for name, function in cached_functions(kind).items():
+        info, start = function.cache_info(), run_metrics['cache_start'][name]
+        hits = info.hits - start.hits
+        lookups = hits + info.misses - start.misses
+        metrics[f'{name}_cache_hit_rate'] = round(hits / lookups, 4) if lookups else None
+    return metrics
+
+def write_run_metrics(metrics_file, metrics):
+    """
+    Write the metrics of a run as a JSON line or as a Prometheus text file.
+
+    A file ending in '.prom' is replaced with the numeric metrics as gauges
+    in the Prometheus text format, e.g. for node_exporter's textfile
+    collector. Any other file gets the metrics appended as one JSON line.
+
+    Args:
+        metrics_file (str): The metrics file.
+        metrics (dict): The metrics, see collect_run_metrics.
+    """
+    if not metrics_file.endswith('.prom'):
+        with open(metrics_file, 'a', encoding='utf-8') as json_file:
+            json_file.write(json.dumps(metrics) + '\n')
+        return
+
+    lines = []
+    for name, value in metrics.items():
+        if isinstance(value, (int, float)) and name != 'timestamp':
+            lines.append(f'# TYPE label_run_{name} gauge')
+            lines.append(f'label_run_{name}{{generator="{metrics["generator"]}"}} {value}')
+    with open(metrics_file + '.tmp', 'w', encoding='utf-8') as prom_file:
+        prom_file.write('\n'.join(lines) + '\n')
+    os.replace(metrics_file + '.tmp', metrics_file)
+
+def build_render_profile(name, settings, profile_geometry, qr_placeholder=False):
+    """
+    Create a render profile from its settings and derive its pixel geometry.
+
+    Args:
+        name (str): The profile name.
+        settings (dict): The profile settings by lower case PROFILE_SETTINGS name.
+        profile_geometry (callable): The label kind's function deriving its own geometry from the settings.
+        qr_placeholder (bool): Draw placeholders instead of QR codes, see label_qr_image.
+
+    Returns:
+        RenderProfile: The profile.
+
+    Raises:
+        ValueError: If profile_geometry finds that the parts of the label do not fit into it.
+    """
+    settings = dict(settings, mm_to_pixels=settings['ppi'] / 25.4, pixels_to_mm=25.4 / settings['ppi'],
+                    qr_placeholder=qr_placeholder)
+    try:
+        settings.update(profile_geometry(settings))
+    except ValueError as error:
+        raise ValueError(f"Render profile '{name}': {error}") from None
+    return RenderProfile(name, settings)
+
+def compile_render_profile(kind, name, options):
+    """
+    Validate a render profile and precompute its pixel geometry and label font.
+
+    Args:
+        kind (LabelKind): The label kind, its profile_settings are the settings a profile may set.
+        name (str): The profile name, used in error messages.
+        options (dict): The profile settings by lower case PROFILE_SETTINGS name, missing ones keep the defaults.
+
+    Returns:
+        RenderProfile: The compiled profile.
+
+    Raises:
+        ValueError: If a setting is unknown or invalid, the parts of the label do not fit into it
+            (see the kind's profile_geometry) or the font cannot be loaded.
+    """
+    unknown = sorted(set(options) - {setting.lower() for setting in kind.profile_settings})
+    if unknown:
+        raise ValueError(f"Render profile '{name}': unknown settings {', '.join(unknown)}")
+
+    settings = {}
+    for setting in kind.profile_settings:
+        key = setting.lower()
+        value = options.get(key, kind.default_profile.settings[key])
+        if setting.endswith('_COLOR'):
+            # A color name or [r, g, b], TOML has no tuples
+            if isinstance(value, list):
+                value = tuple(value)
+            try:
+                rgb = convert_color(value)
+            except ValueError:
+                rgb = None
+            if not (isinstance(rgb, tuple) and len(rgb) == 3 and all(type(c) is int and 0 <= c <= 255 for c in rgb)):
+                raise ValueError(f"Render profile '{name}': {key} must be a color name or [r, g, b], not {value!r}")
+        elif setting == 'QR_ERROR':
+            if value not in ('L', 'M', 'Q', 'H'):
+                raise ValueError(f"Render profile '{name}': qr_error must be L, M, Q or H, not {value!r}")
+        elif setting == 'FONT_TYPE':
+            if not isinstance(value, str):
+                raise ValueError(f"Render profile '{name}': font_type must be a font file, not {value!r}")
+        else:
+            number = int if setting in PROFILE_INTEGER_SETTINGS else (int, float)
+            positive = setting not in kind.zero_settings
+            if isinstance(value, bool) or not isinstance(value, number) or value < 0 or (positive and value == 0):
+                kind_name = 'whole number' if number is int else 'number'
+                raise ValueError(f"Render profile '{name}': {key} must be a "
+                                 f"{'positive' if positive else 'non-negative'} {kind_name}, not {value!r}")
+            if setting == 'QR_VERSION' and value > 40:
+                raise ValueError(f"Render profile '{name}': qr_version must be 1 to 40, not {value}")
+        settings[key] = value
+    profile = build_render_profile(name, settings, kind.profile_geometry)
+
+    try:
+        profile.font
+    except OSError as error:
+        raise ValueError(f"Render profile '{name}': cannot load font {profile.font_type!r}") from error
+    return profile
+
+@lru_cache(maxsize=None)
+def load_render_profiles(kind, profiles_filename):
+    """
+    Read and compile the render profiles of a TOML file, once per file.
+
+    Each table of the file is a profile, e.g.
+
+        [thermal-203]
+        ppi = 203
+        label_color = "white"
+        back_color = [255, 255, 255]
+
+    Args:
+        kind (LabelKind): The label kind the profiles are for.
+        profiles_filename (str): The TOML file.
+
+    Returns:
+        dict: The RenderProfile of each table by name.
+
+    Raises:
+        ValueError: If the file has settings outside a table or a profile is invalid.
+    """
+    try:
+        import tomllib
+    except ImportError:  # Python < 3.11
+        import tomli as tomllib
+
+    with open(profiles_filename, 'rb') as profiles_file:
+        tables = tomllib.load(profiles_file)
+    profiles = {}
+    for name, options in tables.items():
+        if not isinstance(options, dict):
+            raise ValueError(f"{profiles_filename}: '{name}' is not a profile table")
+        profiles[name] = compile_render_profile(kind, name, options)
+    return profiles
+
+def preview_profile(kind, profile=None, ppi=PREVIEW_PPI):
+    """
+    Compile a render profile that previews a profile at a lower resolution.
+
+    The geometry in mm stays the same, the font size and the QR module size are
+    scaled by ppi / PPI, and the fonts are loaded once at the low size. The QR
+    codes are drawn as placeholders of their size, see label_qr_image. The
+    settings were validated with the previewed profile, only its geometry is
+    derived and checked again at the low size.
+
+    Args:
+        kind (LabelKind): The label kind.
+        profile (RenderProfile): The previewed profile, None previews the kind's default profile.
+        ppi (int): The preview resolution.
+
+    Returns:
+        RenderProfile: The preview profile.
+    """
+    profile = profile or kind.default_profile
+    scale = ppi / profile.ppi
+    settings = {setting.lower(): profile.settings[setting.lower()] for setting in kind.profile_settings}
+    settings.update(ppi=ppi, font_size=max(1, round(profile.font_size * scale)), qr_scale=profile.qr_scale * scale)
+    return build_render_profile(f'{profile.name}-preview-{ppi}', settings, kind.profile_geometry, qr_placeholder=True)
+
+def skip_labels(rows, label_count):
+    """
+    Skip the first labels of a run without rendering them.
+
+    Args:
+        rows (iterable): Row records in label order.
+        label_count (int): The number of labels to skip, copies count one each.
+
+    Yields:
+        tuple: The remaining rows, the row cut in the middle with the copies left.
+    """
+    rows = iter(rows)
+    for row in rows:
+        copies = parse_copies(row)
+        if copies > label_count:
+            yield row._replace(copies=str(copies - label_count)) if label_count else row
+            break
+        label_count -= copies
+    yield from rows
+
+def profile_digest(profile):
+    """
+    Fingerprint the settings of a render profile.
+
+    Args:
+        profile (RenderProfile): The render profile.
+
+    Returns:
+        str: A hex digest that changes whenever a setting of the profile changes.
+    """
+    return hashlib.sha256(repr(profile.key).encode('utf-8')).hexdigest()
+
+def write_checkpoint(checkpoint_filename, kind, profile, csv_filename, output_filename, labels_per_sheet, sheet_index):
+    """
+    Record the progress of a run every CHECKPOINT_SHEETS sheets.
+
+    The checkpoint is a JSON file with the input file's size and modification
+    time, the label kind, the render profile and its digest, the number of
+    labels per sheet, the number of finished sheets and labels and the sheet
+    files. It is written to a temporary file first and then replaced, so a
+    run that dies while writing it keeps the previous checkpoint.
+
+    Args:
+        checkpoint_filename (str): The checkpoint file.
+        kind (LabelKind): The label kind.
+        profile (RenderProfile): The render profile of the run.
+        csv_filename (str): The input file of the run.
+        output_filename (str): The sheet filename prefix, see place_labels_on_a4_sheet.
+        labels_per_sheet (int): The number of labels on a full sheet.
+        sheet_index (int): The number of the sheet just saved.
+    """
+    if not CHECKPOINT_SHEETS or sheet_index % CHECKPOINT_SHEETS:
+        return
+    input_stat = os.stat(csv_filename)
+    checkpoint = {
+        'input': csv_filename,
+        'input_size': input_stat.st_size,
+        'input_mtime': input_stat.st_mtime,
+        'kind': kind.name,
+        'profile': profile.name,
+        'profile_digest': profile_digest(profile),
+        'labels_per_sheet': labels_per_sheet,
+        'sheets': sheet_index,
+        'labels': sheet_index * labels_per_sheet,
+        'files': [f'{os.path.basename(output_filename)}_{index}.png' for index in range(1, sheet_index + 1)],
+    }
+    with open(checkpoint_filename + '.tmp', 'w', encoding='utf-8') as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(checkpoint_filename + '.tmp', checkpoint_filename)
+
+def read_checkpoint(checkpoint_filename, kind, profile, csv_filename, labels_per_sheet):
+    """
+    Read the number of finished sheets from the checkpoint of an earlier run.
+
+    Sheets listed in the checkpoint whose files are gone are rendered again.
+
+    Args:
+        checkpoint_filename (str): The checkpoint file.
+        kind (LabelKind): The label kind.
+        profile (RenderProfile): The render profile of the run.
+        csv_filename (str): The input file of the run.
+        labels_per_sheet (int): The number of labels on a full sheet.
+
+    Returns:
+        int: The number of sheets that do not need to be rendered again, 0 without a checkpoint.
+
+    Raises:
+        ValueError: If the input file changed since the checkpoint was written, or the
+            checkpoint was written by a run with another label kind, render profile or sheet layout.
+    """
+    if not os.path.exists(checkpoint_filename):
+        return 0
+    with open(checkpoint_filename, encoding='utf-8') as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+
+    input_stat = os.stat(csv_filename)
+    if (checkpoint['input_size'], checkpoint['input_mtime']) != (input_stat.st_size, input_stat.st_mtime):
+        raise ValueError(f"{csv_filename} changed since the checkpoint {checkpoint_filename} was written")
+    if checkpoint.get('kind') != kind.name:
+        raise ValueError(f"The checkpoint {checkpoint_filename} is for {checkpoint.get('kind')} labels, not {kind.name} labels")
+    if checkpoint.get('profile_digest') != profile_digest(profile):
+        raise ValueError(f"The checkpoint {checkpoint_filename} was written with the render profile "
+                         f"'{checkpoint.get('profile')}', its settings differ from the profile '{profile.name}'")
+    if (checkpoint.get('labels_per_sheet') != labels_per_sheet
+            or checkpoint['labels'] != checkpoint['sheets'] * labels_per_sheet):
+        raise ValueError(f"The checkpoint {checkpoint_filename} was written with {checkpoint.get('labels_per_sheet')} labels "
+                         f"per sheet, not {labels_per_sheet}")
+
+    output_dir = os.path.dirname(checkpoint_filename)
+    finished = 0
+    for sheet_filename in checkpoint['files']:
+        if not os.path.exists(os.path.join(output_dir, sheet_filename)):
+            break
+        finished += 1
+    return finished
+
+def process_csv_file(kind, csv_filename, output_dir, memmap_dir=None, verify=False, resume=False, metrics_file=METRICS_FILE, profile=None):
+    """
+    Process a CSV file and generate labels.
+
+    Rows are streamed from the file (see INPUT_READERS) and sorted with a
+    bounded memory buffer, then each label is placed on a sheet as soon as it
+    is rendered, so memory use does not grow with the size of the file.
+
+    Every CHECKPOINT_SHEETS sheets the progress is recorded in a checkpoint
+    file in output_dir, which is removed when the run completes. A run that
+    died can be resumed from its last checkpoint, the finished sheets are
+    kept and their rows are skipped without rendering.
+
+    Args:
+        kind (LabelKind): The label kind.
+        csv_filename (str): The filename of the CSV file, or of a Parquet, JSON or XLSX export.
+        output_dir (str): The directory to save the generated labels.
+        memmap_dir (str): Directory for a memory-mapped sheet canvas, see place_labels_on_a4_sheet.
+        verify (bool): Scan the saved sheets afterwards and report labels whose QR codes
+            do not match their rows, see verify_sheets.
+        resume (bool): Continue from the checkpoint of an earlier run of the same input, if there is one.
+        metrics_file (str): Write the run metrics to this file, see write_run_metrics.
+        profile (RenderProfile): The render profile, see load_render_profiles. None uses the kind's default profile.
+    """
+    profile = profile or kind.default_profile
+    reset_run_metrics(kind)
+    render_label.resize(LABEL_CACHE_BYTES if memmap_dir is None else MEMMAP_LABEL_CACHE_BYTES)
+    rows = read_sorted_rows(kind, csv_filename)
+
+    # Place the labels on an A4 sheet only if there are labels
+    first_row = next(rows, None)
+    if first_row is None:
+        print("No records found.")
+        return
+
+    output_filename = os.path.join(output_dir, "labels_a4_sheet")
+    checkpoint_filename = f'{output_filename}.checkpoint.json'
+    layout = sheet_layout(profile, kind.sheet, *render_label(kind, profile, kind.label_data(first_row)).size)
+    labels_per_sheet = layout.num_cols * layout.num_rows
+
+    # Skip the labels of the sheets finished by an earlier run
+    finished_sheets = read_checkpoint(checkpoint_filename, kind, profile, csv_filename, labels_per_sheet) if resume else 0
+    labels = generate_labels(kind, profile, skip_labels(chain([first_row], rows), finished_sheets * labels_per_sheet))
+
+    first_label = next(labels, None)
+    if first_label is not None:
+        os.makedirs(output_dir, exist_ok=True)
+        checkpoint = partial(write_checkpoint, checkpoint_filename, kind, profile, csv_filename, output_filename,
+                             labels_per_sheet)
+        place_labels_on_a4_sheet(kind, profile, chain([first_label], labels), output_filename, memmap_dir, finished_sheets + 1,
+                                 sheet_saved=checkpoint)
+    elif not finished_sheets:
+        print("No records found.")
+        return
+    if os.path.exists(checkpoint_filename):
+        os.remove(checkpoint_filename)
+
+    report_progress(force=True)
+    if metrics_file:
+        write_run_metrics(metrics_file, collect_run_metrics(kind, csv_filename))
+
+    if verify:
+        verify_sheets(kind, csv_filename, output_dir, profile=profile)
+
+def write_shard_chunk(kind, queue_dir, chunk_number, first_sheet, last, profile, rows):
+    """
+    Add a chunk of rows to the pending work queue.
+
+    The chunk is a JSON file with the row values and the profile settings,
+    data only, so a worker loading chunks from a shared directory runs no
+    code from it and rows of a script run as __main__ load in any worker.
+    It is written next to the queue and then renamed into it, so workers
+    never see a partly written chunk.
+
+    Args:
+        kind (LabelKind): The label kind, its name is recorded so workers of another kind reject the chunk.
+        queue_dir (str): The work queue directory.
+        chunk_number (int): The number of the chunk, chunks are claimed in this order.
+        first_sheet (int): The number of the first sheet of the chunk.
+        last (bool): Whether the chunk ends the run.
+        profile (RenderProfile): The render profile the chunk is rendered with.
+        rows (list): The row records of the chunk.
+    """
+    chunk = {
+        'kind': kind.name,
+        'first_sheet': first_sheet,
+        'last': last,
+        'profile': profile.name,
+        'settings': {setting.lower(): profile.settings[setting.lower()] for setting in kind.profile_settings},
+        'rows': [list(row) for row in rows],
+    }
+    chunk_name = f'chunk_{chunk_number:06d}.json'
+    temp_filename = os.path.join(queue_dir, chunk_name + '.tmp')
+    with open(temp_filename, 'w', encoding='utf-8') as chunk_file:
+        json.dump(chunk, chunk_file, ensure_ascii=False)
+    os.replace(temp_filename, os.path.join(queue_dir, 'pending', chunk_name))
+
+def read_shard_chunk(kind, chunk_filename):
+    """
+    Load a chunk of the work queue written by write_shard_chunk.
+
+    The profile is compiled from its settings again, so it is validated like
+    a profile of a TOML file, and the rows are rebuilt as kind.row_type records.
+
+    Args:
+        kind (LabelKind): The label kind of the worker.
+        chunk_filename (str): The chunk file.
+
+    Returns:
+        tuple: (first_sheet, last, profile, rows).
+
+    Raises:
+        ValueError: If the chunk is for another label kind or its rows do not fit the row type.
+    """
+    with open(chunk_filename, encoding='utf-8') as chunk_file:
+        chunk = json.load(chunk_file)
+    if chunk['kind'] != kind.name:
+        raise ValueError(f"{chunk_filename} holds {chunk['kind']} labels, not {kind.name} labels")
+    profile = compile_render_profile(kind, chunk['profile'], chunk['settings'])
+    field_count = len(kind.row_type._fields)
+    for values in chunk['rows']:
+        if len(values) != field_count or not all(isinstance(value, str) for value in values):
+            raise ValueError(f"{chunk_filename}: a row must be {field_count} strings, not {values!r}")
+    return chunk['first_sheet'], chunk['last'], profile, [kind.row_type._make(values) for values in chunk['rows']]
+
+def shard_csv_file(kind, csv_filename, queue_dir, sheets_per_chunk=SHARD_SHEETS, profile=None):
+    """
+    Split an input file into sheet-aligned chunks in a work queue directory.
+
+    The rows are sorted as for process_csv_file and cut every sheets_per_chunk
+    sheets, splitting the copies of a row across chunks when needed, so each
+    chunk knows the global number of its first sheet. The queue directory
+    (pending, claimed, done and sheets subdirectories) can be on a share
+    that workers on several hosts see, see run_shard_worker.
+
+    Args:
+        kind (LabelKind): The label kind.
+        csv_filename (str): The filename of the CSV file, or of a Parquet, JSON or XLSX export.
+        queue_dir (str): The work queue directory, empty or not existing yet.
+        sheets_per_chunk (int): The number of sheets rendered per chunk.
+        profile (RenderProfile): The render profile, stored with each chunk for the workers. None uses
+            the kind's default profile.
+
+    Returns:
+        int: The number of chunks, 0 when there are no labels.
+    """
+    profile = profile or kind.default_profile
+    # Rows with 0 copies add no labels, a file of only such rows queues no chunk
+    rows = (row for row in read_sorted_rows(kind, csv_filename) if parse_copies(row))
+    first_row = next(rows, None)
+    if first_row is None:
+        return 0
+
+    for queue_subdir in ('pending', 'claimed', 'done', 'sheets'):
+        os.makedirs(os.path.join(queue_dir, queue_subdir), exist_ok=True)
+
+    # The number of labels on a sheet depends only on the label size
+    layout = sheet_layout(profile, kind.sheet, *render_label(kind, profile, kind.label_data(first_row)).size)
+    chunk_labels = sheets_per_chunk * layout.num_cols * layout.num_rows
+
+    chunk_count = 0
+    chunk = []
+    labels_left = chunk_labels
+    for row in chain([first_row], rows):
+        copies = parse_copies(row)
+        while copies:
+            # A full chunk is written only once more labels follow, the last one is marked as such
+            if labels_left == 0:
+                write_shard_chunk(kind, queue_dir, chunk_count, chunk_count * sheets_per_chunk + 1, False, profile, chunk)
+                chunk_count += 1
+                chunk = []
+                labels_left = chunk_labels
+            chunk_copies = min(copies, labels_left)
+            chunk.append(row._replace(copies=str(chunk_copies)))
+            copies -= chunk_copies
+            labels_left -= chunk_copies
+
+    write_shard_chunk(kind, queue_dir, chunk_count, chunk_count * sheets_per_chunk + 1, True, profile, chunk)
+    return chunk_count + 1
+
+def claim_shard_chunk(queue_dir, worker_id):
+    """
+    Claim the next pending chunk of the work queue.
+
+    A chunk is claimed by renaming it into the claimed directory, which only
+    one worker can do, so workers on several hosts need no other locking.
+
+    Args:
+        queue_dir (str): The work queue directory.
+        worker_id (str): The name of the worker, added to the claimed file name.
+
+    Returns:
+        tuple: (chunk_name, claimed_filename), or None when no chunk is pending.
+    """
+    pending_dir = os.path.join(queue_dir, 'pending')
+    for chunk_name in sorted(os.listdir(pending_dir)):
+        claimed_filename = os.path.join(queue_dir, 'claimed', f'{chunk_name}.{worker_id}')
+        try:
+            os.rename(os.path.join(pending_dir, chunk_name), claimed_filename)
+        except FileNotFoundError:
+            # Another worker was faster
+            continue
+        return chunk_name, claimed_filename
+    return None
+
+def run_shard_worker(kind, queue_dir, memmap_dir=None):
+    """
+    Render chunks from the work queue until no chunk is pending.
+
+    Run it on every host (or in several processes) sharing the queue
+    directory. The sheets are saved in the queue's sheets directory under
+    their global numbers. A chunk left in the claimed directory by a worker
+    that died can be moved back to pending under its original name.
+
+    Args:
+        kind (LabelKind): The label kind.
+        queue_dir (str): The work queue directory, see shard_csv_file.
+        memmap_dir (str): Directory for a memory-mapped sheet canvas, see place_labels_on_a4_sheet.
+
+    Returns:
+        int: The number of chunks rendered by this worker.
+    """
+    reset_run_metrics(kind)
+    render_label.resize(LABEL_CACHE_BYTES if memmap_dir is None else MEMMAP_LABEL_CACHE_BYTES)
+    worker_id = f'{socket.gethostname()}-{os.getpid()}'
+    output_filename = os.path.join(queue_dir, 'sheets', "labels_a4_sheet")
+    rendered = 0
+    while True:
+        claimed = claim_shard_chunk(queue_dir, worker_id)
+        if claimed is None:
+            return rendered
+        chunk_name, claimed_filename = claimed
+
+        first_sheet, last, profile, rows = read_shard_chunk(kind, claimed_filename)
+        place_labels_on_a4_sheet(kind, profile, generate_labels(kind, profile, rows), output_filename, memmap_dir, first_sheet, last)
+
+        os.replace(claimed_filename, os.path.join(queue_dir, 'done', chunk_name))
+        rendered += 1
+
+def merge_shards(queue_dir, output_dir):
+    """
+    Move the sheets of a finished sharded run into the output directory.
+
+    Args:
+        queue_dir (str): The work queue directory, see shard_csv_file.
+        output_dir (str): The directory to save the generated labels.
+
+    Returns:
+        int: The number of sheets.
+
+    Raises:
+        RuntimeError: If chunks are still pending or claimed.
+    """
+    unfinished = len(os.listdir(os.path.join(queue_dir, 'pending'))) + len(os.listdir(os.path.join(queue_dir, 'claimed')))
+    if unfinished:
+        raise RuntimeError(f"{unfinished} chunks in {queue_dir} are not rendered yet")
+
+    os.makedirs(output_dir, exist_ok=True)
+    sheets_dir = os.path.join(queue_dir, 'sheets')
+    sheet_names = os.listdir(sheets_dir)
+    for sheet_name in sheet_names:
+        shutil.move(os.path.join(sheets_dir, sheet_name), os.path.join(output_dir, sheet_name))
+    return len(sheet_names)
+
+def process_csv_file_sharded(kind, csv_filename, output_dir, workers=SHARD_WORKERS, queue_dir=None, memmap_dir=None, profile=None):
+    """
+    Process a CSV file with several local worker processes sharing a work queue.
+
+    The same steps can be run on several hosts: shard_csv_file on one of
+    them, run_shard_worker on each and merge_shards once all chunks are done.
+
+    Args:
+        kind (LabelKind): The label kind.
+        csv_filename (str): The filename of the CSV file, or of a Parquet, JSON or XLSX export.
+        output_dir (str): The directory to save the generated labels.
+        workers (int): The number of worker processes, None uses all CPUs.
+        queue_dir (str): The work queue directory, None uses a temporary directory.
+        memmap_dir (str): Directory for a memory-mapped sheet canvas, see place_labels_on_a4_sheet.
+        profile (RenderProfile): The render profile, None uses the kind's default profile.
+
+    Returns:
+        int: The number of sheets.
+    """
+    if queue_dir is None:
+        with tempfile.TemporaryDirectory() as queue_dir:
+            return process_csv_file_sharded(kind, csv_filename, output_dir, workers, queue_dir, memmap_dir, profile)
+
+    if shard_csv_file(kind, csv_filename, queue_dir, profile=profile) == 0:
+        print("No records found.")
+        return 0
+
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(run_shard_worker, repeat(kind, workers), repeat(queue_dir, workers), repeat(memmap_dir, workers)))
+    return merge_shards(queue_dir, output_dir)
+
+def qr_min_version(data_qr, error):
+    """
+    Find the smallest QR code version that holds the data, as pyqrcode.create would.
+
+    Only pyqrcode's capacity tables are used, no code is built. Data that
+    pyqrcode would encode in kanji mode is counted as UTF-8 bytes, which
+    needs the same or a larger version.
+
+    Args:
+        data_qr (str): The data to encode in the QR code.
+        error (str): The error correction level.
+
+    Returns:
+        int: The version, 41 if the data does not fit into any version.
+    """
+    if data_qr.isdigit():
+        mode, length = 'numeric', len(data_qr)
+    elif all(char in pyqrcode.tables.ascii_codes for char in data_qr):
+        mode, length = 'alphanumeric', len(data_qr)
+    else:
+        mode, length = 'binary', len(data_qr.encode('utf-8'))
+    capacity = pyqrcode.tables.data_capacity
+    error = pyqrcode.tables.error_level[error]
+    mode_num = pyqrcode.tables.modes[mode]
+    return next((version for version in range(1, 41) if capacity[version][error][mode_num] >= length), 41)
+
+def preview_csv_file(kind, csv_filename, output_dir, ppi=PREVIEW_PPI, max_sheets=None, profile=None):
+    """
+    Render preview sheets of a CSV file directly at a low resolution.
+
+    The labels and sheets are laid out by the same code as process_csv_file, with
+    preview_profile settings, so a preview takes a fraction of the time of full
+    sheets and shows the same layout. The QR codes are placeholders of their size, see label_qr_image.
+
+    Args:
+        kind (LabelKind): The label kind.
+        csv_filename (str): The filename of the CSV file, or of a Parquet, JSON or XLSX export.
+        output_dir (str): The directory to save the preview sheets to.
+        ppi (int): The preview resolution.
+        max_sheets (int): Render only the first sheets, None renders all.
+        profile (RenderProfile): The previewed profile, None previews the kind's default profile.
+
+    Returns:
+        int: The number of preview sheets.
+    """
+    reset_run_metrics(kind)
+    profile = preview_profile(kind, profile, ppi)
+    labels = generate_labels(kind, profile, read_sorted_rows(kind, csv_filename))
+    first_label = next(labels, None)
+    if first_label is None:
+        print("No records found.")
+        return 0
+
+    labels = chain([first_label], labels)
+    if max_sheets is not None:
+        layout = sheet_layout(profile, kind.sheet, *first_label.size)
+        labels = islice(labels, max_sheets * layout.num_cols * layout.num_rows)
+    os.makedirs(output_dir, exist_ok=True)
+    sheets = place_labels_on_a4_sheet(kind, profile, labels, os.path.join(output_dir, "preview_a4_sheet"))
+    report_progress(force=True)
+    return sheets
+
+def dry_run_csv_file(kind, csv_filename, profile=None):
+    """
+    Check an input file before rendering it: sheet count, font fit and QR capacity.
+
+    The file goes through encoding detection and parsing as for
+    process_csv_file, each label is laid out from font metrics only (see
+    LabelKind.label_fields) and its QR payloads are checked against the
+    capacity of the profile's QR version. Nothing is rasterized and nothing is written.
+
+    Args:
+        kind (LabelKind): The label kind.
+        csv_filename (str): The filename of the CSV file, or of a Parquet, JSON or XLSX export.
+        profile (RenderProfile): The render profile, None uses the kind's default profile.
+
+    Returns:
+        DryRunReport: The row, label and sheet counts, the rows whose font is
+        smaller than MIN_FONT_PT and the QR payloads that do not fit the QR version.
+    """
+    profile = profile or kind.default_profile
+    row_count = 0
+    label_count = 0
+    label_size = None
+    small_fonts = []
+    qr_overflows = []
+    for row in read_input_rows(kind, csv_filename):
+        row_count += 1
+        label_count += parse_copies(row)
+
+        width, height, fields = kind.label_fields(profile, *kind.label_data(row))
+        label_size = label_size or (width, height)
+        font_pt = min((field.size for field in fields if field.kind == 'text'), default=profile.font_size) * 72 / profile.ppi
+        if font_pt < MIN_FONT_PT:
+            small_fonts.append((row, round(font_pt, 1)))
+        for data_qr in (field.data for field in fields if field.kind == 'qr'):
+            version = qr_min_version(data_qr, profile.qr_error)
+            if version > profile.qr_version:
+                qr_overflows.append((row, data_qr, version))
+
+    sheet_count = 0
+    if label_size is not None:
+        layout = sheet_layout(profile, kind.sheet, *label_size)
+        labels_per_sheet = layout.num_cols * layout.num_rows
+        sheet_count = (label_count + labels_per_sheet - 1) // labels_per_sheet
+
+    for row, font_pt in small_fonts:
+        print(f"Font {font_pt} pt is below {MIN_FONT_PT} pt: {row}")
+    for row, data_qr, version in qr_overflows:
+        print(f"QR payload needs version {version}, QR_VERSION is {profile.qr_version}: {data_qr!r}")
+    print(f"{row_count} rows, {label_count} labels, {sheet_count} sheets, "
+          f"{len(small_fonts)} small fonts, {len(qr_overflows)} QR overflows.")
+    return DryRunReport(row_count, label_count, sheet_count, small_fonts, qr_overflows)
+
+def print_csv_file(kind, csv_filename, target, language='zpl', metrics_file=METRICS_FILE, profile=None):
+    """
+    Send the labels straight to a label printer instead of composing A4 sheets.
+
+    Every label is encoded and written on its own, so the job streams to the
+    printer label by label. 'zpl' uses the printer's own QR code and text
+    commands, 'zpl-grf' and 'tspl' send the rendered label as a 1 bit image.
+    The profile's PPI should match the printer resolution.
+
+    Args:
+        kind (LabelKind): The label kind.
+        csv_filename (str): The filename of the CSV file, or of a Parquet, JSON or XLSX export.
+        target (str): The job file, or 'tcp://host:port' of the printer.
+        language (str): One of PRINTER_LANGUAGES.
+        metrics_file (str): Write the run metrics to this file, see write_run_metrics.
+        profile (RenderProfile): The render profile, None uses the kind's default profile.
+
+    Returns:
+        int: The number of labels sent, copies included.
+    """
+    if language not in PRINTER_LANGUAGES:
+        raise ValueError(f"Unknown printer language '{language}', expected one of {PRINTER_LANGUAGES}")
+
+    profile = profile or kind.default_profile
+    reset_run_metrics(kind)
+    rows = read_sorted_rows(kind, csv_filename)
+    count = 0
+    with open_printer_output(target) as output:
+        for row in rows:
+            copies = parse_copies(row)
+            if copies < 1:
+                continue
+            data = kind.label_data(row)
+            if language == 'zpl':
+                job = encode_zpl(profile, *kind.label_fields(profile, *data), copies=copies)
+            elif language == 'zpl-grf':
+                job = encode_zpl_grf(render_label(kind, profile, data), copies=copies)
+            else:
+                job = encode_tspl_bitmap(profile, render_label(kind, profile, data), copies=copies)
+            output.write(job)
+            count += copies
+            count_metric('rows')
+            count_metric('labels', copies)
+            count_metric('bytes_written', len(job))
+            report_progress()
+
+    if count == 0:
+        print("No records found.")
+        return count
+
+    report_progress(force=True)
+    if metrics_file:
+        write_run_metrics(metrics_file, collect_run_metrics(kind, csv_filename))
+    return count
@@ -0,0 +1,519 @@
+"""
+Regression corpus of the label generators: golden sheets and throughput baselines.
+
+Every case renders an input of cases/ with one of the generator scripts through
+process_csv_file and compares the result with golden.json. The cases render
+with the DejaVu fonts in fonts/ (CASE_FONTS) in place of the scripts' FONT_TYPE,
+so the golden sheets do not depend on the fonts installed on the machine and
+the Cyrillic case draws real glyphs:
+
+- The pixels of every sheet must be identical to the golden sheet. Exact pixels
+  depend on Pillow and FreeType, so when these differ from the ones the golden
+  sheets were made with, the sheets are compared by thumbnails instead, within
+  THUMBNAIL_TOLERANCE.
+- The throughput (labels/s, the fastest of REPEATS runs with cold caches) must
+  not drop more than PERF_TOLERANCE below the baseline. Baselines are only
+  meaningful on the machine they were taken on.
+- The other ways of running a case (FEATURE_CHECKS) must agree with the plain
+  run: sharded, resumed and threaded runs give the same pixels, previews the
+  same number of sheets, printer jobs and the dry run the same labels and QR
+  payloads.
+
+Run it from any directory:
+
+    python regression/run_regression.py                 # check all cases
+    python regression/run_regression.py hw_cyrillic     # check some cases
+    python regression/run_regression.py --accept-perf   # sheets unchanged: take the throughput as new baseline
+    python regression/run_regression.py --update        # intended layout change: rewrite the golden data
+    python regression/run_regression.py --no-features   # golden sheets and throughput only
+"""
+import argparse
+import base64
+import hashlib
+import importlib.util
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+import zlib
+import numpy as np
+import PIL
+from PIL import Image, features
+
+# The corpus directory, the generator scripts are in the directory above it
+CORPUS_DIR = os.path.dirname(os.path.abspath(__file__))
+SCRIPT_DIR = os.path.dirname(CORPUS_DIR)
+GOLDEN_FILE = os.path.join(CORPUS_DIR, 'golden.json')
+FONTS_DIR = os.path.join(CORPUS_DIR, 'fonts')
+
+# The generators import their shared module labels_common from SCRIPT_DIR
+sys.path.insert(0, SCRIPT_DIR)
+import labels_common
+
+# Case name: (generator script, input file in cases/)
+CASES = {
+    'cable_long_hostnames': ('Labels_Cable_gen.py', 'cable_long_hostnames.csv'),
+    'cable_missing_odf': ('Labels_Cable_gen.py', 'cable_missing_odf.csv'),
+    'flag_long_hostnames': ('Flag_labels_Cable_gen.py', 'cable_long_hostnames.csv'),
+    'flag_missing_odf': ('Flag_labels_Cable_gen.py', 'cable_missing_odf.csv'),
+    'hw_cyrillic': ('Labels_HW_gen.py', 'hw_cyrillic.csv'),
+}
+
+# The fonts in FONTS_DIR the cases render with, by the FONT_TYPE of the generator they stand in
+# for. DejaVu Sans and DejaVu Sans Mono Bold (version 2.35, see fonts/LICENSE_DEJAVU) cover
+# Latin and Cyrillic.
+CASE_FONTS = {
+    'arial.ttf': 'DejaVuSans.ttf',
+    'consolab.ttf': 'DejaVuSansMono-Bold.ttf',
+}
+
+# Runs of each case, the fastest one is compared with the throughput baseline
+REPEATS = 3
+# Allowed throughput drop below the baseline, as a fraction of it
+PERF_TOLERANCE = 0.3
+
+# Size of the sheet thumbnails (about 1 mm per pixel), the side of the square blocks of thumbnail
+# pixels their difference is taken over and the largest mean absolute difference (0-255) of a block
+# allowed when Pillow or FreeType differ from the golden run and pixels cannot match exactly. A
+# different antialiasing stays below 5, a label moved by 3 pixels gives more than 12.
+THUMBNAIL_SIZE = (210, 297)
+THUMBNAIL_BLOCK = 8
+THUMBNAIL_TOLERANCE = 8.0
+
+# Sheet number in a sheet filename
+SHEET_NUMBER_PATTERN = re.compile(r'_(\d+)\.png$')
+
+# Generator modules by script, each is loaded once, and the render profiles of their cases by module name
+generators = {}
+case_profiles = {}
+
+def load_generator(script):
+    """
+    Load a generator script as a module, its example usage does not run.
+
+    Args:
+        script (str): The script filename in SCRIPT_DIR.
+
+    Returns:
+        module: The generator module.
+    """
+    if script not in generators:
+        spec = importlib.util.spec_from_file_location(os.path.splitext(script)[0], os.path.join(SCRIPT_DIR, script))
+        module = importlib.util.module_from_spec(spec)
+        # Registered like an imported module, so worker processes find its functions
+        sys.modules[spec.name] = module
+        spec.loader.exec_module(module)
+        generators[script] = module
+    return generators[script]
+
+def file_sha256(filename):
+    """The SHA-256 hex digest of a file."""
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def generator_kind(generator):
+    """The LabelKind a generator module renders, e.g. CABLE_LABELS."""
+    return next(value for value in vars(generator).values() if isinstance(value, labels_common.LabelKind))
+
+def case_profile(generator):
+    """
+    The render profile the cases of a generator render with: its default profile with its CASE_FONTS font.
+
+    Args:
+        generator (module): The generator module from load_generator.
+
+    Returns:
+        RenderProfile: The compiled profile.
+    """
+    if generator.__name__ not in case_profiles:
+        font_type = os.path.join(FONTS_DIR, CASE_FONTS[generator.FONT_TYPE])
+        case_profiles[generator.__name__] = labels_common.compile_render_profile(generator_kind(generator), 'regression',
+                                                                                 {'font_type': font_type})
+    return case_profiles[generator.__name__]
+
+def render_environment():
+    """
+    Describe what exact sheet pixels depend on besides the code.
+
+    Returns:
+        dict: The Pillow and FreeType versions and the SHA-256 of each case font.
+    """
+    fonts = {font: file_sha256(os.path.join(FONTS_DIR, font)) for font in sorted(CASE_FONTS.values())}
+    return {'pillow': PIL.__version__, 'freetype': features.version('freetype2'), 'fonts': fonts}
+
+def sheet_signature(sheet_filename):
+    """
+    Hash the pixels of a sheet and keep a grayscale thumbnail of it.
+
+    The hash is taken over the decoded pixels, so a different PNG encoder does not change it.
+
+    Args:
+        sheet_filename (str): The sheet PNG file.
+
+    Returns:
+        dict: The 'sha256' of the size and RGB pixels and the 'thumbnail', zlib compressed and base64 encoded.
+    """
+    with Image.open(sheet_filename) as sheet:
+        rgb = sheet.convert('RGB')
+    digest = hashlib.sha256(f'{rgb.width}x{rgb.height}'.encode())
+    digest.update(rgb.tobytes())
+    thumbnail = rgb.convert('L').resize(THUMBNAIL_SIZE, Image.BOX)
+    return {'sha256': digest.hexdigest(), 'thumbnail': base64.b64encode(zlib.compress(thumbnail.tobytes(), 9)).decode('ascii')}
+
+def thumbnail_difference(thumbnail_a, thumbnail_b):
+    """
+    The difference of two thumbnails from sheet_signature: the largest mean
+    absolute difference (0-255) of a THUMBNAIL_BLOCK square of them.
+
+    Taken per block rather than over the whole sheet, a moved or missing label
+    counts as much on a sheet with one label as on a full sheet.
+    """
+    width, height = THUMBNAIL_SIZE
+    a, b = (np.frombuffer(zlib.decompress(base64.b64decode(thumbnail)), dtype=np.uint8).astype(np.int16).reshape(height, width)
+            for thumbnail in (thumbnail_a, thumbnail_b))
+    rows, cols = height // THUMBNAIL_BLOCK, width // THUMBNAIL_BLOCK
+    difference = np.abs(a - b)[:rows * THUMBNAIL_BLOCK, :cols * THUMBNAIL_BLOCK]
+    return float(difference.reshape(rows, THUMBNAIL_BLOCK, cols, THUMBNAIL_BLOCK).mean(axis=(1, 3)).max())
+
+def sheet_number(sheet_filename):
+    """The number of a sheet from its filename, for sorting sheet 10 after sheet 9."""
+    return int(SHEET_NUMBER_PATTERN.search(sheet_filename).group(1))
+
+def sheet_signatures(output_dir):
+    """The sheet_signature of every sheet in a directory, in sheet order."""
+    sheet_filenames = sorted((name for name in os.listdir(output_dir) if SHEET_NUMBER_PATTERN.search(name)), key=sheet_number)
+    return [sheet_signature(os.path.join(output_dir, name)) for name in sheet_filenames]
+
+def run_case(script, input_filename, repeats=REPEATS):
+    """
+    Render a case and measure its throughput.
+
+    The caches of the generator are cleared before each run, so every run renders all labels.
+
+    Args:
+        script (str): The generator script.
+        input_filename (str): The input file in cases/.
+        repeats (int): The number of runs, the fastest one counts.
+
+    Returns:
+        dict: The 'labels' and 'labels_per_second' of the run and the signature of each sheet.
+    """
+    generator = load_generator(script)
+    input_path = os.path.join(CORPUS_DIR, 'cases', input_filename)
+    best_seconds = None
+    sheets = None
+    for _ in range(repeats):
+        for function in generator.cached_functions().values():
+            function.cache_clear()
+        with tempfile.TemporaryDirectory() as output_dir:
+            start = time.perf_counter()
+            generator.process_csv_file(input_path, output_dir, profile=case_profile(generator))
+            seconds = time.perf_counter() - start
+            if best_seconds is None or seconds < best_seconds:
+                best_seconds = seconds
+            if sheets is None:
+                sheets = sheet_signatures(output_dir)
+    labels = labels_common.run_state.metrics['labels']
+    return {'labels': labels, 'labels_per_second': round(labels / best_seconds, 1), 'sheets': sheets}
+
+def compare_runs(name, sheets, reference):
+    """
+    Compare the sheets of another way of running a case with the plain run, pixel by pixel.
+
+    Args:
+        name (str): The way of running, used in the descriptions.
+        sheets (list): The sheet signatures of the run.
+        reference (list): The sheet signatures of the plain run.
+
+    Returns:
+        list: A description of every difference, empty if the sheets are identical.
+    """
+    if len(sheets) != len(reference):
+        return [f"{name}: {len(sheets)} sheets, plain run {len(reference)}"]
+    return [f"{name}: sheet {number} differs from the plain run"
+            for number, (sheet, reference_sheet) in enumerate(zip(sheets, reference), start=1)
+            if sheet['sha256'] != reference_sheet['sha256']]
+
+def check_sharded(generator, input_path, result):
+    """Shard the case one sheet per chunk, render the chunks and merge them: the sheets must be the plain run's."""
+    with tempfile.TemporaryDirectory() as work_dir:
+        queue_dir = os.path.join(work_dir, 'queue')
+        output_dir = os.path.join(work_dir, 'sheets')
+        chunks = generator.shard_csv_file(input_path, queue_dir, sheets_per_chunk=1, profile=case_profile(generator))
+        if chunks != len(result['sheets']):
+            return [f"sharded: {chunks} chunks for {len(result['sheets'])} sheets"]
+        generator.run_shard_worker(queue_dir)
+        generator.merge_shards(queue_dir, output_dir)
+        return compare_runs('sharded', sheet_signatures(output_dir), result['sheets'])
+
+def check_resumed(generator, input_path, result):
+    """
+    Interrupt a run after its first sheet and resume it: the sheets must be the plain run's.
+
+    The run is interrupted by a directory in the place of the second sheet,
+    with a checkpoint after every sheet, then the directory is removed and the
+    run resumed. The first sheet must not be rendered again, and resuming with
+    another render profile must be refused.
+    """
+    if len(result['sheets']) < 2:
+        return []
+    with tempfile.TemporaryDirectory() as output_dir:
+        blocker = os.path.join(output_dir, 'labels_a4_sheet_2.png')
+        os.makedirs(blocker)
+        checkpoint_sheets = labels_common.CHECKPOINT_SHEETS
+        labels_common.CHECKPOINT_SHEETS = 1
+        try:
+            generator.process_csv_file(input_path, output_dir, metrics_file=None, profile=case_profile(generator))
+            return ["resumed: the run was not interrupted"]
+        except OSError:
+            pass
+        finally:
+            labels_common.CHECKPOINT_SHEETS = checkpoint_sheets
+        kind = generator_kind(generator)
+        try:
+            generator.process_csv_file(input_path, output_dir, resume=True, metrics_file=None,
+                                       profile=labels_common.preview_profile(kind, case_profile(generator)))
+            return ["resumed: the checkpoint was accepted by a run with another render profile"]
+        except ValueError:
+            pass
+        os.rmdir(blocker)
+        first_sheet = os.path.join(output_dir, 'labels_a4_sheet_1.png')
+        first_sheet_mtime = os.stat(first_sheet).st_mtime_ns
+        generator.process_csv_file(input_path, output_dir, resume=True, metrics_file=None, profile=case_profile(generator))
+        problems = compare_runs('resumed', sheet_signatures(output_dir), result['sheets'])
+        if os.stat(first_sheet).st_mtime_ns != first_sheet_mtime:
+            problems.append("resumed: the finished first sheet was rendered again")
+        return problems
+
+def check_threaded(generator, input_path, result):
+    """
+    Render the case with the default and the preview profile in two threads at
+    the same time, from empty caches: each must give the sheets and label count
+    of its own profile rendered alone.
+    """
+    kind = generator_kind(generator)
+    profiles = {'default': case_profile(generator), 'preview': labels_common.preview_profile(kind, case_profile(generator))}
+    with tempfile.TemporaryDirectory() as work_dir:
+        expected = {'default': (result['labels'], result['sheets'])}
+        generator.process_csv_file(input_path, os.path.join(work_dir, 'alone'), metrics_file=None, profile=profiles['preview'])
+        expected['preview'] = (labels_common.run_state.metrics['labels'], sheet_signatures(os.path.join(work_dir, 'alone')))
+
+        runs = {}
+        def render(name):
+            try:
+                generator.process_csv_file(input_path, os.path.join(work_dir, name), metrics_file=None, profile=profiles[name])
+                runs[name] = labels_common.run_state.metrics['labels']
+            except Exception as error:
+                runs[name] = error
+
+        for function in generator.cached_functions().values():
+            function.cache_clear()
+        threads = [threading.Thread(target=render, args=(name,)) for name in profiles]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        problems = []
+        for name, (labels, sheets) in expected.items():
+            if isinstance(runs[name], Exception):
+                problems.append(f"threaded {name}: {runs[name]!r}")
+                continue
+            if runs[name] != labels:
+                problems.append(f"threaded {name}: counted {runs[name]} labels, alone {labels}")
+            problems.extend(compare_runs(f'threaded {name}', sheet_signatures(os.path.join(work_dir, name)), sheets))
+        return problems
+
+def check_preview(generator, input_path, result):
+    """Render previews: the whole input gives as many sheets as the plain run, max_sheets=0 none."""
+    with tempfile.TemporaryDirectory() as output_dir:
+        problems = []
+        sheets = generator.preview_csv_file(input_path, output_dir, profile=case_profile(generator))
+        if sheets != len(result['sheets']):
+            problems.append(f"preview: {sheets} sheets, plain run {len(result['sheets'])}")
+        if generator.preview_csv_file(input_path, os.path.join(output_dir, 'none'), max_sheets=0, profile=case_profile(generator)) != 0:
+            problems.append("preview: max_sheets=0 rendered sheets")
+        return problems
+
+def zpl_field_data(job, command):
+    """The data of the fields of a ZPL job that use a command, e.g. '^BQN', with the _XX escapes of zpl_escape decoded."""
+    pattern = re.compile(re.escape(command) + r'[^\^]*\^FH\^FD(.*?)\^FS', re.DOTALL)
+    return [re.sub(r'_([0-9A-F]{2})', lambda match: chr(int(match.group(1), 16)), data) for data in pattern.findall(job)]
+
+def check_print(generator, input_path, result):
+    """
+    Print the case as ZPL to a file: one job per row with the row's copies,
+    and the QR fields carry the payloads of the label in label order.
+    """
+    kind = generator_kind(generator)
+    rows = list(labels_common.read_sorted_rows(kind, input_path))
+    with tempfile.TemporaryDirectory() as output_dir:
+        job_filename = os.path.join(output_dir, 'labels.zpl')
+        sent = generator.print_csv_file(input_path, job_filename, metrics_file=None, profile=case_profile(generator))
+        with open(job_filename, encoding='utf-8') as job_file:
+            jobs = [job for job in job_file.read().split('^XZ') if job.strip()]
+    problems = []
+    if sent != result['labels']:
+        problems.append(f"print: {sent} labels sent, plain run {result['labels']}")
+    if len(jobs) != len(rows):
+        return problems + [f"print: {len(jobs)} ZPL jobs for {len(rows)} rows"]
+    copies = sum(int(match.group(1)) if match else 1 for match in (re.search(r'\^PQ(\d+)', job) for job in jobs))
+    if copies != result['labels']:
+        problems.append(f"print: ^PQ copies add up to {copies}, plain run {result['labels']} labels")
+    for row, job in zip(rows, jobs):
+        # The QR data starts with the error correction level and the input mode, e.g. 'MA,'
+        payloads = [data.split(',', 1)[1] for data in zpl_field_data(job, '^BQN')]
+        if payloads != list(kind.qr_payloads(row)):
+            problems.append(f"print: QR fields {payloads!r}, row {row}")
+            break
+        if not zpl_field_data(job, '^A0'):
+            problems.append(f"print: no text fields, row {row}")
+            break
+    return problems
+
+def check_dry_run(generator, input_path, result):
+    """Check the case without rendering it: the dry run must count the plain run's labels and sheets."""
+    report = generator.dry_run_csv_file(input_path, profile=case_profile(generator))
+    rows = sum(1 for _ in labels_common.read_input_rows(generator_kind(generator), input_path))
+    problems = []
+    if (report.rows, report.labels, report.sheets) != (rows, result['labels'], len(result['sheets'])):
+        problems.append(f"dry run: {report.rows} rows, {report.labels} labels, {report.sheets} sheets, "
+                        f"expected {rows} rows, {result['labels']} labels, {len(result['sheets'])} sheets")
+    return problems
+
+def check_verify(generator, input_path, result):
+    """Render the case and scan the QR codes of its sheets back, needs OpenCV."""
+    if importlib.util.find_spec('cv2') is None:
+        print("    SKIP verify: OpenCV (opencv-contrib-python) is not installed")
+        return []
+    with tempfile.TemporaryDirectory() as output_dir:
+        generator.process_csv_file(input_path, output_dir, metrics_file=None, profile=case_profile(generator))
+        mismatches = generator.verify_sheets(input_path, output_dir, profile=case_profile(generator))
+    return [f"verify: {mismatch}" for mismatch in mismatches]
+
+# Other ways of running a case, each is checked against the plain run of run_case
+FEATURE_CHECKS = {
+    'sharded': check_sharded,
+    'resumed': check_resumed,
+    'threaded': check_threaded,
+    'preview': check_preview,
+    'print': check_print,
+    'dry_run': check_dry_run,
+    'verify': check_verify,
+}
+
+def run_feature_checks(script, input_filename, result):
+    """
+    Run the FEATURE_CHECKS of a case.
+
+    Args:
+        script (str): The generator script.
+        input_filename (str): The input file in cases/.
+        result (dict): The result of the plain run, see run_case.
+
+    Returns:
+        list: A description of every problem, empty if all checks pass.
+    """
+    generator = load_generator(script)
+    input_path = os.path.join(CORPUS_DIR, 'cases', input_filename)
+    problems = []
+    for check in FEATURE_CHECKS.values():
+        problems.extend(check(generator, input_path, result))
+    return problems
+
+def compare_sheets(result, golden, exact):
+    """
+    Compare the sheets of a case with its golden sheets.
+
+    Args:
+        result (dict): The case result from run_case.
+        golden (dict): The golden result of the case.
+        exact (bool): Whether the pixels have to match, otherwise the thumbnails are compared.
+
+    Returns:
+        list: A description of every difference, empty if the sheets match.
+    """
+    problems = []
+    if result['labels'] != golden['labels']:
+        problems.append(f"{result['labels']} labels, golden {golden['labels']}")
+    if len(result['sheets']) != len(golden['sheets']):
+        problems.append(f"{len(result['sheets'])} sheets, golden {len(golden['sheets'])}")
+    for number, (sheet, golden_sheet) in enumerate(zip(result['sheets'], golden['sheets']), start=1):
+        if sheet['sha256'] == golden_sheet['sha256']:
+            continue
+        difference = thumbnail_difference(sheet['thumbnail'], golden_sheet['thumbnail'])
+        if exact or difference > THUMBNAIL_TOLERANCE:
+            problems.append(f"sheet {number} differs (thumbnail difference {difference:.2f})")
+    return problems
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the label generators against the golden sheets and throughput baselines.')
+    parser.add_argument('cases', nargs='*', help=f"cases to run, all by default: {', '.join(CASES)}")
+    parser.add_argument('--update', action='store_true', help='rewrite the golden sheets and baselines of the cases')
+    parser.add_argument('--accept-perf', action='store_true', help='take the throughput as new baseline if all sheets match')
+    parser.add_argument('--no-perf', action='store_true', help='check the sheets only')
+    parser.add_argument('--no-features', action='store_true', help='skip the FEATURE_CHECKS of the cases')
+    parser.add_argument('--repeats', type=int, default=REPEATS, help='runs of each case, the fastest one counts')
+    args = parser.parse_args()
+    case_names = args.cases or list(CASES)
+    unknown = [name for name in case_names if name not in CASES]
+    if unknown:
+        parser.error(f"unknown cases: {', '.join(unknown)}")
+
+    golden = {'environment': None, 'cases': {}}
+    if os.path.exists(GOLDEN_FILE):
+        with open(GOLDEN_FILE, encoding='utf-8') as golden_file:
+            golden = json.load(golden_file)
+    environment = render_environment()
+    exact = golden['environment'] == environment
+    if not exact and golden['environment'] is not None and not args.update:
+        print(f"Fonts or Pillow differ from the golden run, comparing sheet thumbnails only: {environment}")
+
+    results = {name: run_case(*CASES[name], repeats=args.repeats) for name in case_names}
+
+    failed = False
+    for name, result in results.items():
+        golden_case = golden['cases'].get(name)
+        if args.update:
+            print(f"UPDATED {name}: {len(result['sheets'])} sheets, {result['labels_per_second']} labels/s")
+            continue
+        if golden_case is None:
+            print(f"FAIL {name}: no golden data, run with --update")
+            failed = True
+            continue
+        problems = compare_sheets(result, golden_case, exact)
+        if not args.no_features:
+            problems.extend(run_feature_checks(*CASES[name], result))
+        speed = result['labels_per_second'] / golden_case['labels_per_second']
+        if not args.no_perf and speed < 1 - PERF_TOLERANCE:
+            problems.append(f"throughput dropped to {speed:.0%} of the baseline")
+        print(f"{'FAIL' if problems else 'PASS'} {name}: {len(result['sheets'])} sheets, {result['labels_per_second']} labels/s "
+              f"(baseline {golden_case['labels_per_second']}, x{speed:.2f})")
+        for problem in problems:
+            print(f"    {problem}")
+        failed = failed or bool(problems)
+
+    if args.update or (args.accept_perf and not failed):
+        for name, result in results.items():
+            if args.update:
+                golden['cases'][name] = result
+            else:
+                golden['cases'][name]['labels_per_second'] = result['labels_per_second']
+        if args.update:
+            golden['environment'] = environment
+        with open(GOLDEN_FILE, 'w', encoding='utf-8') as golden_file:
+            json.dump(golden, golden_file, indent=1)
+            golden_file.write('\n')
+        print(f"Saved {GOLDEN_FILE}")
+    elif args.accept_perf:
+        print("Sheets differ from the golden ones, the baselines are kept.")
+    return 1 if failed and not args.update else 0
+
+if __name__ == '__main__':
+    sys.exit(main())